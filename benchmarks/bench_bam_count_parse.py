@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Benchmark the bam-readcount output parser on a genome-sized synthetic file.
+
+Compares the columnar parser of bam2count (one parse feeding the stats and the extract) with the previous
+line-by-line parser that built a dict per base field and an OrderedDict per row, once for the stats and once for
+the extract.
+
+    python benchmarks/bench_bam_count_parse.py --positions 5000000 --out bench_parse.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd  # noqa: E402
+
+from mutanalysis import bam2count  # noqa: E402
+
+HEADER = ':'.join(bam2count.BAM_COUNT_HEADER)
+
+
+def write_fixture(path, positions, contigs, seed=1):
+    rng = random.Random(seed)
+    per_contig = positions // contigs
+    with open(path, 'w') as out_f:
+        for c in range(contigs):
+            for pos in range(1, per_contig + 1):
+                ref = 'ACGT'[rng.randrange(4)]
+                depth = rng.randrange(0, 120)
+                fields = ['=:0:0.00:0.00:0.00:0:0:0.00:0.00:0.00:0:0.00:0.00:0.00']
+                for base in 'ACGTN':
+                    count = depth if base == ref else 0
+                    fields.append('{0}:{1}:60.00:{2:.2f}:0.00:{3}:{4}:0.50:0.01:10.00:0:0.00:0.00:0.50'.format(
+                        base, count, 30 + rng.random() * 10 if count else 0, count // 2, count - count // 2))
+                out_f.write('\t'.join(['contig_{0}'.format(c), str(pos), ref, str(depth)] + fields) + '\n')
+
+
+def legacy_stats_lists(bam_count_file):
+    ctg_ref_depth, ctg_ref_qual = {}, {}
+    with open(bam_count_file) as count_f:
+        for line in count_f:
+            line = line.strip().split('\t')
+            ctg, ref = line[0], line[2]
+            for item in line[4:]:
+                data = dict(zip(HEADER.split(':'), item.split(':')))
+                if data['base'] == ref:
+                    ctg_ref_depth.setdefault(ctg, []).append(int(data['count']))
+                    ctg_ref_qual.setdefault(ctg, []).append(round(float(data['avg_base_quality']), 2))
+    return ctg_ref_depth, ctg_ref_qual
+
+
+def legacy_extract(bam_count_file):
+    result_data = []
+    with open(bam_count_file) as count_f:
+        for line in count_f:
+            line = line.strip().split('\t')
+            data = [('ID', line[0]), ('position', int(line[1])), ('reference', line[2]), ('total_depth', int(line[3]))]
+            for item in line[4:]:
+                d = dict(zip(HEADER.split(':'), item.split(':')))
+                if d['base'] != '=':
+                    data.append(('{0}_depth'.format(d['base']), int(d['count'])))
+                    data.append(('{0}_quality'.format(d['base']), round(float(d['avg_base_quality']), 2)))
+            result_data.append(OrderedDict(data))
+    return pd.DataFrame.from_dict(result_data)
+
+
+def columnar(bam_count_file):
+    table = bam2count.read_bam_count(bam_count_file)
+    ref_depth, valid = bam2count.reference_values(table, 'depth')
+    ref_qual = bam2count.reference_values(table, 'quality')[0]
+    return table, ref_depth[valid], ref_qual[valid]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return round(time.perf_counter() - start, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--positions', type=int, default=1000000, help="Number of positions (Default=1000000)")
+    parser.add_argument('--contigs', type=int, default=2, help="Number of contigs (Default=2)")
+    parser.add_argument('--out', default='', help="JSON result file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fixture = os.path.join(tmp_dir, 'raw.csv')
+        write_fixture(fixture, args.positions, args.contigs)
+        legacy = timed(legacy_stats_lists, fixture) + timed(legacy_extract, fixture)
+        new = timed(columnar, fixture)
+
+    result = OrderedDict([('benchmark', 'bam_count_parse'), ('positions', args.positions),
+                          ('contigs', args.contigs), ('legacy_s', legacy), ('columnar_s', new),
+                          ('speedup', round(legacy / new, 2) if new else None)])
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, 'w') as out_f:
+            json.dump(result, out_f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark the per-sample time against the catalogue size, up to a panel of 10k mutations.
+
+One sample is simulated over the largest panel (benchmarks/simulate_reads.py, 10 mutations per gene), its true
+alignments written to a BAM (needs pysam), then the count, codon and report stages are timed for the first N
+mutations of the catalogue. The growth of the per-sample time is summarised by the slope of log(time) against
+log(N): below 1 the time grows sub-linearly with the catalogue. The routing of the count rows by the interval index
+(bam2count.route_regions) is also compared with a scan of the count table per site (bam2count.select_region).
+
+    python benchmarks/bench_catalogue_scaling.py
+    python benchmarks/bench_catalogue_scaling.py --sizes 10 100 1000 10000 --depth 30 --out bench_scaling.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pandas as pd  # noqa: E402
+
+import simulate_reads  # noqa: E402
+from mutanalysis import bam2count, catalogue, codon, mut2report  # noqa: E402
+from mutanalysis.siteplan import SitePlan  # noqa: E402
+
+# per-sample stages, the routing comparison is reported apart
+SAMPLE_STAGES = ['plan', 'count', 'codons', 'report']
+
+
+def timed(stages, name, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    stages[name] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def run_size(work_dir, sequence_file, sites, counter, jobs):
+    stages = OrderedDict()
+    regions = OrderedDict((key, (site['feature'], site['position'])) for key, site in sites.items())
+    codons = OrderedDict((key, (site['feature'], site['start'])) for key, site in sites.items())
+
+    plan = timed(stages, 'plan', SitePlan,
+                 OrderedDict((key, bam2count.site_interval(position)) for key, (name, position) in regions.items()))
+    counts = timed(stages, 'count', bam2count.main, work_dir, sequence_file, regions, backend=counter, jobs=jobs)
+    histograms = timed(stages, 'codons', codon.count_codons, os.path.join(work_dir, 'sequence.bam'), codons,
+                       'samtools' if shutil.which('samtools') else 'pysam')
+
+    def report():
+        rows = []
+        for key, count_table in counts.items():
+            rows.extend(mut2report.site_rows(sites[key], count_table, histograms.get(key), 'bench'))
+        return mut2report.report(work_dir, rows)
+    timed(stages, 'report', report)
+
+    # routing of the rows: interval index against a scan of the whole table per site
+    table = pd.concat(list(counts.values()), ignore_index=True) if counts else bam2count.empty_count_table()
+    routing = OrderedDict()
+    timed(routing, 'index', bam2count.route_regions, table, plan)
+    timed(routing, 'scan', lambda: [bam2count.select_region(table, position) for name, position in regions.values()])
+
+    return OrderedDict([('mutations', len(sites)), ('regions', plan.nb_regions()), ('stages', stages),
+                        ('total_s', round(sum(stages[name] for name in SAMPLE_STAGES), 4)), ('routing', routing)])
+
+
+def slope(cases, value):
+    """
+    Slope of log(value) against log(mutations) between the smallest and the largest catalogue.
+    """
+    first, last = cases[0], cases[-1]
+    if last['mutations'] == first['mutations'] or not value(first) or not value(last):
+        return None
+    return round(math.log(value(last) / value(first)) / math.log(last['mutations'] / float(first['mutations'])), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help="Catalogue sizes (Default=10 100 1000 10000)")
+    parser.add_argument('--depth', type=int, default=20, help="Depth of the simulated sample (Default=20)")
+    parser.add_argument('--background', type=float, default=0.2,
+                        help="Off-target pairs per on-target pair (Default=0.2)")
+    parser.add_argument('--counter', choices=['bam-readcount', 'pysam'],
+                        help="Counting backend (Default=bam-readcount when installed, pysam otherwise)")
+    parser.add_argument('--jobs', type=int, default=1, help="Concurrent bam-readcount shards (Default=1)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (Default=1)")
+    parser.add_argument('--out', default='', help="JSON result file")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Show the output of the pipeline stages")
+    args = parser.parse_args()
+
+    counter = args.counter or ('bam-readcount' if shutil.which('bam-readcount') else 'pysam')
+    sizes = sorted(args.sizes)
+    cases = []
+    with tempfile.TemporaryDirectory(prefix='bench_scaling_') as work_dir:
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with output:
+            # one sample over the largest panel, the smaller catalogues are its first mutations
+            sequence_file, mutation_file, sim_sites = simulate_reads.make_dataset(work_dir, sizes[-1],
+                                                                                  seed=args.seed)
+            fastq_1, fastq_2, truth = simulate_reads.simulate_reads(sequence_file, sim_sites, work_dir, args.depth,
+                                                                    background=args.background, seed=args.seed)
+            simulate_reads.write_truth_bam(sequence_file, truth, os.path.join(work_dir, 'sequence.bam'))
+            panel = catalogue.compile_catalogue(mutation_file, sequence_file)
+        all_sites = OrderedDict(((site['feature'], site['mutation']), site) for site in panel['sites'])
+        print('Sample: {0} read pairs over {1} sequences'.format(len(truth), len(panel['features'])), flush=True)
+
+        for size in sizes:
+            sites = OrderedDict(list(all_sites.items())[:size])
+            with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+                case = run_size(work_dir, sequence_file, sites, counter, args.jobs)
+            cases.append(case)
+            print('mutations {0:>6} regions {1:>6}: {2} s (routing index {3} s, scan {4} s)'.format(
+                case['mutations'], case['regions'], case['total_s'], case['routing']['index'],
+                case['routing']['scan']), flush=True)
+
+    results = OrderedDict([('benchmark', 'catalogue_scaling'), ('depth', args.depth), ('counter', counter),
+                           ('read_pairs', len(truth)), ('cases', cases),
+                           ('slope_total', slope(cases, lambda case: case['total_s'])),
+                           ('slope_routing_index', slope(cases, lambda case: case['routing']['index'])),
+                           ('slope_routing_scan', slope(cases, lambda case: case['routing']['scan']))])
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as out_f:
+            json.dump(results, out_f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
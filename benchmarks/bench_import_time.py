@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark the start-up of the command line: the import-time profile (python -X importtime) of the entry points and
+the wall time of `mutanalysis -V`.
+
+Each entry point is imported in a fresh interpreter, several times, and the median of its cumulative import time is
+reported with the slowest modules it pulls in. The light entry points (command line, catalogue, report) must not
+import the heavy dependencies (pandas, numpy, pysam, asyncio): they are reported, and fail the run, when they do.
+
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --repeat 20 --out bench_import.json
+    python benchmarks/bench_import_time.py --baseline bench_import.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# entry point -> (module imported, True when it must stay free of the heavy dependencies)
+ENTRY_POINTS = OrderedDict([
+    ('cli', ('mutanalysis.mutAnalysis', True)),
+    ('catalogue', ('mutanalysis.catalogue', True)),
+    ('report', ('mutanalysis.mut2report', True)),
+    ('count', ('mutanalysis.bam2count', False)),
+])
+
+HEAVY_MODULES = ['pandas', 'numpy', 'pysam', 'asyncio', 'Bio']
+
+# entry points faster than this (ms) are not reported as regressions (timer noise)
+NOISE_FLOOR = 20.0
+
+
+def import_profile(module):
+    """
+    Cumulative import time (ms) of each top-level import of module in a fresh interpreter.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(module)], env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    profile = OrderedDict()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = [field.strip() for field in line[len('import time:'):].split('|')]
+        profile[name] = int(cumulative_us) / 1000.0
+    return profile
+
+
+def version_wall_time():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'mutanalysis.mutAnalysis', '-V'], env=env, stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000.0
+
+
+def run_entry(module, light, repeat, top):
+    totals = []
+    profile = None
+    for _ in range(repeat):
+        profile = import_profile(module)
+        totals.append(profile[module])
+    heavy = [name for name in HEAVY_MODULES if name in profile]
+    slowest = sorted(((name, ms) for name, ms in profile.items() if name.split('.')[0] != 'mutanalysis'),
+                     key=lambda item: -item[1])[:top]
+    return OrderedDict([('module', module), ('import_ms', round(statistics.median(totals), 1)),
+                        ('modules', len(profile)), ('heavy', heavy), ('light', light),
+                        ('slowest', OrderedDict((name, round(ms, 1)) for name, ms in slowest))])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the entry points slower to import than the baseline by more than tolerance (a fraction).
+    """
+    regressions = []
+    for name, entry in results['entry_points'].items():
+        base_entry = baseline['entry_points'].get(name)
+        if not base_entry or entry['import_ms'] < NOISE_FLOOR:
+            continue
+        if entry['import_ms'] > base_entry['import_ms'] * (1 + tolerance):
+            regressions.append(OrderedDict([('entry_point', name), ('baseline_ms', base_entry['import_ms']),
+                                            ('ms', entry['import_ms']),
+                                            ('ratio', round(entry['import_ms'] / base_entry['import_ms'], 2))]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters per entry point (Default=5)")
+    parser.add_argument('--top', type=int, default=10, help="Slowest imports reported per entry point (Default=10)")
+    parser.add_argument('--out', default='', help="JSON result file")
+    parser.add_argument('--baseline', default='', help="JSON result file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Slowdown reported as a regression, as a fraction of the baseline (Default=0.25)")
+    args = parser.parse_args()
+
+    entry_points = OrderedDict()
+    for name, (module, light) in ENTRY_POINTS.items():
+        entry_points[name] = run_entry(module, light, args.repeat, args.top)
+        print('{0:<10} {1:<26} {2:>8} ms {3}'.format(name, module, entry_points[name]['import_ms'],
+                                                     ', '.join(entry_points[name]['heavy'])), flush=True)
+    version_ms = statistics.median(version_wall_time() for _ in range(args.repeat))
+    print('mutanalysis -V: {0:.1f} ms'.format(version_ms), flush=True)
+
+    results = OrderedDict([('benchmark', 'import_time'), ('python', sys.version.split()[0]),
+                           ('repeat', args.repeat), ('version_ms', round(version_ms, 1)),
+                           ('entry_points', entry_points)])
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as out_f:
+            json.dump(results, out_f, indent=2)
+
+    failed = False
+    for name, entry in entry_points.items():
+        if entry['light'] and entry['heavy']:
+            print('HEAVY IMPORT {0}: {1}'.format(name, ', '.join(entry['heavy'])))
+            failed = True
+    if args.baseline:
+        with open(args.baseline) as in_f:
+            regressions = compare(results, json.load(in_f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {entry_point}: {baseline_ms} ms -> {ms} ms (x{ratio})'.format(**regression))
+        failed = failed or bool(regressions)
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
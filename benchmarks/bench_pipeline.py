@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Benchmark every stage of the pipeline on simulated data, over a matrix of read depths and catalogue sizes.
+
+Each case simulates a reference, a catalogue and paired reads (benchmarks/simulate_reads.py), then times the
+stages separately: catalogue, index, align, convert/split/sort/index, count, stats/extract, codons and report.
+Without bwa and samtools the alignment stages are skipped and the true alignments of the simulated reads are
+counted instead (needs pysam).
+
+    python benchmarks/bench_pipeline.py --profile smoke
+    python benchmarks/bench_pipeline.py --profile default --out bench_pipeline.json
+    python benchmarks/bench_pipeline.py --profile default --baseline bench_pipeline.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import simulate_reads  # noqa: E402
+from mutanalysis import bam2count, catalogue, codon, mapping, mut2report  # noqa: E402
+
+# depths x catalogue sizes of each profile, the smoke profile runs in a few seconds
+PROFILES = {
+    'smoke': {'depths': [20], 'mutations': [1, 10], 'background': 1.0},
+    'default': {'depths': [50, 200], 'mutations': [1, 50, 200], 'background': 5.0},
+    'full': {'depths': [100, 500, 1000], 'mutations': [1, 100, 1000], 'background': 20.0},
+}
+
+# stages faster than this are not reported as regressions (timer noise)
+NOISE_FLOOR = 0.05
+
+
+class Timer:
+    """
+    Wall time of the stages of a case, in run order.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.stages[name] = round(time.perf_counter() - start, 4)
+
+    def skip(self, name):
+        self.stages[name] = None
+
+
+def run_case(work_dir, depth, nb_mutations, args):
+    timer = Timer()
+    aligner = shutil.which('bwa') and shutil.which('samtools')
+    counter = args.counter or ('bam-readcount' if shutil.which('bam-readcount') else 'pysam')
+
+    with timer.stage('simulate'):
+        sequence_file, mutation_file, sim_sites = simulate_reads.make_dataset(work_dir, nb_mutations,
+                                                                              seed=args.seed)
+        fastq_1, fastq_2, truth = simulate_reads.simulate_reads(sequence_file, sim_sites, work_dir, depth,
+                                                                error_rate=args.error_rate, minority=args.minority,
+                                                                background=args.background, seed=args.seed)
+
+    with timer.stage('catalogue'):
+        mut_catalogue = catalogue.compile_catalogue(mutation_file, sequence_file)
+    sites = OrderedDict(((site['feature'], site['mutation']), site) for site in mut_catalogue['sites'])
+    regions = OrderedDict((key, (site['feature'], site['position'])) for key, site in sites.items())
+    codons = OrderedDict((key, (site['feature'], site['start'])) for key, site in sites.items())
+
+    bam_file = os.path.join(work_dir, 'sequence.bam')
+    if aligner:
+        with timer.stage('index'):
+            index_file = mapping.index_bwa(sequence_file, work_dir, force=True)
+        with timer.stage('align'):
+            sam_file = mapping.alignment_bwa(index_file, fastq_1, fastq_2, work_dir, args.threads)
+        with timer.stage('convert_split_sort_index'):
+            bam_file = mapping.convert_sam_to_bam(sam_file)
+            mapping.split_unmapped_mapped_reads(bam_file, unmapped='skip')
+            mapping.sort_bam_file(bam_file)
+    else:
+        for name in ('index', 'align', 'convert_split_sort_index'):
+            timer.skip(name)
+        simulate_reads.write_truth_bam(sequence_file, truth, bam_file)
+
+    with timer.stage('count'):
+        counts = bam2count.main(work_dir, sequence_file, regions, backend=counter)
+
+    with timer.stage('stats_extract'):
+        for key, count_table in counts.items():
+            out_prefix = os.path.join(work_dir, 'bench_{0}'.format(count_table['position'].iloc[0]))
+            bam2count.bam_count_stats(count_table, out_prefix + '_stats')
+            bam2count.bam_count_extract(count_table, out_prefix + '_count')
+
+    with timer.stage('codons'):
+        histograms = codon.count_codons(bam_file, codons, 'samtools' if shutil.which('samtools') else 'pysam')
+
+    with timer.stage('report'):
+        rows = []
+        for key, count_table in counts.items():
+            rows.extend(mut2report.site_rows(sites[key], count_table, histograms.get(key), 'bench'))
+        mut2report.report(work_dir, rows)
+
+    return OrderedDict([('depth', depth), ('mutations', nb_mutations), ('read_pairs', len(truth)),
+                        ('aligner', bool(aligner)), ('counter', counter), ('stages', timer.stages),
+                        ('total_s', round(sum(t for t in timer.stages.values() if t), 4))])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the stages slower than the baseline by more than tolerance (a fraction) for the same case.
+    """
+    regressions = []
+    base_cases = {(case['depth'], case['mutations']): case for case in baseline['cases']}
+    for case in results['cases']:
+        base_case = base_cases.get((case['depth'], case['mutations']))
+        if base_case is None:
+            continue
+        for stage, seconds in case['stages'].items():
+            base_seconds = base_case['stages'].get(stage)
+            if seconds is None or not base_seconds or seconds < NOISE_FLOOR:
+                continue
+            if seconds > base_seconds * (1 + tolerance):
+                regressions.append(OrderedDict([('depth', case['depth']), ('mutations', case['mutations']),
+                                                ('stage', stage), ('baseline_s', base_seconds),
+                                                ('seconds', seconds), ('ratio', round(seconds / base_seconds, 2))]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile', default='smoke', choices=sorted(PROFILES), help="Case matrix (Default=smoke)")
+    parser.add_argument('--depths', type=int, nargs='+', help="Read depths, override the profile")
+    parser.add_argument('--mutations', type=int, nargs='+', help="Catalogue sizes, override the profile")
+    parser.add_argument('--background', type=float, help="Off-target pairs per on-target pair, override the profile")
+    parser.add_argument('--error-rate', type=float, default=0.001, help="Substitution rate (Default=0.001)")
+    parser.add_argument('--minority', type=float, default=0.1,
+                        help="Fraction of the fragments carrying the resistant codons (Default=0.1)")
+    parser.add_argument('--counter', choices=['bam-readcount', 'pysam'],
+                        help="Counting backend (Default=bam-readcount when installed, pysam otherwise)")
+    parser.add_argument('--threads', type=int, default=4, help="Threads of the aligner (Default=4)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (Default=1)")
+    parser.add_argument('--out', default='', help="JSON result file")
+    parser.add_argument('--baseline', default='', help="JSON result file to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Slowdown reported as a regression, as a fraction of the baseline (Default=0.25)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Show the output of the pipeline stages")
+    args = parser.parse_args()
+
+    profile = PROFILES[args.profile]
+    depths = args.depths or profile['depths']
+    sizes = args.mutations or profile['mutations']
+    if args.background is None:
+        args.background = profile['background']
+
+    cases = []
+    for depth in depths:
+        for nb_mutations in sizes:
+            with tempfile.TemporaryDirectory(prefix='bench_') as work_dir:
+                output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+                with output:
+                    case = run_case(work_dir, depth, nb_mutations, args)
+            cases.append(case)
+            print('depth {0:>5} mutations {1:>5}: {2} s'.format(depth, nb_mutations, case['total_s']), flush=True)
+
+    results = OrderedDict([('benchmark', 'pipeline'), ('profile', args.profile), ('background', args.background),
+                           ('error_rate', args.error_rate), ('minority', args.minority), ('seed', args.seed),
+                           ('cases', cases)])
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, 'w') as out_f:
+            json.dump(results, out_f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as in_f:
+            regressions = compare(results, json.load(in_f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION depth {depth} mutations {mutations} {stage}: {baseline_s} s -> {seconds} s '
+                  '(x{ratio})'.format(**regression))
+        if regressions:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
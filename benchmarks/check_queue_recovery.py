@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Check the recovery of the work queue when a worker stalls: N workers share a temporary queue, one of them is stopped
+(SIGSTOP) in the middle of a sample until its lease is reclaimed by another worker, then resumed (SIGCONT).
+
+The stalled worker must stop its commands and exit without recording the sample, every sample must be done exactly
+once (by the worker holding its lease) and no command of any worker may survive. The commands of each worker are
+found through a marker variable of their environment (Linux /proc).
+
+    python benchmarks/check_queue_recovery.py -1 R1.fastq.gz -2 R2.fastq.gz --workers 3 --samples 2
+    python benchmarks/check_queue_recovery.py -1 R1.fastq.gz -2 R2.fastq.gz --bin-dir fake_tools --lease 6
+
+Options not listed here are passed to each sample run. With fewer samples than workers, a free worker reclaims the
+stalled sample as soon as its lease expires; commands longer than the stall (lease + 2 heartbeats) show that the
+commands still running at the resume are stopped.
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MARKER = 'MUTANALYSIS_QUEUE_CHECK'
+
+
+def queue_command(action, queue_dir, *options):
+    return [sys.executable, '-m', 'mutanalysis.mutAnalysis', 'queue', action, '-q', queue_dir] + list(options)
+
+
+def marked_processes(marker):
+    # processes whose environment holds the marker of a worker
+    entry = '{0}={1}'.format(MARKER, marker).encode()
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', name, 'environ'), 'rb') as in_f:
+                if entry in in_f.read().split(b'\0'):
+                    pids.append(int(name))
+        except OSError:
+            continue
+    return pids
+
+
+def read_json(path):
+    try:
+        with open(path) as in_f:
+            return json.load(in_f)
+    except (OSError, ValueError):
+        return None
+
+
+def wait_for(condition, timeout, interval=0.2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(interval)
+    return None
+
+
+def running_sample(queue_dir, workers):
+    # a worker in the middle of a sample, as (worker index, worker id, sample id)
+    for status_file in os.listdir(os.path.join(queue_dir, 'workers')):
+        status = read_json(os.path.join(queue_dir, 'workers', status_file))
+        if status and status['state'] == 'running' and status.get('stage'):
+            for index, worker in enumerate(workers):
+                if worker.pid == status['pid']:
+                    return index, status['worker'], status['sample']
+    return None
+
+
+def attempts(queue_dir, sample_id):
+    for shard in os.listdir(os.path.join(queue_dir, 'tasks')):
+        attempts_file = os.path.join(queue_dir, 'tasks', shard, sample_id + '.attempts')
+        if os.path.exists(attempts_file):
+            with open(attempts_file) as in_f:
+                return [line.split('\t')[0] for line in in_f]
+    return []
+
+
+def check(args, sample_options, tmp_dir):
+    queue_dir = os.path.join(tmp_dir, 'queue')
+    sheet_file = os.path.join(tmp_dir, 'samples.tsv')
+    with open(sheet_file, 'w') as out_f:
+        for i in range(args.samples):
+            out_f.write('S{0:02d}\t{1}\t{2}\n'.format(i + 1, os.path.abspath(args.reads_1),
+                                                      os.path.abspath(args.reads_2)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR] + os.environ.get('PYTHONPATH', '').split(
+        os.pathsep)).rstrip(os.pathsep))
+    if args.bin_dir:
+        env['PATH'] = os.pathsep.join([os.path.abspath(args.bin_dir), env['PATH']])
+    subprocess.run(queue_command('init', queue_dir, '-s', sheet_file, '-wd', os.path.join(tmp_dir, 'work'), '-i',
+                                 'check') + sample_options, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    timing = ['--lease', str(args.lease), '--heartbeat', str(args.heartbeat), '--poll', str(args.heartbeat)]
+    markers = [uuid.uuid4().hex for _ in range(args.workers)]
+    workers = []
+    for i, marker in enumerate(markers):
+        with open(os.path.join(tmp_dir, 'worker_{0}.log'.format(i)), 'w') as log_f:
+            workers.append(subprocess.Popen(queue_command('work', queue_dir, *timing), stdout=log_f,
+                                            stderr=subprocess.STDOUT, env=dict(env, **{MARKER: marker})))
+    report = OrderedDict([('workers', args.workers), ('samples', args.samples), ('tmp_dir', tmp_dir)])
+    try:
+        stalled = wait_for(lambda: running_sample(queue_dir, workers), args.timeout)
+        if stalled is None:
+            report['error'] = 'no worker started a sample'
+            return report, False
+        index, worker_id, sample_id = stalled
+        workers[index].send_signal(signal.SIGSTOP)
+        stop_time = time.time()
+        # reclaimed once the lease expired and another worker is free
+        reclaimed = wait_for(lambda: len(attempts(queue_dir, sample_id)) > 1, args.timeout)
+        time.sleep(max(0.0, stop_time + args.lease + 2 * args.heartbeat - time.time()))
+        commands_at_resume = [pid for pid in marked_processes(markers[index]) if pid != workers[index].pid]
+        workers[index].send_signal(signal.SIGCONT)
+        report.update([('stalled_worker', worker_id), ('stalled_sample', sample_id),
+                       ('stall_s', round(time.time() - stop_time, 1)), ('reclaimed', bool(reclaimed)),
+                       ('commands_at_resume', len(commands_at_resume))])
+
+        deadline = time.time() + args.timeout
+        exit_codes = [worker.wait(max(1.0, deadline - time.time())) for worker in workers]
+    except subprocess.TimeoutExpired:
+        report['error'] = 'workers still running after {0} s'.format(args.timeout)
+        return report, False
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGCONT)
+                worker.kill()
+                worker.wait()
+
+    done = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(queue_dir, 'done')))
+    failed = sorted(name[:-len('.json')] for name in os.listdir(os.path.join(queue_dir, 'failed')))
+    marker_file = read_json(os.path.join(queue_dir, 'done', sample_id + '.json')) or {}
+    status = read_json(os.path.join(queue_dir, 'workers', worker_id + '.json')) or {}
+    survivors = sorted(pid for marker in markers for pid in marked_processes(marker))
+    checks = OrderedDict([
+        ('every sample done', done == ['S{0:02d}'.format(i + 1) for i in range(args.samples)] and not failed),
+        ('stalled sample recorded by the reclaiming worker', marker_file.get('worker') not in (None, worker_id)),
+        ('stalled sample attempted twice', attempts(queue_dir, sample_id) == [worker_id, marker_file.get('worker')]),
+        ('stalled worker stopped on the lost lease', exit_codes[index] == 1 and status.get('state') == 'lost'),
+        ('other workers finished', all(code == 0 for i, code in enumerate(exit_codes) if i != index)),
+        ('no command left running', not survivors),
+    ])
+    report.update([('exit_codes', exit_codes), ('done', len(done)), ('failed', failed), ('survivors', survivors),
+                   ('checks', checks)])
+    return report, all(checks.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-1', '--R1', dest='reads_1', required=True, help='Reads R1 of every sample')
+    parser.add_argument('-2', '--R2', dest='reads_2', required=True, help='Reads R2 of every sample')
+    parser.add_argument('--workers', type=int, default=3, help='Number of workers (Default=3)')
+    parser.add_argument('--samples', type=int, default=2, help='Number of samples of the queue (Default=2)')
+    parser.add_argument('--lease', type=float, default=6.0, help='Lease of the workers in seconds (Default=6)')
+    parser.add_argument('--heartbeat', type=float, default=1.0,
+                        help='Heartbeat and poll interval of the workers in seconds (Default=1)')
+    parser.add_argument('--bin-dir', dest='bin_dir', default='',
+                        help='Directory of the bwa, samtools and bam-readcount used, put first in the PATH')
+    parser.add_argument('--timeout', type=float, default=600.0,
+                        help='Seconds given to each step of the check (Default=600)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary queue and work directory')
+    args, sample_options = parser.parse_known_args()
+    if args.workers < 2:
+        parser.error('--workers must be at least 2, one of them stalls')
+
+    tmp_dir = tempfile.mkdtemp(prefix='queue_check_')
+    try:
+        report, ok = check(args, sample_options, tmp_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Offline synthetic data for the benchmarks: a reference and a mutation catalogue of a chosen size, and paired FASTQ
+files with a controlled depth, substitution error rate, minority resistant allele fraction and off-target background.
+
+The packaged database/sequences.fasta is always part of the reference, synthetic genes are added to reach the
+requested catalogue size.
+
+    python benchmarks/simulate_reads.py --out-dir sim --mutations 50 --depth 100 --minority 0.2 --background 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from mutanalysis import catalogue  # noqa: E402
+from mutanalysis.utils import sanitize_name  # noqa: E402
+
+COMPLEMENT = str.maketrans('ACGTN', 'TGCAN')
+MUTATIONS_PER_GENE = 10
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def codon_to_aa():
+    return {codon: aa for aa, codons in catalogue.codon_table().items() for codon in codons}
+
+
+def random_gene(rng, length, aa_codons):
+    # ATG, random sense codons, stop
+    sense = [codon for aa, codons in sorted(aa_codons.items()) if aa != '*' for codon in codons]
+    return 'ATG' + ''.join(rng.choice(sense) for _ in range(length // 3 - 2)) + 'TAA'
+
+
+def make_dataset(out_dir, nb_mutations=1, gene_length=900, seed=1):
+    """
+    Write sequences.fasta and mutations.tsv with nb_mutations proteic mutations: the packaged catalogue first, then
+    synthetic genes of MUTATIONS_PER_GENE mutations each. Return the two files and the sites as
+    (feature ID, 1-based codon start, resistant codon).
+    """
+    rng = random.Random(seed)
+    aa_codons = catalogue.codon_table()
+    codon_aa = codon_to_aa()
+
+    packaged = catalogue.load_catalogue()
+    sequences = OrderedDict((name, seq) for name, seq in catalogue.read_sequences(packaged['sequence_file']).items())
+    mutations = OrderedDict()
+    sites = []
+    for site in packaged['sites'][:nb_mutations]:
+        mutations.setdefault(site['feature_name'], []).append(site['mutation'])
+        sites.append((site['feature'], site['start'], rng.choice(site['resistant_codons'])))
+
+    gene = 0
+    while len(sites) < nb_mutations:
+        gene += 1
+        name = 'synth_gene_{0}'.format(gene)
+        sequence = random_gene(rng, gene_length, aa_codons)
+        sequences[name] = sequence
+        aa_positions = sorted(rng.sample(range(2, gene_length // 3),
+                                         min(MUTATIONS_PER_GENE, nb_mutations - len(sites))))
+        for aa_position in aa_positions:
+            start = aa_position * 3 - 2
+            ref_aa = codon_aa[sequence[start - 1:start + 2]]
+            alt_aa = rng.choice([aa for aa in sorted(aa_codons) if aa not in ('*', ref_aa)])
+            mutations.setdefault(name, []).append('{0}{1}{2}'.format(ref_aa, aa_position, alt_aa))
+            sites.append((sanitize_name(name), start, rng.choice(aa_codons[alt_aa])))
+
+    sequence_file = os.path.join(out_dir, 'sequences.fasta')
+    with open(sequence_file, 'w') as out_f:
+        for name, sequence in sequences.items():
+            out_f.write('>{0}\n{1}\n'.format(name, sequence))
+    mutation_file = os.path.join(out_dir, 'mutations.tsv')
+    with open(mutation_file, 'w') as out_f:
+        out_f.write('Sequence\tProteic\tNucleic\n')
+        for name, feature_mutations in mutations.items():
+            out_f.write('{0}\t[{1}]\t[]\n'.format(name, ','.join(feature_mutations)))
+    return sequence_file, mutation_file, sites
+
+
+def mutate(rng, sequence, error_rate):
+    if not error_rate:
+        return sequence
+    bases = list(sequence)
+    for i in range(len(bases)):
+        if rng.random() < error_rate:
+            bases[i] = rng.choice([base for base in 'ACGT' if base != bases[i]])
+    return ''.join(bases)
+
+
+def simulate_reads(sequence_file, sites, out_dir, depth=50, read_length=100, insert_size=300, error_rate=0.001,
+                   minority=0.1, background=1.0, seed=1):
+    """
+    Write <out_dir>/reads_R1.fastq and reads_R2.fastq: fragments drawn uniformly along each sequence up to depth,
+    a minority fraction of them carrying the resistant codon of every site they cover, and background times as many
+    random off-target pairs. Return the FASTQ files and the true alignments of the on-target pairs as
+    (contig, fragment start, fragment sequence, name, R1 on the reverse strand).
+    """
+    rng = random.Random(seed)
+    sequences = catalogue.read_sequences(sequence_file)
+    by_contig = OrderedDict()
+    for ctg, start, codon in sites:
+        by_contig.setdefault(ctg, []).append((start - 1, codon))
+
+    fastq_1 = os.path.join(out_dir, 'reads_R1.fastq')
+    fastq_2 = os.path.join(out_dir, 'reads_R2.fastq')
+    quality = 'I' * read_length
+    truth = []
+    nb_pairs = 0
+    with open(fastq_1, 'w') as out_1, open(fastq_2, 'w') as out_2:
+        def write_pair(fragment):
+            nonlocal nb_pairs
+            name = 'sim{0}'.format(nb_pairs)
+            reverse = rng.random() < 0.5
+            forward = fragment if not reverse else reverse_complement(fragment)
+            read_1 = mutate(rng, forward[:read_length], error_rate)
+            read_2 = mutate(rng, reverse_complement(forward)[:read_length], error_rate)
+            out_1.write('@{0}/1\n{1}\n+\n{2}\n'.format(name, read_1, quality))
+            out_2.write('@{0}/2\n{1}\n+\n{2}\n'.format(name, read_2, quality))
+            nb_pairs += 1
+            return name, reverse, read_1, read_2
+
+        nb_target = 0
+        for ctg, sequence in sequences.items():
+            size = min(insert_size, len(sequence))
+            for _ in range(max(1, depth * len(sequence) // (2 * read_length))):
+                start = rng.randint(0, len(sequence) - size)
+                fragment = list(sequence[start:start + size])
+                if rng.random() < minority:
+                    for codon_start, codon in by_contig.get(ctg, []):
+                        if start <= codon_start and codon_start + 3 <= start + size:
+                            fragment[codon_start - start:codon_start - start + 3] = codon
+                name, reverse, read_1, read_2 = write_pair(''.join(fragment))
+                truth.append((ctg, start, size, name, reverse, read_1, read_2))
+                nb_target += 1
+
+        for _ in range(int(nb_target * background)):
+            write_pair(''.join(rng.choice('ACGT') for _ in range(insert_size)))
+    return fastq_1, fastq_2, truth
+
+
+def write_truth_bam(sequence_file, truth, bam_file, read_length=100):
+    """
+    Write the true alignments of the on-target pairs as a sorted and indexed BAM (needs pysam), to benchmark the
+    counting stages where no aligner is installed.
+    """
+    import pysam
+
+    sequences = catalogue.read_sequences(sequence_file)
+    contig_ids = {ctg: i for i, ctg in enumerate(sequences)}
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': ctg, 'LN': len(sequence)} for ctg, sequence in sequences.items()]}
+    records = []
+    for ctg, start, size, name, reverse, read_1, read_2 in truth:
+        length = min(read_length, size)
+        # R1 on the forward strand starts the fragment, its mate ends it
+        mates = [(read_1, 0x40, start if not reverse else start + size - length, reverse),
+                 (read_2, 0x80, start + size - length if not reverse else start, not reverse)]
+        for i, (read, first_last, position, is_reverse) in enumerate(mates):
+            mate_position, mate_reverse = mates[1 - i][2], mates[1 - i][3]
+            segment = pysam.AlignedSegment()
+            segment.query_name = name
+            segment.query_sequence = reverse_complement(read) if is_reverse else read
+            segment.flag = 0x1 | 0x2 | first_last | (0x10 if is_reverse else 0) | (0x20 if mate_reverse else 0)
+            segment.reference_id = contig_ids[ctg]
+            segment.reference_start = position
+            segment.mapping_quality = 60
+            segment.cigartuples = [(0, len(read))]
+            segment.next_reference_id = segment.reference_id
+            segment.next_reference_start = mate_position
+            segment.template_length = size if position <= mate_position else -size
+            segment.query_qualities = pysam.qualitystring_to_array('I' * len(read))
+            records.append(segment)
+    records.sort(key=lambda segment: (segment.reference_id, segment.reference_start))
+    with pysam.AlignmentFile(bam_file, 'wb', header=header) as out_f:
+        for segment in records:
+            out_f.write(segment)
+    pysam.index(bam_file)
+    return bam_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out-dir', default='.', help="Output directory (Default=.)")
+    parser.add_argument('--mutations', type=int, default=1, help="Catalogue size (Default=1)")
+    parser.add_argument('--depth', type=int, default=50, help="Depth of the target sequences (Default=50)")
+    parser.add_argument('--error-rate', type=float, default=0.001, help="Substitution rate (Default=0.001)")
+    parser.add_argument('--minority', type=float, default=0.1,
+                        help="Fraction of the fragments carrying the resistant codons (Default=0.1)")
+    parser.add_argument('--background', type=float, default=1.0,
+                        help="Off-target pairs per on-target pair (Default=1.0)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed (Default=1)")
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    sequence_file, mutation_file, sites = make_dataset(args.out_dir, args.mutations, seed=args.seed)
+    fastq_1, fastq_2, truth = simulate_reads(sequence_file, sites, args.out_dir, args.depth,
+                                             error_rate=args.error_rate, minority=args.minority,
+                                             background=args.background, seed=args.seed)
+    print(json.dumps(OrderedDict([('sequences', sequence_file), ('mutations', mutation_file), ('reads_1', fastq_1),
+                                  ('reads_2', fastq_2), ('sites', len(sites)), ('target_pairs', len(truth))]),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Pre-aligned input: place the catalogued codons on the reference of an existing coordinate-sorted and indexed
+BAM/CRAM (feature map or liftover by exact sequence match) and bring the counts back to the feature strand.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import csv
+import os
+import shutil
+from collections import OrderedDict
+from subprocess import PIPE
+
+from mutanalysis import catalogue, pileup, runner
+from mutanalysis.codon import decode_codon, encode_codon
+from mutanalysis.metrics import command
+from mutanalysis.utils import sanitize_name
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+# index files accepted next to an alignment
+INDEX_SUFFIXES = {".bam": [".bai", ".csi"], ".cram": [".crai"]}
+
+
+def reverse_complement(sequence):
+    return sequence.upper().translate(COMPLEMENT)[::-1]
+
+
+def read_reference(reference_file):
+    """
+    Sequences of the alignment reference keyed by the contig names of the BAM header (first word, not sanitised).
+    """
+    sequences = OrderedDict()
+    name = None
+    with open(reference_file) as in_f:
+        for line in in_f:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                sequences[name] = []
+            elif name is not None:
+                sequences[name].append(line.upper())
+    return OrderedDict((name, "".join(seq)) for name, seq in sequences.items())
+
+
+def read_feature_map(map_file):
+    """
+    Read a tab separated feature map (feature, contig, start, end, strand with 1-based inclusive coordinates of the
+    feature on the alignment reference). Return feature ID -> (contig, start, end, strand).
+    """
+    features = OrderedDict()
+    with open(map_file) as in_f:
+        for row in csv.DictReader(in_f, delimiter="\t"):
+            strand = row.get("strand", "+").strip() or "+"
+            if strand not in ("+", "-"):
+                print("\nStrand of {0} in {1} must be + or -\n".format(row["feature"], map_file))
+                exit(1)
+            features[sanitize_name(row["feature"].strip())] = (row["contig"].strip(), int(row["start"]),
+                                                               int(row["end"]), strand)
+    return features
+
+
+def liftover(mut_catalogue, reference_file):
+    """
+    Find each catalogue feature in the alignment reference by exact match of its sequence, on either strand.
+    Return feature ID -> (contig, start, end, strand), the first match when there are several.
+    """
+    features_seq = catalogue.read_sequences(mut_catalogue["sequence_file"])
+    reference = read_reference(reference_file)
+    features = OrderedDict()
+    missing = []
+    for feature_id in mut_catalogue["features"]:
+        sequence = features_seq[feature_id]
+        matches = []
+        for strand, query in (("+", sequence), ("-", reverse_complement(sequence))):
+            for ctg, ref_seq in reference.items():
+                start = ref_seq.find(query)
+                while start >= 0:
+                    matches.append((ctg, start + 1, start + len(query), strand))
+                    start = ref_seq.find(query, start + 1)
+        if not matches:
+            missing.append(feature_id)
+            continue
+        if len(matches) > 1:
+            print("WARNING: {0} matches {1} loci of {2}, {3}:{4}-{5} ({6}) used".format(
+                feature_id, len(matches), reference_file, *matches[0]), flush=True)
+        features[feature_id] = matches[0]
+    if missing:
+        print("\nNo exact match of {0} in {1}, give their coordinates with --feature-map\n".format(
+            ", ".join(missing), reference_file))
+        exit(1)
+    return features
+
+
+def genome_sites(sites, features):
+    """
+    Place the codon of each site (key -> catalogue site) on the alignment reference. Return key -> (contig,
+    1-based first base on the forward strand, strand).
+    """
+    placed = OrderedDict()
+    errors = []
+    for key, site in sites.items():
+        if site["feature"] not in features:
+            errors.append("Feature {0} has no coordinates".format(site["feature"]))
+            continue
+        ctg, start, end, strand = features[site["feature"]]
+        if site["end"] > end - start + 1:
+            errors.append("Codon {0} of {1} is outside its mapped locus {2}:{3}-{4}".format(
+                site["mutation"], site["feature"], ctg, start, end))
+            continue
+        if strand == "+":
+            placed[key] = (ctg, start + site["start"] - 1, strand)
+        else:
+            placed[key] = (ctg, end - site["end"] + 1, strand)
+    if errors:
+        print("\nFeature coordinates not valid:\n\t{0}\n".format("\n\t".join(errors)))
+        exit(1)
+    return placed
+
+
+def orient_table(table, site, genome_start, strand):
+    """
+    Return the count table of a codon placed at genome_start (see genome_sites) in the coordinates of its feature:
+    on the reverse strand the rows are reversed and the bases and strands complemented.
+    """
+    columns = list(table.columns)
+    table = table.copy()
+    offset = table["position"].values - genome_start
+    if strand == "-":
+        renamed = {}
+        for base, complement in zip("ACGT", "TGCA"):
+            for column in columns:
+                if column.startswith(base + "_"):
+                    renamed[column] = complement + column[1:]
+        table = table.rename(columns=renamed)
+        for base in "ACGTN":
+            plus, minus = table[base + "_plus"].values, table[base + "_minus"].values
+            table[base + "_plus"], table[base + "_minus"] = minus, plus
+        table = table[columns]
+        table["reference"] = table["reference"].str.translate(COMPLEMENT)
+        offset = site["end"] - site["start"] - offset
+    table["ID"] = site["feature"]
+    table["position"] = site["start"] + offset
+    return table.sort_values("position", kind="mergesort").reset_index(drop=True)
+
+
+def orient_histogram(histogram, strand):
+    if strand == "+":
+        return histogram
+    oriented = [0] * 64
+    for code, depth in enumerate(histogram):
+        oriented[encode_codon(reverse_complement(decode_codon(code)))] += depth
+    return oriented
+
+
+def check_alignment(bam_file, reference_file):
+    """
+    Exit unless the alignment is an indexed, coordinate-sorted BAM or CRAM and the reference is readable.
+    """
+    extension = os.path.splitext(bam_file)[1].lower()
+    if extension not in INDEX_SUFFIXES:
+        print("\nAligned input {0} must be a .bam or .cram file\n".format(bam_file))
+        exit(1)
+    for path in (bam_file, reference_file):
+        if not os.path.exists(path):
+            print("\nFile {0} not found\n".format(path))
+            exit(1)
+    candidates = [bam_file + suffix for suffix in INDEX_SUFFIXES[extension]]
+    candidates += [os.path.splitext(bam_file)[0] + suffix for suffix in INDEX_SUFFIXES[extension]]
+    if not any(os.path.exists(path) for path in candidates):
+        print("\nAligned input {0} is not indexed: samtools index {0}\n".format(bam_file))
+        exit(1)
+    if "SO:coordinate" not in alignment_header(bam_file, reference_file):
+        print("\nAligned input {0} is not coordinate-sorted: samtools sort\n".format(bam_file))
+        exit(1)
+
+
+def alignment_header(bam_file, reference_file):
+    if pileup.pysam is not None:
+        with pileup.pysam.AlignmentFile(bam_file, "r", reference_filename=reference_file) as bam:
+            return str(bam.header)
+    with command(["samtools", "view", "-H", "-T", reference_file, bam_file], stdout=PIPE,
+                 universal_newlines=True) as process:
+        return process.stdout.read()
+
+
+def local_reference(reference_file, work_dir):
+    """
+    Link the alignment reference into the work directory and index it there, the directory of the reference may be
+    read-only. A .fai (and .gzi) already next to the reference is linked with it.
+    Keep CRAM decoding on the local reference: without REF_PATH htslib would download missing sequences by MD5.
+    """
+    if not os.path.exists(reference_file):
+        print("\nFile {0} not found\n".format(reference_file))
+        exit(1)
+    os.environ.setdefault("REF_PATH", os.path.join(work_dir, "ref_cache", "%s"))
+    reference_dir = os.path.join(work_dir, "bam_reference")
+    if not os.path.exists(reference_dir):
+        os.mkdir(reference_dir)
+    local_file = os.path.join(reference_dir, os.path.basename(reference_file))
+    for suffix in ("", ".fai", ".gzi"):
+        if os.path.lexists(local_file + suffix):
+            os.remove(local_file + suffix)
+        if os.path.exists(reference_file + suffix):
+            try:
+                os.symlink(reference_file + suffix, local_file + suffix)
+            except OSError:
+                shutil.copy(reference_file + suffix, local_file + suffix)
+    if not os.path.exists(local_file + ".fai"):
+        if pileup.pysam is not None:
+            pileup.pysam.faidx(local_file)
+        elif shutil.which("samtools"):
+            runner.run("samtools faidx {0}".format(local_file))
+    return local_file
@@ -13,206 +13,493 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
 details. You should have received a copy of the GNU General Public License along with CGST. If
 not, see <http://www.gnu.org/licenses/>.
 """
+import io
 import os
 import re
+import shutil
 from collections import OrderedDict
-from subprocess import Popen, PIPE, STDOUT
 import numpy as np
 import pandas as pd
 
+from mutanalysis import pileup, runner
+from mutanalysis.siteplan import SitePlan
+from mutanalysis.render import render_html
 
-def write_site_file(position, output_dir):
+
+BAM_COUNT_HEADER = ['base', 'count', 'avg_mapping_quality', 'avg_base_quality', 'avg_se_mapping_quality',
+                    'num_plus_strand', 'num_minus_strand', 'avg_pos_as_fraction', 'avg_num_mismatches_as_fraction',
+                    'avg_sum_mismatch_qualities', 'num_q2_containing_reads', 'avg_distance_to_q2_start_in_q2_reads',
+                    'avg_clipped_length', 'avg_distance_to_effective_3p_end']
+# fixed per-base columns of a bam-readcount line, after contig, position, reference and depth
+BAM_COUNT_BASES = ['=', 'A', 'C', 'G', 'T', 'N']
+COUNT_BASES = ['A', 'C', 'G', 'T', 'N']
+# count table column suffix, bam-readcount field and type
+COUNT_FIELDS = [('depth', 'count', np.int64), ('quality', 'avg_base_quality', float),
+                ('mapq', 'avg_mapping_quality', float), ('plus', 'num_plus_strand', np.int64),
+                ('minus', 'num_minus_strand', np.int64)]
+
+
+def parse_position(position):
+    """
+    Split a position "<contig>", "<contig>:<pos>" or "<contig>:<start>-<end>" into its non-empty parts.
+    """
     pattern = re.compile('([0-9a-zA-Z_-]+):*([0-9]*)-*([0-9]*)')
     match = pattern.match(position)
     if match:
-        txt = ''
-        site_file = os.path.join(output_dir, 'site_file.txt')
-        for item in match.groups():
-            if item != '':
-                txt = txt + '\t{0}'.format(item)
-        with open(site_file, 'w') as out_f:
-            out_f.write(txt[1:])
-        return site_file
-    else:
-        print('\nPositions not identified\n')
-        print('Position formats:\n'
-              '\t<contig or chromosome name>\n'
-              '\t<contig or chromosome name>:<position in chromome or contig>\n'
-              '\t<contig or chromosome name>:<start position in chromome or contig>:<end position in chromome or contig>')
-        exit(1)
+        return [item for item in match.groups() if item != '']
+    print('\nPositions not identified\n')
+    print('Position formats:\n'
+          '\t<contig or chromosome name>\n'
+          '\t<contig or chromosome name>:<position in chromome or contig>\n'
+          '\t<contig or chromosome name>:<start position in chromome or contig>:<end position in chromome or contig>')
+    exit(1)
 
 
-def bam_count(bam_file, fasta_ref, output_dir, q=0, b=0, feature_name='', site_file='', force=False):
+def raw_count_file(bam_file, output_dir, feature_name='', site_file=''):
     sample = os.path.basename(bam_file).split(".")[0]
-    if feature_name == '' and site_file == '':
-        out_file = os.path.join(output_dir, '{0}_raw.csv'.format(sample))
-        cmd = 'bam-readcount -w 0 -q {0} -b {1} -i -f {2} {3} > {4}'.format(q, b, fasta_ref, bam_file, out_file)
-    elif feature_name != '' and site_file == '':
-        out_file = os.path.join(output_dir, '{0}_{1}_raw.csv'.format(sample, feature_name))
-        cmd = 'bam-readcount -w 0 -q {0} -b {1} -i -f {2} {3} > {4}'.format(q, b, fasta_ref, bam_file, out_file)
-    else:
-        out_file = os.path.join(output_dir, '{0}_{1}_raw.csv'.format(sample, feature_name))
-        cmd = 'bam-readcount -w 0 -q {0} -b {1} -i -l {2} -f {3} {4} > {5}'.format(q, b, site_file, fasta_ref,
-                                                                                   bam_file, out_file)
-    if not os.path.exists(out_file) or force:
-        process = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT).stdout.read()
-        log_info = "Command line executed: {0}\n\n\n{1}".format(cmd, process.decode("utf-8"))
-        print(log_info)
-    else:
-        print('\nRead count file {0} already done.\n'.format(out_file))
+    if site_file:
+        return os.path.join(output_dir, '{0}_sites_raw.csv'.format(sample))
+    if feature_name:
+        return os.path.join(output_dir, '{0}_{1}_raw.csv'.format(sample, feature_name))
+    return os.path.join(output_dir, '{0}_raw.csv'.format(sample))
+
+
+def bam_count(bam_file, fasta_ref, output_dir, q=0, b=0, feature_name='', site_file='', jobs=1):
+    """
+    Run bam-readcount on the whole reference or on the regions of site_file. The regions are split in up to jobs
+    shards counted concurrently, their outputs are concatenated in the order of the site file.
+    """
+    out_file = raw_count_file(bam_file, output_dir, feature_name, site_file)
+    cmd = 'bam-readcount -w 0 -q {0} -b {1} -i {2}-f {3} {4} > {5}'
+    if site_file == '':
+        runner.run(cmd.format(q, b, '', fasta_ref, bam_file, out_file),
+                   os.path.join(output_dir, 'logBamReadcount.txt'))
+        return out_file
+
+    with open(site_file) as in_f:
+        sites = in_f.readlines()
+    nb_shards = max(1, min(jobs, len(sites)))
+    if nb_shards == 1:
+        # one counting pass for every region of the site file
+        runner.run(cmd.format(q, b, '-l {0} '.format(site_file), fasta_ref, bam_file, out_file),
+                   os.path.join(output_dir, 'logBamReadcount.txt'))
+        return out_file
+
+    shard_size = -(-len(sites) // nb_shards)
+    commands = []
+    shard_files = []
+    for i in range(0, len(sites), shard_size):
+        shard_site_file = '{0}.{1}'.format(site_file, len(shard_files))
+        with open(shard_site_file, 'w') as out_f:
+            out_f.writelines(sites[i:i + shard_size])
+        shard_file = '{0}.{1}'.format(out_file, len(shard_files))
+        commands.append((cmd.format(q, b, '-l {0} '.format(shard_site_file), fasta_ref, bam_file, shard_file),
+                         os.path.join(output_dir, 'logBamReadcount.{0}.txt'.format(len(shard_files)))))
+        shard_files.append((shard_site_file, shard_file))
+    runner.run_commands(commands, jobs)
+
+    with open(out_file, 'wb') as out_f:
+        for shard_site_file, shard_file in shard_files:
+            with open(shard_file, 'rb') as in_f:
+                shutil.copyfileobj(in_f, out_f, 1 << 20)
+            os.remove(shard_file)
+            os.remove(shard_site_file)
     return out_file
 
 
-def calculate_stats(data):
-    result = OrderedDict()
-    result['perc>=30'] = round(100 * len([x for x in data if x >= 30]) / float(len(data)), 2)
-    result['perc>=20'] = round(100 * len([x for x in data if x >= 20]) / float(len(data)), 2)
-    result['perc>=10'] = round(100 * len([x for x in data if x >= 10]) / float(len(data)), 2)
-    result['mean'] = round(sum(data) / float(len(data)), 2)
-    result['50_perc'] = round(np.percentile(np.array(data), 50), 2)
-    result['25_perc'] = round(np.percentile(np.array(data), 25), 2)
-    result['75_perc'] = round(np.percentile(np.array(data), 75), 2)
-    result['max'] = max(data)
-    result['min'] = min(data)
-    return result
+def calculate_stats(data, scale=1):
+    accumulator = StatsAccumulator(scale)
+    accumulator.add(data)
+    return accumulator.stats()
 
 
-def bam_count_stats(bam_count_file, feature_name, header, output_dir, bam_file):
+class StatsAccumulator:
+    """
+    Single-pass statistics of non-negative values (depths, or qualities with scale=100 for 2 decimals) kept as an
+    integer histogram: memory is bounded by the histogram size whatever the number of values, values above it are
+    kept in an exact overflow counter. Percentiles are exact and interpolated like numpy.percentile.
+    """
 
-    sample = os.path.basename(bam_file).split(".")[0]
+    def __init__(self, scale=1, size=1 << 16):
+        self.scale = scale
+        self.histogram = np.zeros(size, dtype=np.int64)
+        self.overflow = {}
+        self.n = 0
+        self.total = 0
 
-    if feature_name == '':
-        out_file = os.path.join(output_dir, '{0}_{1}_stats'.format(sample, 'whole_genome'))
-    else:
-        out_file = os.path.join(output_dir, '{0}_{1}_stats'.format(sample, feature_name))
-    with open(bam_count_file) as count_f:
-        ctgs = []
+    def add(self, values):
+        values = np.rint(np.asarray(values, dtype=float) * self.scale).astype(np.int64)
+        if not len(values):
+            return
+        size = len(self.histogram)
+        in_range = values < size
+        self.histogram += np.bincount(values[in_range], minlength=size)
+        for value, count in zip(*np.unique(values[~in_range], return_counts=True)):
+            self.overflow[int(value)] = self.overflow.get(int(value), 0) + int(count)
+        self.n += len(values)
+        self.total += int(values.sum())
+
+    def _sorted_bins(self):
+        bins = np.nonzero(self.histogram)[0]
+        values = np.concatenate([bins, np.array(sorted(self.overflow), dtype=np.int64)])
+        counts = np.concatenate([self.histogram[bins], np.array([self.overflow[v] for v in sorted(self.overflow)],
+                                                                dtype=np.int64)])
+        return values, np.cumsum(counts)
+
+    def _value(self, value):
+        return int(value) if self.scale == 1 else value / self.scale
+
+    def percentile(self, q, bins=None):
+        values, cumulative = bins or self._sorted_bins()
+        # linear interpolation between the closest ranks, as the default method of numpy.percentile
+        quantile = q / 100.0
+        rank = (self.n - 1) * quantile
+        low = int(np.floor(rank))
+        high = min(low + 1, self.n - 1)
+        gamma = rank - low
+        # values of the low-th and high-th smallest elements (0-based)
+        x_low, x_high = values[np.searchsorted(cumulative, [low, high], side='right')] / float(self.scale)
+        diff = x_high - x_low
+        if gamma >= 0.5:
+            return x_high - diff * (1 - gamma)
+        return x_low + diff * gamma
+
+    def count_above(self, threshold):
+        threshold = int(round(threshold * self.scale))
+        count = int(self.histogram[threshold:].sum()) if threshold < len(self.histogram) else 0
+        return count + sum(c for v, c in self.overflow.items() if v >= threshold)
+
+    def stats(self):
+        bins = self._sorted_bins()
+        result = OrderedDict()
+        result['perc>=30'] = round(100 * self.count_above(30) / float(self.n), 2)
+        result['perc>=20'] = round(100 * self.count_above(20) / float(self.n), 2)
+        result['perc>=10'] = round(100 * self.count_above(10) / float(self.n), 2)
+        result['mean'] = round(self.total / float(self.scale) / float(self.n), 2)
+        result['50_perc'] = round(self.percentile(50, bins), 2)
+        result['25_perc'] = round(self.percentile(25, bins), 2)
+        result['75_perc'] = round(self.percentile(75, bins), 2)
+        result['max'] = self._value(bins[0][-1])
+        result['min'] = self._value(bins[0][0])
+        return result
+
+
+class CountStats:
+    """
+    Per contig statistics of the reference depth and quality, updated table by table so that a whole genome count
+    can be streamed in chunks.
+    """
+
+    def __init__(self):
+        self.contigs = OrderedDict()
+
+    def update(self, table):
+        ref_depth, valid = reference_values(table, 'depth')
+        ref_qual = reference_values(table, 'quality')[0]
+        ids = table['ID'].values
+        for ctg in pd.unique(ids):
+            mask = ids == ctg
+            positions = table['position'].values[mask]
+            if ctg not in self.contigs:
+                self.contigs[ctg] = {'start': int(positions[0]), 'end': 1, 'size': 0,
+                                     'depth': StatsAccumulator(), 'quality': StatsAccumulator(scale=100)}
+            contig = self.contigs[ctg]
+            contig['end'] = max(contig['end'], int(positions.max()))
+            contig['size'] += int(mask.sum())
+            contig['depth'].add(ref_depth[mask & valid])
+            contig['quality'].add(ref_qual[mask & valid])
+
+    def write(self, out_file):
         result_stat = []
         result_data = []
-        start = end = base_nb = 0
-
-        for line in count_f:
-            line = line.strip().split('\t')
-            ctg = line[0]
-            if ctg not in ctgs:
-                if len(ctgs) > 0:
-                    d = OrderedDict([('ID', ctgs[-1]), ('start', start), ('end', end), ('size', base_nb)])
-                    result_data.append(d)
-                    s = []
-                    # for key, value in calculate_stats(ctg_depth).iteritems():
-                    #    s.append(('All_depth_{0}'.format(key), value))
-                    for key, value in calculate_stats(ctg_ref_depth).items():
-                        s.append(('Ref_depth_{0}'.format(key), value))
-                    for key, value in calculate_stats(ctg_ref_qual).items():
-                        s.append(('Ref_quali_{0}'.format(key), value))
-                    s = OrderedDict(s)
-                    result_stat.append(s)
-                ctg_ref_depth, ctg_ref_qual = [], []
-                # ctg_ref_depth = []
-                ctgs.append(ctg)
-                start = -1
-                end = 1
-                base_nb = 0
-
-            pos = int(line[1])
-            if start == -1:
-                start = pos
-            if pos >= end:
-                end = pos
-            base_nb += 1
-
-            ref = line[2]
-            # ctg_depth.append(int(line[3]))
-
-            for item in line[4:]:
-                data = dict(zip(header.split(':'), item.split(':')))
-                base = data['base']
-                if base == ref:
-                    ctg_ref_depth.append(int(data['count']))
-                    ctg_ref_qual.append(round(float(data['avg_base_quality']), 2))
-
-        d = OrderedDict([('ID', ctgs[-1]), ('start', start), ('end', end), ('size', base_nb)])
-        result_data.append(d)
-        s = []
-        # for key, value in calculate_stats(ctg_depth).iteritems():
-        #    s.append(('All_depth_{0}'.format(key), value))
-        for key, value in calculate_stats(ctg_ref_depth).items():
-            s.append(('Ref_depth_{0}'.format(key), value))
-        for key, value in calculate_stats(ctg_ref_qual).items():
-            s.append(('Ref_quali_{0}'.format(key), value))
-        s = OrderedDict(s)
-        result_stat.append(s)
+        for ctg, contig in self.contigs.items():
+            result_data.append(OrderedDict([('ID', ctg), ('start', contig['start']), ('end', contig['end']),
+                                            ('size', contig['size'])]))
+            s = []
+            for key, value in contig['depth'].stats().items():
+                s.append(('Ref_depth_{0}'.format(key), value))
+            for key, value in contig['quality'].stats().items():
+                s.append(('Ref_quali_{0}'.format(key), value))
+            result_stat.append(OrderedDict(s))
 
         df_data = pd.DataFrame.from_dict(result_data)
         df_stat = pd.DataFrame.from_dict(result_stat)
         weighted_mean = ((df_stat.multiply(df_data['size'], axis=0).sum()).div(df_data['size'].sum(), axis=0)).round(2)
-        df_stat = df_stat.append(weighted_mean, ignore_index=True)
+        df_stat = pd.concat([df_stat, weighted_mean.to_frame().T], ignore_index=True)
         df_stat = df_stat.round(2)
-        df_data = df_data.append([{'ID': 'Overall', 'size': df_data['size'].sum(), 'end': '-', 'start': '-'}],
-                                 ignore_index=True)
+        df_data = pd.concat([df_data, pd.DataFrame([{'ID': 'Overall', 'size': df_data['size'].sum(), 'end': '-',
+                                                     'start': '-'}])], ignore_index=True)
         df = pd.concat([df_data, df_stat], axis=1)
         df.sort_values('size', inplace=True)
         df.to_csv('{0}.csv'.format(out_file), sep='\t', header=True, index=True)
-        df.to_html('{0}.html'.format(out_file), index=True)
         return '{0}.csv'.format(out_file)
 
 
-def bam_count_extract(bam_count_file, feature_name, header, output_dir, bam_file):
+def empty_count_table():
+    columns = ['ID', 'position', 'reference', 'total_depth']
+    for base in COUNT_BASES:
+        columns.extend('{0}_{1}'.format(base, name) for name, field, dtype in COUNT_FIELDS)
+    return pd.DataFrame(columns=columns)
 
-    sample = os.path.basename(bam_file).split(".")[0]
-    if feature_name == '':
-        out_file = os.path.join(output_dir, sample + '_{0}_count'.format('whole_genome'))
-    else:
-        out_file = os.path.join(output_dir, sample + '_{0}_count'.format(feature_name))
 
-    with open(bam_count_file) as count_f:
-        result_data = []
-        for line in count_f:
-            line = line.strip().split('\t')
-            ctg = line[0]
-            pos = int(line[1])
-            ref = line[2]
-            depth = int(line[3])
-            data = [('ID', ctg), ('position', pos), ('reference', ref), ('total_depth', depth)]
-            for item in line[4:]:
-                d = dict(zip(header.split(':'), item.split(':')))
-                base = d['base']
-                if base != '=':
-                    data.append(('{0}_depth'.format(base), int(d['count'])))
-                    data.append(('{0}_quality'.format(base), round(float(d['avg_base_quality']), 2)))
-            data = OrderedDict(data)
-            result_data.append(data)
-
-        df = pd.DataFrame.from_dict(result_data)
-        # print(df)
-        df.to_csv('{0}.csv'.format(out_file), sep='\t', header=True, index=True)
-        df.to_html('{0}.html'.format(out_file), index=True)
-    return '{0}.csv'.format(out_file)
+def to_count_table(chunk):
+    """
+    Rename the raw columns of a parsed bam-readcount block into the count table columns.
+    """
+    table = OrderedDict([('ID', chunk[0]), ('position', chunk[1]), ('reference', chunk[2]), ('total_depth', chunk[3])])
+    for base in COUNT_BASES:
+        for name, field, dtype in COUNT_FIELDS:
+            values = chunk[raw_column(base, field)]
+            table['{0}_{1}'.format(base, name)] = values.round(2) if dtype is float else values
+    return pd.DataFrame(table)
+
+
+def raw_column(base, field):
+    # column of a field once the ':' separated per-base fields are split like the tab separated ones
+    return 4 + BAM_COUNT_BASES.index(base) * len(BAM_COUNT_HEADER) + BAM_COUNT_HEADER.index(field)
+
+
+# indel entries (+<bases>:... or -<bases>:...) following the fixed =/A/C/G/T/N entries, up to the end of the line
+INDEL_ENTRIES = re.compile(rb'\t[+-][^\n]*')
+# contig name holding ':' (e.g. an HLA allele of a --bam reference), up to its tab
+COLON_CONTIG = re.compile(rb'^[^\t\n]*:[^\t\n]*\t', re.MULTILINE)
+# quick test for such a name after the first line: the newline prefix is searched much faster than a line start
+COLON_CONTIG_LINE = re.compile(rb'\n[^\t\n:]*:')
+# stands for the ':' of the contig names while the per-base fields are split
+CONTIG_COLON = b'\x1f'
 
 
-def main(wk_dir, sequence_file, position, feature_name="", stats=True, data=True):
-    bam_file = os.path.join(wk_dir, 'sequence.bam')
-    site_file = ""
-    while feature_name == '' and position != '':
-        # feature_name = raw_input('Enter a feature name for the position and validate by enter:\n')
-        print("YOU NEED TO SELECT A FEATURE")
+def split_fields(block):
+    """
+    Prepare a block of bam-readcount lines for the C parser: the indel entries, whose number varies from line to
+    line, are dropped and the ':' of the per-base fields turned into tabs, those of the contig names kept.
+    """
+    if b'\t+' in block or b'\t-' in block:
+        block = INDEL_ENTRIES.sub(b'', block)
+    if b':' in block[:block.find(b'\t')] or COLON_CONTIG_LINE.search(block):
+        block = COLON_CONTIG.sub(lambda match: match.group(0).replace(b':', CONTIG_COLON), block)
+        return block.replace(b':', b'\t').replace(CONTIG_COLON, b':')
+    return block.replace(b':', b'\t')
+
+
+def iter_bam_count(bam_count_file, block_size=1 << 26):
+    """
+    Parse a bam-readcount output by blocks of lines into count tables (one row per position, one column per base
+    field). The ':' of the per-base fields are turned into tabs so that the whole line is split by the C parser.
+    Only the fixed =/A/C/G/T/N columns are read, indel columns are dropped (see split_fields).
+    """
+    nb_columns = 4 + len(BAM_COUNT_BASES) * len(BAM_COUNT_HEADER)
+    dtype = {0: str, 1: np.int64, 2: str, 3: np.int64}
+    for base in COUNT_BASES:
+        for name, field, field_type in COUNT_FIELDS:
+            dtype[raw_column(base, field)] = field_type
+    usecols = sorted(dtype)
+
+    with open(bam_count_file, 'rb') as count_f:
+        remainder = b''
+        while True:
+            block = count_f.read(block_size)
+            if block:
+                # keep the last incomplete line for the next block
+                block = remainder + block
+                end = block.rfind(b'\n') + 1
+                block, remainder = block[:end], block[end:]
+            else:
+                block, remainder = remainder, b''
+                if not block:
+                    break
+            if not block.strip():
+                continue
+            chunk = pd.read_csv(io.BytesIO(split_fields(block)), sep='\t', header=None, usecols=usecols,
+                                names=range(nb_columns), dtype=dtype, keep_default_na=False)
+            yield to_count_table(chunk)
+
+
+def read_bam_count(bam_count_file):
+    """
+    Parse a bam-readcount output once into a single count table.
+    """
+    tables = list(iter_bam_count(bam_count_file))
+    if not tables:
+        return empty_count_table()
+    return pd.concat(tables, ignore_index=True)
+
+
+def select_region(table, position):
+    """
+    Return the rows of a "<contig>:<start>-<end>" region (whole contig or single position also accepted).
+    """
+    items = parse_position(position)
+    mask = table['ID'] == items[0]
+    if len(items) > 1:
+        start = int(items[1])
+        end = int(items[2]) if len(items) > 2 else start
+        mask &= (table['position'] >= start) & (table['position'] <= end)
+    return table[mask].drop_duplicates('position').reset_index(drop=True)
+
+
+# "<contig>:<start>[-<end>]" of a site, the contig name may hold any character (e.g. NC_000913.3 of a genome)
+SITE_PATTERN = re.compile(r'^(.+):([0-9]+)(?:-([0-9]+))?$')
+
+
+def site_interval(position):
+    match = SITE_PATTERN.match(position)
+    if match:
+        start = int(match.group(2))
+        return match.group(1), start, int(match.group(3)) if match.group(3) else start
+    items = parse_position(position)
+    if len(items) < 2:
+        print('\nRegion {0} has no position\n'.format(position))
         exit(1)
-    if feature_name == '':
-        position = ''
-    if position != '':
-        site_file = write_site_file(position, wk_dir)
+    return items[0], int(items[1]), int(items[-1])
+
+
+def route_regions(table, plan):
+    """
+    Return the rows of each site of a plan, found by binary search in the sorted positions of its contig instead
+    of a scan of the whole table per site.
+    """
+    table = table.drop_duplicates(['ID', 'position']).sort_values(['ID', 'position'], kind='mergesort')
+    table = table.reset_index(drop=True)
+    positions = table['position'].values
+    contigs, firsts = np.unique(table['ID'].values.astype(str), return_index=True)
+    bounds = {ctg: (lo, hi) for ctg, lo, hi in zip(contigs, firsts, list(firsts[1:]) + [len(table)])}
+    routed = OrderedDict()
+    for key, (ctg, start, end) in plan.sites.items():
+        lo, hi = bounds.get(ctg, (0, 0))
+        i = lo + np.searchsorted(positions[lo:hi], start, 'left')
+        j = lo + np.searchsorted(positions[lo:hi], end, 'right')
+        routed[key] = table.iloc[i:j].reset_index(drop=True)
+    return routed
+
+
+def reference_values(table, name):
+    """
+    Return the value of the field of the reference base at each position and the mask of positions whose
+    reference is one of the counted bases.
+    """
+    conditions = [table['reference'].values == base for base in COUNT_BASES]
+    choices = [table['{0}_{1}'.format(base, name)].values for base in COUNT_BASES]
+    return np.select(conditions, choices, default=0), np.logical_or.reduce(conditions)
+
+
+class CountResult(OrderedDict):
+    """
+    Count tables of a sample keyed like the regions given to main, handed directly to the report. files lists the
+    optional CSV/HTML artefacts written.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.files = []
+
+
+def render_files(result, html=False):
+    # HTML pages are rendered once, from the complete CSV files
+    if html:
+        result.files.extend([render_html(out_file) for out_file in result.files])
+    return result
+
+
+def bam_count_stats(tables, out_file):
+    """
+    Write the depth/quality statistics of a count table or of an iterable of count tables (streamed chunks).
+    """
+    if isinstance(tables, pd.DataFrame):
+        tables = [tables]
+    count_stats = CountStats()
+    for table in tables:
+        count_stats.update(table)
+    return count_stats.write(out_file)
+
+
+def bam_count_extract(table, out_file, append=False):
+    """
+    Write the per-base depth and quality of a count table, append=True adds a streamed chunk to the output.
+    """
+    columns = ['ID', 'position', 'reference', 'total_depth']
+    for base in COUNT_BASES:
+        columns.extend(['{0}_depth'.format(base), '{0}_quality'.format(base)])
+    df = table[columns]
+    df.to_csv('{0}.csv'.format(out_file), sep='\t', header=not append, index=True, mode='a' if append else 'w')
+    return '{0}.csv'.format(out_file)
+
+
+def main(wk_dir, sequence_file, regions=None, stats=False, data=False, html=False, backend="bam-readcount",
+         cache=None, jobs=1, bam_file=None):
+    """
+    Count every region with a single pass (bam-readcount or the in-process pysam backend), overlapping and adjacent
+    regions merged (see siteplan), and route the rows back to each region. regions maps a key (e.g. (feature,
+    mutation)) to a (feature name, "<contig>:<start>-<end>") pair, without regions the whole genome is counted and
+    streamed to the artefacts. Return a CountResult with the count table of each key. The stats (stats) and count
+    (data) CSV files are only written on request, once every region is counted, and rendered as HTML (html) from
+    the written files. With a stage cache, bam-readcount is only run again when the alignment, the reference, the
+    counted sites or its version changed. The regions are counted by up to jobs concurrent bam-readcount shards.
+    bam_file is the alignment to count (Default: the
+    sequence.bam mapped in wk_dir), a pre-aligned BAM or CRAM on sequence_file.
+    """
+    bam_file = bam_file or os.path.join(wk_dir, 'sequence.bam')
+    sample = os.path.basename(bam_file).split(".")[0]
+    regions = regions or OrderedDict()
+    # overlapping and adjacent sites are counted once, as a shared region
+    plan = SitePlan(OrderedDict((key, site_interval(position)) for key, (feature_name, position) in regions.items()))
+    if plan:
+        print('{0} sites counted in {1} regions'.format(len(plan), plan.nb_regions()), flush=True)
+
+    if backend == "pysam":
+        tables = [pileup.count_regions(bam_file, sequence_file, plan.region_list())]
+    else:
+        site_file = plan.write_site_file(os.path.join(wk_dir, 'site_file.txt')) if plan else ""
+        raw_file = raw_count_file(bam_file, wk_dir, site_file=site_file)
+        key = cache.key("count", [bam_file, sequence_file] + ([site_file] if site_file else []), {"q": 0, "b": 0},
+                        ["bam-readcount"]) if cache else None
+        if not cache or not cache.fresh("count", key):
+            bam_count(bam_file, sequence_file, wk_dir, 0, 0, '', site_file, jobs)
+            if cache:
+                cache.record("count", key, [raw_file])
+        tables = iter_bam_count(raw_file)
+
+    result = CountResult()
+
+    if not regions:
+        # whole genome: stream the chunks through the statistics and the extract
+        out_prefix = os.path.join(wk_dir, '{0}_{1}'.format(sample, 'whole_genome'))
+        count_stats = CountStats()
+        nb_positions = 0
+        for table in tables:
+            table.index += nb_positions
+            if stats:
+                count_stats.update(table)
+            if data:
+                bam_count_extract(table, out_prefix + '_count', append=nb_positions > 0)
+            nb_positions += len(table)
+        if nb_positions:
+            if stats:
+                result.files.append(count_stats.write(out_prefix + '_stats'))
+            if data:
+                result.files.append(out_prefix + '_count.csv')
+        return render_files(result, html)
 
-    bam_count_file = bam_count(bam_file, sequence_file, wk_dir, 0, 0, feature_name, site_file, force=False)
+    tables = [table for table in tables if not table.empty]
+    if not tables:
+        return result
+    table = pd.concat(tables, ignore_index=True)
 
-    header = 'base:count:avg_mapping_quality:avg_base_quality:avg_se_mapping_quality:num_plus_strand:num_minus_strand:' \
-             'avg_pos_as_fraction:avg_num_mismatches_as_fraction:avg_sum_mismatch_qualities:num_q2_containing_reads:' \
-             'avg_distance_to_q2_start_in_q2_reads:avg_clipped_length:avg_distance_to_effective_3p_end'
+    routed = route_regions(table, plan)
+    region_names = OrderedDict()
+    for key, (feature_name, position) in regions.items():
+        region_table = routed[key]
+        if region_table.empty:
+            print('\nNo read count for {0} at {1}\n'.format(feature_name, position))
+            continue
+        result[key] = region_table
+        region_names[key] = '{0}_{1}-{2}'.format(feature_name, *plan.sites[key][1:])
 
-    if os.stat(bam_count_file).st_size:
-        out_file_list = [bam_count_file]
+    # optional artefacts, once per region even when several mutations share it
+    for region_name, key in OrderedDict((v, k) for k, v in region_names.items()).items():
+        out_prefix = os.path.join(wk_dir, '{0}_{1}'.format(sample, region_name))
         if stats:
-            stat_file = bam_count_stats(bam_count_file, feature_name, header, wk_dir, bam_file)
-            out_file_list.append(stat_file)
+            result.files.append(bam_count_stats(result[key], out_prefix + '_stats'))
         if data:
-            data_file = bam_count_extract(bam_count_file, feature_name, header, wk_dir, bam_file)
-            out_file_list.append(data_file)
+            result.files.append(bam_count_extract(result[key], out_prefix + '_count'))
+    return render_files(result, html)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Run mutanalysis on every sample of a sample sheet with a process pool.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import csv
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from mutanalysis import index_cache, metrics, mutAnalysis, resources, results
+from mutanalysis.utils import rename_reference
+
+
+def read_sample_sheet(sample_sheet):
+    """
+    Read a TSV of sample id, R1 and R2. Relative paths are resolved from the sheet directory, lines starting with
+    '#' and a header line starting with 'sample' are ignored.
+    """
+    sheet_dir = os.path.dirname(os.path.abspath(sample_sheet))
+    samples = []
+    with open(sample_sheet, "r") as sheet_f:
+        for row in csv.reader(sheet_f, delimiter="\t"):
+            if not row or row[0].startswith("#") or row[0].lower() in ("sample", "sample_id", "id"):
+                continue
+            if len(row) < 3:
+                print("\nSample sheet line without R1/R2: {0}\n".format("\t".join(row)))
+                exit(1)
+            sample_id, reads_1, reads_2 = [item.strip() for item in row[:3]]
+            samples.append((sample_id, os.path.join(sheet_dir, reads_1), os.path.join(sheet_dir, reads_2)))
+
+    sample_ids = [sample[0] for sample in samples]
+    duplicates = sorted(set(x for x in sample_ids if sample_ids.count(x) > 1))
+    if duplicates:
+        print("\nDuplicated sample ids in sample sheet: {0}\n".format(", ".join(duplicates)))
+        exit(1)
+    return samples
+
+
+def plan_cores(cores, nb_samples, jobs=0, min_threads=8):
+    """
+    Split the core budget between concurrent samples and aligner threads per sample.
+    """
+    cores = max(1, cores)
+    if not jobs:
+        jobs = max(1, cores // min_threads)
+    jobs = max(1, min(jobs, nb_samples, cores))
+    threads = max(1, cores // jobs)
+    return jobs, threads
+
+
+def run_sample(sample_id, sample_argv, sample_dir, retries, reference=None):
+    """
+    Run one sample in a pool process with its output redirected to the sample log. Failures (including the
+    exit() calls of the pipeline) are retried and then reported instead of being raised. reference is the prepared
+    reference of a long-running process (see mutAnalysis.prepare_reference). A run stopped by metrics.stop_run is
+    not retried and ends "stopped".
+    """
+    if not os.path.exists(sample_dir):
+        os.makedirs(sample_dir)
+    log_file = os.path.join(sample_dir, "mutanalysis.log")
+    args = mutAnalysis.build_parser().parse_args(sample_argv)
+
+    start = time.time()
+    attempt = 0
+    error = ""
+    while attempt <= retries:
+        attempt += 1
+        sys.stdout.flush()
+        stdout_fd = os.dup(1)
+        with open(log_file, "a") as log_f:
+            os.dup2(log_f.fileno(), 1)
+            try:
+                print("\n##### {0} attempt {1} #####\n".format(sample_id, attempt), flush=True)
+                mutAnalysis.main(args, reference)
+                error = ""
+            except (Exception, SystemExit) as e:
+                error = "{0}: {1}".format(type(e).__name__, e)
+                traceback.print_exc(file=sys.stdout)
+                metrics.finish_run("stopped" if metrics.STOP.is_set() else "failed")
+            finally:
+                sys.stdout.flush()
+                os.dup2(stdout_fd, 1)
+                os.close(stdout_fd)
+        if not error:
+            return sample_id, "done", attempt, round(time.time() - start, 2), ""
+        if metrics.STOP.is_set():
+            return sample_id, "stopped", attempt, round(time.time() - start, 2), error
+    return sample_id, "failed", attempt, round(time.time() - start, 2), error
+
+
+def write_summary(summary_file, results):
+    with open(summary_file, "w") as out_f:
+        writer = csv.writer(out_f, delimiter="\t")
+        writer.writerow(["Sample", "Status", "Attempts", "Time (s)", "Error"])
+        for result in results:
+            writer.writerow(result)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis batch',
+        description='mutanalysis batch: run every sample of a sample sheet concurrently. Options not listed here '
+                    'are passed to each sample run (e.g. --mapping-mode, --unmapped, --index-cache).',
+    )
+    parser.add_argument('-s', '--sample-sheet', dest="sample_sheet", required=True,
+                        help="TSV file of sample id, reads R1 and reads R2")
+    parser.add_argument('-wd', '--wkDir', dest="workDir", required=True,
+                        help="Working directory, each sample is written to <wkDir>/<sample id>")
+    parser.add_argument('-i', '--initial', dest="initial", required=True, help="Initial of user")
+    parser.add_argument('--cores', dest="cores", type=int, default=0,
+                        help="Total number of cores shared by all samples (Default=CPU quota of the cgroup, or all "
+                             "cores)")
+    parser.add_argument('--memory', dest="memory", default='',
+                        help="Total memory shared by all samples, e.g. 64G (Default=memory limit of the cgroup, or "
+                             "memory of the host)")
+    parser.add_argument('-j', '--jobs', dest="jobs", type=int, default=0,
+                        help="Number of samples processed concurrently (Default=cores/8)")
+    parser.add_argument('--retries', dest="retries", type=int, default=1,
+                        help="Number of retries of a failed sample before it is skipped (Default=1)")
+    args, sample_options = parser.parse_known_args(argv)
+
+    wk_dir = os.path.abspath(args.workDir)
+    if not os.path.exists(wk_dir):
+        os.makedirs(wk_dir)
+
+    samples = read_sample_sheet(args.sample_sheet)
+    if not samples:
+        print("\nNo sample found in {0}\n".format(args.sample_sheet))
+        exit(1)
+    cores = args.cores or resources.available_cpus()
+    memory = resources.parse_size(args.memory) if args.memory else resources.available_memory()
+    jobs, threads = plan_cores(cores, len(samples), args.jobs)
+
+    print("Sample sheet: {0}".format(os.path.abspath(args.sample_sheet)), flush=True)
+    print("Samples: {0}".format(len(samples)), flush=True)
+    print("Work directory: {0}".format(wk_dir), flush=True)
+    print("Cores: {0} ({1} concurrent samples x {2} threads)".format(cores, jobs, threads), flush=True)
+    if memory:
+        print("Memory: {0} ({1} per sample)".format(resources.format_size(memory),
+                                                   resources.format_size(memory // jobs)), flush=True)
+
+    # build the shared index once before the workers start
+    options = mutAnalysis.build_parser().parse_args(sample_options)
+    if not options.no_index_cache:
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        sequence_file = rename_reference(os.path.join(dir_path, "database", "sequences.fasta"),
+                                         os.path.join(wk_dir, "sequence.fasta"))
+        index_cache.cached_index(sequence_file, options.index_cache)
+
+    sample_results = []
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for sample_id, reads_1, reads_2 in samples:
+            sample_dir = os.path.join(wk_dir, sample_id)
+            # each sample gets its share of the cores and of the memory
+            sample_argv = sample_options + ["-1", reads_1, "-2", reads_2, "-wd", sample_dir,
+                                            "-i", args.initial, "--cpus", str(threads), "-t", str(threads)]
+            if memory:
+                sample_argv += ["--memory", str(memory // jobs)]
+            futures.append(executor.submit(run_sample, sample_id, sample_argv, sample_dir, args.retries))
+        for future in as_completed(futures):
+            result = future.result()
+            sample_results.append(result)
+            print("{0}: {1} after {2} attempt(s) in {3} s {4}".format(*result), flush=True)
+
+    sample_results.sort(key=lambda x: x[0])
+    write_summary(os.path.join(wk_dir, "batch_summary.tsv"), sample_results)
+
+    # cohort table of the samples done
+    done = [os.path.join(wk_dir, result[0]) for result in sample_results if result[1] == "done"]
+    for out_file in results.merge_results(done, os.path.join(wk_dir, "cohort_result"), options.result_format,
+                                          options.html):
+        print("Cohort table: {0}".format(out_file), flush=True)
+
+    failed = [result[0] for result in sample_results if result[1] != "done"]
+    print("\nBatch finished: {0} done, {1} failed".format(len(sample_results) - len(failed), len(failed)),
+          flush=True)
+    if failed:
+        print("Failed samples: {0}".format(", ".join(failed)), flush=True)
+        exit(1)
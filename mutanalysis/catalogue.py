@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Compile the mutation database and its sequences into a validated catalogue cached next to the package.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+from mutanalysis.utils import read_mutation_database, sanitize_name
+
+CATALOGUE_VERSION = 1
+CATALOGUE_FILE = "catalogue.json"
+
+MUTATION_PATTERN = re.compile('([a-zA-Z_-]+)*([0-9]*)([a-zA-Z_-]+)')
+
+# genetic code table 11 (bacterial, archaeal and plant plastid), codons in TCAG order
+GENETIC_CODE_11 = OrderedDict(("".join(nucs), amino_acid) for nucs, amino_acid in zip(
+    itertools.product("TCAG", repeat=3), "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"))
+
+
+def database_dir():
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), "database")
+
+
+def user_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "mutanalysis")
+
+
+def source_hash(mutation_file, sequence_file):
+    sha = hashlib.sha256("catalogue-v{0}".format(CATALOGUE_VERSION).encode())
+    for path in (mutation_file, sequence_file):
+        with open(path, "rb") as in_f:
+            sha.update(in_f.read())
+    return sha.hexdigest()
+
+
+def read_sequences(sequence_file):
+    sequences = OrderedDict()
+    name = None
+    with open(sequence_file, "r") as in_f:
+        for line in in_f:
+            line = line.strip()
+            if line.startswith(">"):
+                name = sanitize_name(line[1:].split()[0])
+                sequences[name] = []
+            elif name is not None:
+                sequences[name].append(line.upper())
+    return OrderedDict((name, "".join(seq)) for name, seq in sequences.items())
+
+
+def translate_codon(codon):
+    """
+    Amino acid coded by a codon in the genetic code table 11 ("*" for a stop codon, "X" for an ambiguous codon).
+    """
+    return GENETIC_CODE_11.get(codon.upper(), "X")
+
+
+def codon_table():
+    # genetic code table 11 (bacterial): amino acid -> codons
+    table = {}
+    for codon in ("".join(nucs) for nucs in itertools.product("ACGT", repeat=3)):
+        table.setdefault(translate_codon(codon), []).append(codon)
+    return table
+
+
+def compile_catalogue(mutation_file, sequence_file):
+    """
+    Parse and validate the mutation database against its sequences. Each proteic mutation becomes a site with the
+    sanitised feature ID, the nucleotide coordinates of its codon, the reference codon and the codons (table 11)
+    of the susceptible and resistant amino acids.
+    """
+    mut_dict = read_mutation_database(mutation_file)
+    sequences = read_sequences(sequence_file)
+    aa_codons = codon_table()
+
+    features = OrderedDict()
+    sites = []
+    errors = []
+    for feature_name, mutation_dict in mut_dict.items():
+        feature_id = sanitize_name(feature_name)
+        if feature_id not in sequences:
+            errors.append("Feature {0} ({1}) not found in {2}".format(feature_name, feature_id, sequence_file))
+            continue
+        sequence = sequences[feature_id]
+        features[feature_id] = {"name": feature_name, "length": len(sequence),
+                                "nucleic": [mut.strip() for mut in mutation_dict["nucleic"] if mut.strip()]}
+
+        for mut_prot in mutation_dict["proteic"]:
+            mut_prot = mut_prot.strip()
+            if not mut_prot:
+                continue
+            match = MUTATION_PATTERN.match(mut_prot)
+            if not match or not match.groups()[1]:
+                errors.append("Mutation {0} of {1} not identified".format(mut_prot, feature_name))
+                continue
+            acide_s, pos_mutation, acide_r = match.groups()
+            pos_mutation = int(pos_mutation)
+            start, end = (pos_mutation * 3) - 2, pos_mutation * 3
+            if end > len(sequence):
+                errors.append("Mutation {0} of {1} is outside the sequence ({2} bp)".format(mut_prot, feature_name,
+                                                                                        len(sequence)))
+                continue
+            ref_codon = sequence[start - 1:end]
+            if acide_s and translate_codon(ref_codon) != acide_s:
+                print("WARNING: reference codon {0} of {1} {2} does not code {3}".format(ref_codon, feature_name,
+                                                                                        mut_prot, acide_s))
+            sites.append(OrderedDict([
+                ("feature", feature_id), ("feature_name", feature_name), ("mutation", mut_prot),
+                ("aa_position", pos_mutation), ("start", start), ("end", end),
+                ("position", "{0}:{1}-{2}".format(feature_id, start, end)), ("ref_codon", ref_codon),
+                ("ref_aa", acide_s or ""), ("alt_aa", acide_r),
+                ("susceptible_codons", aa_codons.get(acide_s, [])), ("resistant_codons", aa_codons.get(acide_r, [])),
+            ]))
+
+    if errors:
+        print("\nMutation database not valid:\n\t{0}\n".format("\n\t".join(errors)))
+        exit(1)
+
+    return OrderedDict([("version", CATALOGUE_VERSION), ("hash", source_hash(mutation_file, sequence_file)),
+                        ("mutation_file", os.path.abspath(mutation_file)),
+                        ("sequence_file", os.path.abspath(sequence_file)),
+                        ("features", features), ("sites", sites)])
+
+
+def write_catalogue(catalogue, out_file):
+    # write then rename so that a concurrent reader never sees a partial file
+    out_dir = os.path.dirname(out_file)
+    fd, tmp_file = tempfile.mkstemp(prefix=".catalogue_", dir=out_dir)
+    # mkstemp creates the file for its owner only, the cache of a shared install is read by every user
+    os.fchmod(fd, 0o644)
+    with os.fdopen(fd, "w") as out_f:
+        json.dump(catalogue, out_f, indent=1)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def cached_catalogue_files(key):
+    # next to the package first, then the user cache when the package directory is read-only
+    return [os.path.join(database_dir(), CATALOGUE_FILE),
+            os.path.join(user_cache_dir(), "catalogue_{0}.json".format(key[:16]))]
+
+
+def load_catalogue(mutation_file=None, sequence_file=None, force=False):
+    """
+    Return the compiled catalogue, reusing the cached artefact when its hash matches the sources. An unreadable or
+    stale cache is compiled again, in the user cache when the package directory is read-only.
+    """
+    mutation_file = mutation_file or os.path.join(database_dir(), "mutations.tsv")
+    sequence_file = sequence_file or os.path.join(database_dir(), "sequences.fasta")
+    key = source_hash(mutation_file, sequence_file)
+
+    cache_files = cached_catalogue_files(key)
+    if not force:
+        for cache_file in cache_files:
+            try:
+                with open(cache_file, "r") as in_f:
+                    catalogue = json.load(in_f, object_pairs_hook=OrderedDict)
+            except (OSError, ValueError):
+                # missing, written by another user without read access, or truncated
+                continue
+            if catalogue.get("hash") == key:
+                return catalogue
+
+    catalogue = compile_catalogue(mutation_file, sequence_file)
+    for cache_file in cache_files:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            write_catalogue(catalogue, cache_file)
+            break
+        except OSError:
+            continue
+    return catalogue
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis catalogue',
+        description='mutanalysis catalogue: compile and cache the mutation catalogue',
+    )
+    parser.add_argument('-m', '--mutations', dest="mutations", default=os.path.join(database_dir(), "mutations.tsv"),
+                        help="Mutation database (Default=packaged database)")
+    parser.add_argument('-s', '--sequences', dest="sequences",
+                        default=os.path.join(database_dir(), "sequences.fasta"),
+                        help="Sequences of the features (Default=packaged database)")
+    parser.add_argument('-o', '--out', dest="out", default="",
+                        help="Also write the compiled catalogue to this file")
+    parser.add_argument('-f', '--force', dest="force", action="store_true", help="Recompile the cached catalogue")
+    args = parser.parse_args(argv)
+
+    catalogue = load_catalogue(args.mutations, args.sequences, args.force)
+    if args.out:
+        write_catalogue(catalogue, os.path.abspath(args.out))
+    print("Catalogue {0}: {1} features, {2} sites".format(catalogue["hash"][:16], len(catalogue["features"]),
+                                                         len(catalogue["sites"])), flush=True)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Read-phased codon counting: tally the codon actually carried by each read overlapping a catalogued codon.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import tempfile
+from collections import OrderedDict
+from subprocess import PIPE
+
+from mutanalysis.metrics import command
+from mutanalysis.siteplan import SitePlan
+
+NUCLEOTIDES = 'ACGT'
+NUC_CODE = {nuc: i for i, nuc in enumerate(NUCLEOTIDES)}
+
+# reads skipped like the samtools pileup used by bam-readcount: unmapped, secondary, QC fail, duplicate
+SKIP_FLAGS = 0x704
+
+CIGAR_OPS = {op: i for i, op in enumerate('MIDNSHP=X')}
+# CIGAR operations consuming the query / the reference
+QUERY_OPS = {0, 1, 4, 7, 8}
+REF_OPS = {0, 2, 3, 7, 8}
+
+
+def encode_codon(codon):
+    """
+    Encode a 3-base codon as an integer in 0-63, -1 when it holds anything other than A, C, G or T.
+    """
+    code = 0
+    for nuc in codon.upper():
+        if nuc not in NUC_CODE:
+            return -1
+        code = code * 4 + NUC_CODE[nuc]
+    return code
+
+
+def decode_codon(code):
+    return NUCLEOTIDES[code >> 4] + NUCLEOTIDES[(code >> 2) & 3] + NUCLEOTIDES[code & 3]
+
+
+def parse_cigar(cigar):
+    cigartuples = []
+    length = ''
+    for char in cigar:
+        if char.isdigit():
+            length += char
+        else:
+            cigartuples.append((CIGAR_OPS[char], int(length)))
+            length = ''
+    return cigartuples
+
+
+def read_codon(ref_start, cigartuples, sequence, codon_start):
+    """
+    Return the encoded codon a read carries at the 0-based reference positions codon_start..codon_start+2, -1 when
+    the read does not cover all three bases (deletion, skip, end of read) or carries an ambiguous base.
+    """
+    codon_end = codon_start + 3
+    ref_pos = ref_start
+    query_pos = 0
+    code = 0
+    found = 0
+    for op, length in cigartuples:
+        if ref_pos >= codon_end:
+            break
+        if op in REF_OPS:
+            overlap_start = max(ref_pos, codon_start)
+            overlap_end = min(ref_pos + length, codon_end)
+            if overlap_start < overlap_end:
+                if op not in QUERY_OPS:
+                    # deletion or skip inside the codon
+                    return -1
+                for pos in range(overlap_start, overlap_end):
+                    nuc = NUC_CODE.get(sequence[query_pos + pos - ref_pos])
+                    if nuc is None:
+                        return -1
+                    code = code * 4 + nuc
+                    found += 1
+            ref_pos += length
+            if op in QUERY_OPS:
+                query_pos += length
+        elif op in QUERY_OPS:
+            if codon_start < ref_pos < codon_end and found:
+                # insertion inside the codon
+                return -1
+            query_pos += length
+    return code if found == 3 else -1
+
+
+def reference_length(cigartuples):
+    return sum(length for op, length in cigartuples if op in REF_OPS)
+
+
+def codon_plan(codons):
+    # each distinct codon is counted once, whatever the number of mutations sharing it
+    return SitePlan.from_codons(OrderedDict((codon, codon) for codon in codons.values()))
+
+
+def count_codons_pysam(bam_file, codons, reference=None):
+    from mutanalysis import pileup
+    pileup.check_pysam()
+    plan = codon_plan(codons)
+    histograms = {codon: [0] * 64 for codon in plan.sites}
+    with pileup.pysam.AlignmentFile(bam_file, "r", reference_filename=reference) as bam:
+        for ctg, window in pileup.windows(plan.region_list()):
+            start, end = window[0][0], window[-1][1]
+            for read in bam.fetch(ctg, start - 1, end):
+                if read.flag & SKIP_FLAGS or read.query_sequence is None:
+                    continue
+                # a read overlapping several windows is fetched once per window, only its codons of the window count
+                covered = plan.within(ctg, max(start, read.reference_start + 1), min(end, read.reference_end))
+                if not covered:
+                    continue
+                sequence = read.query_sequence.upper()
+                for codon in covered:
+                    code = read_codon(read.reference_start, read.cigartuples, sequence, codon[1] - 1)
+                    if code >= 0:
+                        histograms[codon][code] += 1
+    return OrderedDict((key, list(histograms[codon])) for key, codon in codons.items())
+
+
+def count_codons_samtools(bam_file, codons, reference=None, random_access=False):
+    from mutanalysis import pileup
+    plan = codon_plan(codons)
+    if not plan:
+        return OrderedDict()
+    histograms = {codon: [0] * 64 for codon in plan.sites}
+    reference_opt = ["-T", reference] if reference else []
+
+    def add_reads(lines, window=None):
+        for line in lines:
+            fields = line.split('\t', 10)
+            if fields[5] == '*' or fields[9] == '*':
+                continue
+            ref_start = int(fields[3]) - 1
+            cigartuples = parse_cigar(fields[5])
+            ref_end = ref_start + reference_length(cigartuples)
+            if window:
+                # a read overlapping several windows is written once per window, only its codons of the window count
+                covered = plan.within(fields[2], max(window[1], ref_start + 1), min(window[2], ref_end))
+            else:
+                covered = plan.within(fields[2], ref_start + 1, ref_end)
+            if not covered:
+                continue
+            sequence = fields[9].upper()
+            for codon in covered:
+                code = read_codon(ref_start, cigartuples, sequence, codon[1] - 1)
+                if code >= 0:
+                    histograms[codon][code] += 1
+
+    if random_access:
+        # region queries on the index of a large alignment, one per window of nearby codons
+        for ctg, window in pileup.windows(plan.region_list()):
+            start, end = window[0][0], window[-1][1]
+            cmd = ["samtools", "view", "-F", str(SKIP_FLAGS)] + reference_opt + [
+                bam_file, "{0}:{1}-{2}".format(ctg, start, end)]
+            with command(cmd, stdout=PIPE, universal_newlines=True) as process:
+                add_reads(process.stdout, (ctg, start, end))
+        return OrderedDict((key, list(histograms[codon])) for key, codon in codons.items())
+
+    # a single pass over the reads of the merged regions, each read is written once
+    fd, bed_file = tempfile.mkstemp(prefix="codons_", suffix=".bed", dir=os.path.dirname(os.path.abspath(bam_file)))
+    os.close(fd)
+    try:
+        plan.write_bed(bed_file)
+        cmd = ["samtools", "view", "-F", str(SKIP_FLAGS)] + reference_opt + ["-L", bed_file, bam_file]
+        with command(cmd, stdout=PIPE, universal_newlines=True) as process:
+            add_reads(process.stdout)
+    finally:
+        os.remove(bed_file)
+    return OrderedDict((key, list(histograms[codon])) for key, codon in codons.items())
+
+
+def count_codons(bam_file, codons, backend="samtools", reference=None, random_access=False):
+    """
+    Walk the reads of the merged codon regions once and return, for each key, a 64-bin histogram of the codons
+    the reads carry. codons maps a key to (contig, 1-based position of the first codon base). reference decodes
+    CRAM input, random_access queries the index window by window instead of streaming the whole alignment
+    (samtools backend, the pysam backend always does).
+    """
+    if backend == "pysam":
+        return count_codons_pysam(bam_file, codons, reference)
+    return count_codons_samtools(bam_file, codons, reference, random_access)
@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Long-running worker daemon: the catalogue and the reference index are loaded once and samples are submitted over
+a local socket or dropped in a spool directory.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from mutanalysis import batch, index_cache, mutAnalysis
+from mutanalysis.metrics import run_command
+
+SOCKET_FILE = "daemon.sock"
+# spool sub-directories: job files dropped in incoming are moved along as they are processed
+SPOOL_DIRS = ["incoming", "running", "done", "failed"]
+POLL_INTERVAL = 1.0
+
+
+def warm_reference(spool_dir, cache_dir=None, bwa_shm=False):
+    """
+    Prepare the reference once for every job: compiled catalogue, renamed reference with its FASTA index and BWA
+    index, optionally loaded in shared memory with bwa shm.
+    """
+    reference_dir = os.path.join(spool_dir, "reference")
+    if not os.path.exists(reference_dir):
+        os.makedirs(reference_dir)
+    reference = mutAnalysis.prepare_reference(reference_dir, cache_dir)
+    # built before the workers start, they would all try to write it
+    if shutil.which("samtools"):
+        run_command("samtools faidx {0}".format(reference["sequence_file"]))
+    if bwa_shm:
+        run_command("bwa shm {0}".format(reference["index_file"]))
+    return reference
+
+
+class JobQueue:
+    """
+    Jobs of the daemon run by a bounded process pool. Submissions beyond max_queue waiting jobs are refused.
+    """
+
+    def __init__(self, reference, workers=1, threads=8, max_queue=100, retries=0):
+        self.reference = reference
+        self.workers = workers
+        self.threads = threads
+        self.max_queue = max_queue
+        self.retries = retries
+        self.jobs = OrderedDict()
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.executor = None
+        self.start_pool()
+
+    def start_pool(self):
+        # forked workers inherit the imported modules and the prepared reference. A fork pool forks all its workers
+        # on its first submit, made here: at startup, before the server and spool threads exist, a job submitted
+        # from one of those threads would fork while another may hold a lock (stdout, logging, imports) and leave the
+        # child deadlocked on it
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+        self.executor.submit(os.getpid).result()
+
+    def state(self, job_id):
+        state = self.jobs[job_id]["state"]
+        if state == "queued" and self.futures[job_id].running():
+            return "running"
+        return state
+
+    def counts(self):
+        counts = OrderedDict((state, 0) for state in ("queued", "running", "done", "failed"))
+        for job_id in self.jobs:
+            counts[self.state(job_id)] += 1
+        return counts
+
+    def health(self):
+        with self.lock:
+            counts = self.counts()
+        return OrderedDict([("status", "ok"), ("pid", os.getpid()), ("uptime_s", round(time.time() - self.start, 1)),
+                            ("workers", self.workers),
+                            ("worker_pids", sorted(process.pid for process in multiprocessing.active_children())),
+                            ("threads", self.threads),
+                            ("max_queue", self.max_queue),
+                            ("queue_depth", counts["queued"]), ("jobs", counts),
+                            ("catalogue", self.reference["catalogue"]["hash"]),
+                            ("index", self.reference["index_file"])])
+
+    def submit(self, spec, job_file=None):
+        """
+        Queue a job: spec holds sample, reads_1, reads_2, work_dir, initial and the extra options of the sample run.
+        """
+        missing = [key for key in ("sample", "reads_1", "reads_2", "work_dir", "initial") if not spec.get(key)]
+        if missing:
+            return OrderedDict([("status", "error"), ("error", "missing {0}".format(", ".join(missing)))])
+        with self.lock:
+            if self.counts()["queued"] >= self.max_queue:
+                return OrderedDict([("status", "error"), ("error", "queue full")])
+            job_id = uuid.uuid4().hex[:12]
+            work_dir = os.path.abspath(spec["work_dir"])
+            sample_argv = list(spec.get("options", [])) + [
+                "-1", spec["reads_1"], "-2", spec["reads_2"], "-wd", work_dir, "-i", spec["initial"],
+                "-t", str(self.threads)]
+            self.jobs[job_id] = OrderedDict([("id", job_id), ("sample", spec["sample"]), ("work_dir", work_dir),
+                                             ("state", "queued"), ("submitted", time.time()),
+                                             ("job_file", job_file)])
+            run = (batch.run_sample, spec["sample"], sample_argv, work_dir, self.retries, self.reference)
+            try:
+                try:
+                    future = self.executor.submit(*run)
+                except BrokenProcessPool:
+                    # a worker died (e.g. killed out of memory): the pool is broken for good and its jobs failed,
+                    # the next ones run on a new pool
+                    print("Process pool broken, starting {0} new workers".format(self.workers), flush=True)
+                    self.executor.shutdown(wait=False)
+                    self.start_pool()
+                    future = self.executor.submit(*run)
+            except (BrokenProcessPool, OSError) as e:
+                error = "{0}: {1}".format(type(e).__name__, e)
+                self.jobs[job_id].update([("state", "failed"), ("error", error)])
+                return OrderedDict([("status", "error"), ("id", job_id), ("error", error)])
+            self.futures[job_id] = future
+        future.add_done_callback(lambda f: self.finish(job_id, f))
+        return OrderedDict([("status", "ok"), ("id", job_id)])
+
+    def finish(self, job_id, future):
+        try:
+            sample_id, state, attempts, seconds, error = future.result()
+        except Exception as e:
+            state, attempts, seconds, error = "failed", 0, 0, "{0}: {1}".format(type(e).__name__, e)
+        with self.lock:
+            job = self.jobs[job_id]
+            job.update([("state", state), ("attempts", attempts), ("time_s", seconds), ("error", error)])
+            job_file = job["job_file"]
+        if job_file and os.path.exists(job_file):
+            out_file = os.path.join(os.path.dirname(os.path.dirname(job_file)), state, os.path.basename(job_file))
+            with open(job_file) as in_f:
+                spec = json.load(in_f)
+            spec["result"] = self.job(job_id)
+            with open(out_file, "w") as out_f:
+                json.dump(spec, out_f, indent=2)
+            os.remove(job_file)
+
+    def job(self, job_id):
+        with self.lock:
+            if job_id not in self.jobs:
+                return None
+            job = OrderedDict(self.jobs[job_id])
+            job["state"] = self.state(job_id)
+            return job
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    One JSON request per line: {"action": "health"}, {"action": "submit", "job": {...}}, {"action": "job", "id": ...}
+    or {"action": "stop"}. The reply is one JSON line.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode("utf-8"))
+                reply = self.server.dispatch(request)
+            except ValueError as e:
+                reply = OrderedDict([("status", "error"), ("error", "invalid request: {0}".format(e))])
+            except Exception as e:
+                # the client always gets a reply
+                reply = OrderedDict([("status", "error"), ("error", "{0}: {1}".format(type(e).__name__, e))])
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, queue):
+        self.queue = queue
+        super().__init__(socket_file, RequestHandler)
+
+    def dispatch(self, request):
+        action = request.get("action")
+        if action == "health":
+            return self.queue.health()
+        if action == "submit":
+            return self.queue.submit(request.get("job", {}))
+        if action == "job":
+            job = self.queue.job(request.get("id"))
+            return job if job else OrderedDict([("status", "error"), ("error", "unknown job")])
+        if action == "stop":
+            threading.Thread(target=self.shutdown).start()
+            return OrderedDict([("status", "ok"), ("stopping", True)])
+        return OrderedDict([("status", "error"), ("error", "unknown action {0}".format(action))])
+
+
+def watch_spool(spool_dir, queue, stop_event):
+    """
+    Submit the job files (JSON job specs) dropped in <spool>/incoming, oldest first.
+    """
+    while not stop_event.is_set():
+        job_files = sorted(glob.glob(os.path.join(spool_dir, "incoming", "*.json")), key=os.path.getmtime)
+        for job_file in job_files:
+            running_file = os.path.join(spool_dir, "running", os.path.basename(job_file))
+            try:
+                with open(job_file) as in_f:
+                    spec = json.load(in_f)
+            except ValueError as e:
+                print("Invalid job file {0}: {1}".format(job_file, e), flush=True)
+                shutil.move(job_file, os.path.join(spool_dir, "failed", os.path.basename(job_file)))
+                continue
+            spec.setdefault("sample", os.path.splitext(os.path.basename(job_file))[0])
+            if queue.health()["queue_depth"] >= queue.max_queue:
+                break
+            os.rename(job_file, running_file)
+            try:
+                reply = queue.submit(spec, running_file)
+            except Exception as e:
+                # an error of one job does not stop the spool
+                reply = OrderedDict([("status", "error"), ("error", "{0}: {1}".format(type(e).__name__, e))])
+            if reply["status"] != "ok":
+                print("Job file {0} refused: {1}".format(job_file, reply["error"]), flush=True)
+                shutil.move(running_file, os.path.join(spool_dir, "failed", os.path.basename(job_file)))
+            else:
+                print("Job {0}: {1}".format(reply["id"], job_file), flush=True)
+        stop_event.wait(POLL_INTERVAL)
+
+
+def request(spool_dir, message, timeout=10.0):
+    """
+    Send one request to the daemon of a spool directory and return its reply.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(os.path.join(spool_dir, SOCKET_FILE))
+    except OSError as e:
+        print("\nNo daemon listening on {0}: {1}\n".format(os.path.join(spool_dir, SOCKET_FILE), e))
+        exit(1)
+    with client, client.makefile("rwb") as stream:
+        stream.write((json.dumps(message) + "\n").encode("utf-8"))
+        stream.flush()
+        return json.loads(stream.readline().decode("utf-8"))
+
+
+def serve(args):
+    spool_dir = os.path.abspath(args.spool)
+    for name in SPOOL_DIRS:
+        os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+    socket_file = os.path.join(spool_dir, SOCKET_FILE)
+    if os.path.exists(socket_file):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_file)
+            print("\nA daemon already listens on {0}\n".format(socket_file))
+            exit(1)
+        except OSError:
+            # left by a daemon that did not stop cleanly
+            os.remove(socket_file)
+        finally:
+            probe.close()
+
+    cache_dir = None if args.no_index_cache else os.path.abspath(args.index_cache)
+    reference = warm_reference(spool_dir, cache_dir, args.bwa_shm)
+    queue = JobQueue(reference, args.workers, args.threads, args.max_queue, args.retries)
+
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=watch_spool, args=(spool_dir, queue, stop_event), daemon=True)
+    server = DaemonServer(socket_file, queue)
+    print("Daemon listening on {0} ({1} workers x {2} threads), spool {3}".format(
+        socket_file, args.workers, args.threads, os.path.join(spool_dir, "incoming")), flush=True)
+    watcher.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        watcher.join()
+        server.server_close()
+        os.remove(socket_file)
+        queue.shutdown()
+        if args.bwa_shm:
+            run_command("bwa shm -d", check=False)
+    print("Daemon stopped", flush=True)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis daemon',
+        description='mutanalysis daemon: keep the catalogue and the reference index loaded and process the samples '
+                    'submitted over a local socket or dropped as JSON job files in <spool>/incoming',
+    )
+    parser.add_argument('action', choices=["start", "health", "submit", "job", "stop"],
+                        help="start the daemon, query its health and queue depth, submit a sample, follow a job or "
+                             "stop the daemon")
+    parser.add_argument('--spool', dest="spool", required=True, help="Spool directory of the daemon")
+    parser.add_argument('--workers', dest="workers", type=int, default=1,
+                        help="Number of samples processed concurrently (Default=1)")
+    parser.add_argument('-t', '--threads', dest="threads", type=int, default=8,
+                        help="Number of threads of each sample (Default=8)")
+    parser.add_argument('--max-queue', dest="max_queue", type=int, default=100,
+                        help="Number of waiting jobs before submissions are refused (Default=100)")
+    parser.add_argument('--retries', dest="retries", type=int, default=0,
+                        help="Number of retries of a failed sample (Default=0)")
+    parser.add_argument('--index-cache', dest="index_cache", default=index_cache.default_cache_dir(),
+                        help="Shared cache of BWA indexes (Default=$MUTANALYSIS_INDEX_CACHE or "
+                             "~/.cache/mutanalysis/bwa_index)")
+    parser.add_argument('--no-index-cache', dest="no_index_cache", action="store_true",
+                        help="Build the BWA index in the spool directory")
+    parser.add_argument('--bwa-shm', dest="bwa_shm", action="store_true",
+                        help="Load the BWA index in shared memory (bwa shm) while the daemon runs")
+    parser.add_argument('--sample', dest="sample", default="", help="submit: sample id")
+    parser.add_argument('-1', '--R1', dest="reads_1", default="", help="submit: reads file R1")
+    parser.add_argument('-2', '--R2', dest="reads_2", default="", help="submit: reads file R2")
+    parser.add_argument('-wd', '--wkDir', dest="workDir", default="", help="submit: working directory of the sample")
+    parser.add_argument('-i', '--initial', dest="initial", default="", help="submit: initial of user")
+    parser.add_argument('--id', dest="job_id", default="", help="job: job id")
+    args, sample_options = parser.parse_known_args(argv)
+
+    if args.action == "start":
+        serve(args)
+        return
+    if args.action == "submit":
+        message = {"action": "submit", "job": {
+            "sample": args.sample or os.path.basename(os.path.abspath(args.workDir)),
+            "reads_1": os.path.abspath(args.reads_1) if args.reads_1 else "",
+            "reads_2": os.path.abspath(args.reads_2) if args.reads_2 else "",
+            "work_dir": os.path.abspath(args.workDir) if args.workDir else "", "initial": args.initial,
+            "options": sample_options}}
+    elif args.action == "job":
+        message = {"action": "job", "id": args.job_id}
+    else:
+        message = {"action": args.action}
+    reply = request(os.path.abspath(args.spool), message)
+    print(json.dumps(reply, indent=2), flush=True)
+    if reply.get("status") == "error":
+        exit(1)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Depth-capped read consumption: stop reading the FASTQ once every catalogued codon reaches a target depth.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import bisect
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from contextlib import nullcontext
+from subprocess import DEVNULL, PIPE
+
+from mutanalysis.codon import REF_OPS, SKIP_FLAGS, parse_cigar, read_codon
+from mutanalysis.metrics import command
+from mutanalysis.prefilter import read_name, read_pairs
+
+
+def site_label(key):
+    return "\t".join(key) if isinstance(key, tuple) else str(key)
+
+
+def keep_pair(name, seed, fraction):
+    """
+    Seeded subsampling decision of a read pair: the same name, seed and fraction always give the same answer.
+    """
+    if fraction >= 1:
+        return True
+    digest = hashlib.blake2b("{0}\t{1}".format(seed, name).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") < fraction * (1 << 64)
+
+
+class CodonDepth:
+    """
+    Number of reads carrying the three bases of each codon, updated from SAM lines.
+    """
+
+    def __init__(self, codons):
+        # codons maps a key to (contig, 1-based position of the first codon base)
+        self.depth = OrderedDict((key, 0) for key in codons)
+        # contig -> 0-based codon starts (sorted) and the matching keys
+        self.starts = {}
+        for key, (ctg, start) in sorted(codons.items(), key=lambda item: item[1]):
+            ctg_starts, ctg_keys = self.starts.setdefault(ctg, ([], []))
+            ctg_starts.append(start - 1)
+            ctg_keys.append(key)
+
+    def add(self, sam_line):
+        fields = sam_line.split("\t", 10)
+        if fields[0].startswith("@") or int(fields[1]) & (SKIP_FLAGS | 0x4) or fields[5] == "*" or fields[9] == "*":
+            return
+        if fields[2] not in self.starts:
+            return
+        ctg_starts, ctg_keys = self.starts[fields[2]]
+        ref_start = int(fields[3]) - 1
+        cigartuples = parse_cigar(fields[5])
+        ref_end = ref_start + sum(length for op, length in cigartuples if op in REF_OPS)
+        sequence = fields[9].upper()
+        for i in range(bisect.bisect_left(ctg_starts, ref_start), len(ctg_starts)):
+            if ctg_starts[i] + 3 > ref_end:
+                break
+            if read_codon(ref_start, cigartuples, sequence, ctg_starts[i]) >= 0:
+                self.depth[ctg_keys[i]] += 1
+
+    def reached(self, target_depth):
+        return all(depth >= target_depth for depth in self.depth.values())
+
+
+def align_chunk(index_file, fastq_file1, fastq_file2, tracker, sam_f=None, header=True, threads=8):
+    """
+    Align a chunk of read pairs, follow the depth of the codons and append the alignments to sam_f (with the header
+    when header is set).
+    """
+    cmd = ["bwa", "mem", "-t", str(threads), index_file, fastq_file1, fastq_file2]
+    with command(cmd, stdout=PIPE, stderr=DEVNULL, universal_newlines=True) as process:
+        for line in process.stdout:
+            tracker.add(line)
+            if sam_f is not None and (header or not line.startswith("@")):
+                sam_f.write(line)
+
+
+def cap_reads(index_file, fastq_file1, fastq_file2, work_dir, codons, target_depth=100, max_pairs=0, seed=1,
+              fraction=1.0, chunk_size=50000, threads=8):
+    """
+    Stream the read pairs kept by the seeded subsampling in chunks, align each chunk to follow the depth of every
+    codon and stop once they all reach target_depth (0: no target) or max_pairs pairs were kept (0: no budget).
+    Write the consumed pairs to FASTQ files and return them with the report of the run. With a target depth, the
+    alignments of the chunks are kept in <work_dir>/sequence.sam (report "alignment"), the final alignment: the
+    consumed pairs are not aligned again, even when a codon never reaches the target (report "under_target").
+    """
+    tracker = CodonDepth(codons)
+    out_file1 = os.path.join(work_dir, "depthcap_R1.fastq")
+    out_file2 = os.path.join(work_dir, "depthcap_R2.fastq")
+    sam_file = os.path.join(work_dir, "sequence.sam") if target_depth else None
+    chunk_file1 = os.path.join(work_dir, "depthcap_chunk_R1.fastq")
+    chunk_file2 = os.path.join(work_dir, "depthcap_chunk_R2.fastq")
+
+    read_total = kept = chunks = 0
+    stop = "end of input"
+    pairs = read_pairs(fastq_file1, fastq_file2, threads)
+    with open(out_file1, "w") as out_1, open(out_file2, "w") as out_2, \
+            (open(sam_file, "w") if sam_file else nullcontext()) as sam_f:
+        while stop == "end of input":
+            chunk = []
+            for record_1, record_2 in pairs:
+                read_total += 1
+                if keep_pair(read_name(record_1[0]), seed, fraction):
+                    chunk.append((record_1, record_2))
+                    if len(chunk) == chunk_size or (max_pairs and kept + len(chunk) == max_pairs):
+                        break
+            if not chunk:
+                break
+            with open(chunk_file1, "w") as chunk_1, open(chunk_file2, "w") as chunk_2:
+                for record_1, record_2 in chunk:
+                    chunk_1.writelines(record_1)
+                    chunk_2.writelines(record_2)
+                    out_1.writelines(record_1)
+                    out_2.writelines(record_2)
+            kept += len(chunk)
+            chunks += 1
+            if target_depth:
+                align_chunk(index_file, chunk_file1, chunk_file2, tracker, sam_f, chunks == 1, threads)
+            if target_depth and tracker.reached(target_depth):
+                stop = "target depth reached"
+            elif max_pairs and kept >= max_pairs:
+                stop = "read budget exhausted"
+    pairs.close()
+    for chunk_file in (chunk_file1, chunk_file2):
+        if os.path.exists(chunk_file):
+            os.remove(chunk_file)
+
+    report = OrderedDict([("target_depth", target_depth), ("max_pairs", max_pairs), ("seed", seed),
+                          ("fraction", fraction), ("chunk_size", chunk_size), ("read_pairs", read_total),
+                          ("kept_pairs", kept), ("chunks", chunks), ("stop", stop),
+                          ("depth", OrderedDict((site_label(key), depth) for key, depth in tracker.depth.items())),
+                          ("under_target", [site_label(key) for key, depth in tracker.depth.items()
+                                            if depth < target_depth]),
+                          ("alignment", sam_file)])
+    return out_file1, out_file2, report
+
+
+def write_report(report_file, report, achieved_depth=None):
+    """
+    Write the depth cap report, with the depth achieved at each site on the final alignment when it is given.
+    """
+    report = OrderedDict(report)
+    if achieved_depth is not None:
+        report["achieved_depth"] = OrderedDict((site_label(key), depth) for key, depth in achieved_depth.items())
+    with open(report_file, "w") as out_f:
+        json.dump(report, out_f, indent=2)
+    return report
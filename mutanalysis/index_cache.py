@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Shared, content-addressed cache of BWA indexes.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from mutanalysis.metrics import run_command
+from mutanalysis.utils import rename_reference
+
+INDEX_EXTENSIONS = [".amb", ".ann", ".bwt", ".pac", ".sa"]
+INDEX_PREFIX = "reference"
+CHECKSUM_FILE = "checksums.json"
+
+
+def default_cache_dir():
+    return os.environ.get("MUTANALYSIS_INDEX_CACHE",
+                          os.path.join(os.path.expanduser("~"), ".cache", "mutanalysis", "bwa_index"))
+
+
+def file_checksum(path, block_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as in_f:
+        for block in iter(lambda: in_f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def verify_index(entry_dir):
+    """
+    Return True when every index file of a cache entry is present and matches its recorded checksum.
+    """
+    checksum_file = os.path.join(entry_dir, CHECKSUM_FILE)
+    if not os.path.exists(checksum_file):
+        return False
+    with open(checksum_file) as in_f:
+        checksums = json.load(in_f)
+    for ext in INDEX_EXTENSIONS:
+        path = os.path.join(entry_dir, INDEX_PREFIX + ext)
+        if not os.path.exists(path) or checksums.get(ext) != file_checksum(path):
+            return False
+    return True
+
+
+def build_index(sequence_file, entry_dir, key):
+    """
+    Build the index in a fresh directory next to the entry and swap the entry over to it atomically.
+    The entry is a symbolic link to its current directory: a rebuild (warm-index -f) only replaces the link, so the
+    runs still reading the previous directory through bwa mem keep it.
+    """
+    cache_dir = os.path.dirname(entry_dir)
+    index_dir = tempfile.mkdtemp(prefix="{0}.".format(key), dir=cache_dir)
+    prefix = os.path.join(index_dir, INDEX_PREFIX)
+    cmd = "bwa index -p {0} {1}".format(prefix, sequence_file)
+    try:
+        run_command(cmd, os.path.join(index_dir, "logBWA_index.txt"))
+    except SystemExit:
+        shutil.rmtree(index_dir)
+        raise
+    os.chmod(index_dir, 0o755)
+
+    checksums = {ext: file_checksum(prefix + ext) for ext in INDEX_EXTENSIONS}
+    checksums["reference"] = key
+    with open(os.path.join(index_dir, CHECKSUM_FILE), "w") as out_f:
+        json.dump(checksums, out_f, indent=2)
+
+    if os.path.isdir(entry_dir) and not os.path.islink(entry_dir):
+        # entry of an earlier release, built in place: kept under a directory name of its own
+        os.rename(entry_dir, tempfile.mkdtemp(prefix="{0}.".format(key), dir=cache_dir))
+    link_file = os.path.join(cache_dir, "{0}.link_{1}".format(key, os.getpid()))
+    if os.path.lexists(link_file):
+        os.remove(link_file)
+    os.symlink(os.path.basename(index_dir), link_file)
+    os.replace(link_file, entry_dir)
+
+
+def cached_index(sequence_file, cache_dir=None, force=False):
+    """
+    Return the BWA index prefix of the reference, building it in the shared cache only once.
+    The entry is keyed by the SHA-256 of the (renamed) reference and writers are serialised by a file lock.
+    The prefix returned is in the directory the entry points to, which a later rebuild leaves in place.
+    """
+    cache_dir = os.path.abspath(cache_dir or default_cache_dir())
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    key = file_checksum(sequence_file)
+    entry_dir = os.path.join(cache_dir, key)
+
+    if not force and verify_index(entry_dir):
+        print("\nIndex BWA found in cache: {0}\n".format(entry_dir))
+        return os.path.join(os.path.realpath(entry_dir), INDEX_PREFIX)
+
+    with open(os.path.join(cache_dir, "{0}.lock".format(key)), "w") as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            # another run may have built it while we were waiting for the lock
+            if force or not verify_index(entry_dir):
+                print("\nBuild index BWA in cache: {0}\n".format(entry_dir))
+                build_index(sequence_file, entry_dir, key)
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+    return os.path.join(os.path.realpath(entry_dir), INDEX_PREFIX)
+
+
+def run(argv=None):
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis warm-index',
+        description='mutanalysis warm-index: build the BWA index of a reference in the shared cache',
+    )
+    parser.add_argument('-r', '--reference', dest="reference",
+                        default=os.path.join(dir_path, "database", "sequences.fasta"),
+                        help="Reference FASTA (Default=packaged database)")
+    parser.add_argument('--index-cache', dest="index_cache", default=default_cache_dir(),
+                        help="Index cache directory (Default=$MUTANALYSIS_INDEX_CACHE or ~/.cache/mutanalysis)")
+    parser.add_argument('-f', '--force', dest="force", action="store_true", help="Rebuild the cached index")
+    args = parser.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp(prefix="mutanalysis_")
+    try:
+        sequence_file = rename_reference(os.path.abspath(args.reference), os.path.join(tmp_dir, "sequence.fasta"))
+        index_prefix = cached_index(sequence_file, args.index_cache, args.force)
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("Index BWA ready: {0}".format(index_prefix), flush=True)
@@ -16,115 +16,163 @@ not, see <http://www.gnu.org/licenses/>.
 
 import os
 import shutil
-from subprocess import PIPE, Popen, STDOUT
+import tempfile
 
+from mutanalysis import index_cache, runner
+from mutanalysis.metrics import timed_stage
+from mutanalysis.resources import SORT_MEMORY_MAX
+from mutanalysis.stagecache import StageCache
 
-def alignment_bwa(sequence_file, fastq_file1, fastq_file2, work_dir, threads=8, force=False):
 
-    sam_file = os.path.join(work_dir, 'sequence.sam')
-    bam_file = os.path.join(work_dir, 'sequence.bam')
+def index_bwa(sequence_file, work_dir, force=False, cache_dir=None, cache=None):
+
+    if cache_dir:
+        return index_cache.cached_index(sequence_file, cache_dir, force)
+
     bwa_index_dir = os.path.join(work_dir, "bwa_index")
+    index_fasta_file = os.path.join(bwa_index_dir, os.path.basename(sequence_file))
 
     if not os.path.exists(bwa_index_dir):
         os.mkdir(bwa_index_dir)
-    else:
-        print("\nIndex BWA already exist!\n")
+
+    cache = cache or StageCache(work_dir, force)
+    key = cache.key("index", [sequence_file], tools=["bwa"])
+    if cache.fresh("index", key):
         print("At {0}".format(bwa_index_dir))
+        return index_fasta_file
 
-    index_fasta_file = os.path.join(bwa_index_dir, os.path.basename(sequence_file))
     shutil.copy(sequence_file, index_fasta_file)
 
-    if not os.path.exists(bam_file) or force:
-        # index reference
-        cmd = "bwa index {0}".format(index_fasta_file)
-        process = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT).stdout.read()
-
-        # make log
-        filename_log = "logBWA_index.txt"
-        header = "Command line executed: {0}\n\n\n{1}".format(cmd, process.decode("utf-8"))
-        log_process_output(header, bwa_index_dir, filename_log)
-
-        # remove fasta used for index
-        os.remove(index_fasta_file)
-
-        # alignment
-        cmd = "bwa mem -t {0} {1} {2} {3} > {4}".format(threads, index_fasta_file, fastq_file1, fastq_file2,
-                                                        sam_file)
-        process = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT).stdout.read()
-
-        # make log
-        filename_log = "logBWA_MEM.txt"
-        header = "Command line executed: {0}\n\n\n{1}".format(cmd, process.decode("utf-8"))
-        log_process_output(header, os.path.dirname(bam_file), filename_log)
-    else:
-        print('\nAlignment file {0} already done\n'.format(bam_file))
+    # index reference
+    cmd = "bwa index {0}".format(index_fasta_file)
+    runner.run(cmd, os.path.join(bwa_index_dir, "logBWA_index.txt"))
+
+    # remove fasta used for index
+    os.remove(index_fasta_file)
+    cache.record("index", key, [index_fasta_file + ext for ext in index_cache.INDEX_EXTENSIONS])
+    return index_fasta_file
+
+
+def alignment_bwa(index_file, fastq_file1, fastq_file2, work_dir, threads=8):
+
+    sam_file = os.path.join(work_dir, 'sequence.sam')
+
+    # alignment
+    cmd = "bwa mem -t {0} {1} {2} {3} > {4}".format(threads, index_file, fastq_file1, fastq_file2, sam_file)
+    runner.run(cmd, os.path.join(work_dir, "logBWA_MEM.txt"))
     return sam_file
 
 
-def convert_sam_to_bam(sam_file, force=False):
+def convert_sam_to_bam(sam_file):
     bam_file = os.path.splitext(sam_file)[0] + '.bam'
-    if not os.path.exists(bam_file) or force:
-        cmd = "samtools view -h -b -S {0} > {1}".format(sam_file, bam_file)
-        os.system(cmd)
+    cmd = "samtools view -h -b -S {0} > {1}".format(sam_file, bam_file)
+    runner.run(cmd)
 
-        # remove sam file
-        os.remove(sam_file)
+    # remove sam file
+    os.remove(sam_file)
 
     return bam_file
 
 
-def sort_bam_file(bam_file):
+def sort_bam_file(bam_file, sort_threads=1, sort_memory=SORT_MEMORY_MAX):
     out_file = os.path.splitext(bam_file)[0] + '_sort.bam'
-    cmd = "samtools sort -m 1000000000 {0} > {1};mv {2} {3}".format(bam_file, out_file, out_file, bam_file)
-    os.system(cmd)
-    cmd = "samtools flagstat {0} > {1}".format(bam_file, os.path.splitext(bam_file)[0] + '_bamstat.txt')
-    os.system(cmd)
+    runner.run("samtools sort -@ {0} -m {1} -o {2} {3}".format(sort_threads, sort_memory, out_file, bam_file))
+    shutil.move(out_file, bam_file)
+
+    # flag counters and index both only read the sorted BAM
+    runner.run_commands(["samtools flagstat {0} > {1}".format(bam_file,
+                                                              os.path.splitext(bam_file)[0] + '_bamstat.txt'),
+                         "samtools index {0}".format(bam_file)])
     return bam_file
 
 
 def index_bam_file(bam_file):
     cmd = "samtools index {0}".format(bam_file)
-    os.system(cmd)
+    runner.run(cmd)
 
 
-def split_unmapped_mapped_reads(bam_file, force):
+def split_unmapped_mapped_reads(bam_file, unmapped="split"):
     unmapped_fastq_file = os.path.splitext(bam_file)[0] + '_unmapped.fastq.gz'
-    if not os.path.exists(unmapped_fastq_file) or force:
+    out_file = os.path.splitext(bam_file)[0] + '_droped.bam'
 
-        # process BAM of unmapped read
-        cmd = "samtools view -b -f 4 {0} > tmp_unmapped.bam".format(bam_file)
-        os.system(cmd)
+    # BAM of mapped reads, FASTQ of unmapped reads written at the same time
+    commands = ["samtools view -b -F 4 {0} > {1}".format(bam_file, out_file)]
+    if unmapped == "split":
+        commands.append("set -o pipefail; samtools view -b -f 4 {0} | samtools fastq - > {1}".format(
+            bam_file, unmapped_fastq_file))
+    runner.run_commands(commands)
 
-        # process FASTQ of unmapped read
-        cmd = "samtools fastq tmp_unmapped.bam > {0}".format(unmapped_fastq_file)
-        os.system(cmd)
+    # move BAM file
+    shutil.move(out_file, bam_file)
 
-        # remove unmapped reads BAM file
-        os.remove("tmp_unmapped.bam")
+    return bam_file, unmapped_fastq_file
 
-        # process BAM of mapped reads
-        out_file = os.path.splitext(bam_file)[0] + '_droped.bam'
-        cmd = "samtools view -b -F 4 {0} > {1}".format(bam_file, out_file)
-        os.system(cmd)
 
-        # move BAM file
-        shutil.move(out_file, bam_file)
+def alignment_bwa_stream(index_file, fastq_file1, fastq_file2, work_dir, threads=8, unmapped="split",
+                         sort_threads=1, sort_memory=SORT_MEMORY_MAX):
+    """
+    Align, drop unmapped reads, sort and count flags in a single pass: bwa mem is piped into samtools and the
+    side outputs (flagstat and unmapped reads) are fed through named pipes by readers running in parallel. A
+    failing command stops the others, readers included.
+    """
+    bam_file = os.path.join(work_dir, 'sequence.bam')
+    unmapped_fastq_file = os.path.join(work_dir, 'sequence_unmapped.fastq.gz')
+    flagstat_file = os.path.join(work_dir, 'sequence_bamstat.txt')
 
-    else:
-        print('\nUnmapped reads fastq file {0} already done\n'.format(unmapped_fastq_file))
+    fifo_dir = tempfile.mkdtemp(prefix="fifo_", dir=work_dir)
+    try:
+        # flagstat counters collected on the whole stream
+        flagstat_fifo = os.path.join(fifo_dir, "flagstat")
+        os.mkfifo(flagstat_fifo)
+        commands = ["samtools flagstat {0} > {1}".format(flagstat_fifo, flagstat_file)]
+
+        # unmapped reads written in parallel
+        unmapped_opt = ""
+        if unmapped == "split":
+            unmapped_fifo = os.path.join(fifo_dir, "unmapped")
+            os.mkfifo(unmapped_fifo)
+            commands.append("set -o pipefail; samtools fastq {0} | gzip -c > {1}".format(unmapped_fifo,
+                                                                                         unmapped_fastq_file))
+            unmapped_opt = "-U {0} ".format(unmapped_fifo)
+
+        bwa_log = os.path.join(work_dir, "logBWA_MEM.txt")
+        cmd = "set -o pipefail; bwa mem -t {0} {1} {2} {3} 2> {4} | tee {5} | samtools view -u -F 4 {6}- | " \
+              "samtools sort -@ {7} -m {8} -o {9} -".format(threads, index_file, fastq_file1, fastq_file2, bwa_log,
+                                                            flagstat_fifo, unmapped_opt, sort_threads, sort_memory,
+                                                            bam_file)
+        commands.append((cmd, os.path.join(work_dir, "logStream.txt")))
+
+        # the readers and the writer of a named pipe block each other, they all need a slot
+        runner.run_commands(commands, jobs=len(commands))
+    finally:
+        shutil.rmtree(fifo_dir)
 
+    index_bam_file(bam_file)
     return bam_file, unmapped_fastq_file
 
 
-def log_process_output(output, work_dir_path, filename_log):
-    try:
-        with open("{0}/{1}".format(work_dir_path, filename_log), 'w') as log_file:
-            log_file.write(output)
-    except IOError as e:
-        return e
-
-
-def main(fasta_file, fastq_file1, fastq_file2, work_dir, force=False, threads=8):
+def read_flagstat(flagstat_file):
+    """
+    Return the passed QC counters of a samtools flagstat report keyed by label ("in total", "mapped"...).
+    """
+    counters = {}
+    if not os.path.exists(flagstat_file):
+        return counters
+    with open(flagstat_file) as flag_f:
+        for line in flag_f:
+            fields = line.strip().split(" ", 3)
+            if len(fields) == 4 and fields[1] == "+":
+                label = fields[3].split("(")[0].strip()
+                counters.setdefault(label, int(fields[0]))
+    return counters
+
+
+def main(fasta_file, fastq_file1, fastq_file2, work_dir, force=False, threads=8, stream=True, unmapped="split",
+         index_file=None, cache_dir=None, cache=None, sort_threads=1, sort_memory=SORT_MEMORY_MAX, sam_file=None):
+    """
+    Align the read pairs and write the sorted and indexed BAM of the mapped reads. sam_file is an alignment of the
+    same pairs already made (the chunks of the depth cap): it is only converted, split, sorted and indexed.
+    """
 
     print("FASTA TO BAM arguments:\n")
     print("\t - Fasta File = {0}".format(fasta_file))
@@ -132,23 +180,53 @@ def main(fasta_file, fastq_file1, fastq_file2, work_dir, force=False, threads=8)
     print("\t - Fastq File 2 = {0}".format(fastq_file2))
     print("\t - Force = {0}".format(force))
     print("\t - Threads = {0}".format(threads))
+    print("\t - Sort = {0} threads x {1} bytes".format(sort_threads, sort_memory))
+    print("\t - Streaming = {0}".format(stream))
+    print("\t - Unmapped reads = {0}".format(unmapped))
+    print("\t - Alignment = {0}".format(sam_file or "bwa mem"))
 
-    print("*START Align BWA*")
-    sam_file = alignment_bwa(fasta_file, fastq_file1, fastq_file2, work_dir, threads, force)
-    print("*END Align BWA*")
-
-    print("*START Convert SAM to BAM*")
-    bam_file = convert_sam_to_bam(sam_file, force)
-    print("*END Convert SAM to BAM*")
-
-    print("*START Split unmapped and mapped reads*")
-    bam_file, unmapped_fastq_file = split_unmapped_mapped_reads(bam_file, force)
-    print("*END Split unmapped and mapped reads*")
+    cache = cache or StageCache(work_dir, force)
 
-    print("*START sort BAM*")
-    bam_file = sort_bam_file(bam_file)
-    print("*END sort BAM*")
+    if index_file is None:
+        with timed_stage("Index BWA"):
+            index_file = index_bwa(fasta_file, work_dir, force, cache_dir, cache)
 
-    print("*START index BAM*")
-    index_bam_file(bam_file)
-    print("*END index BAM*")
+    bam_file = os.path.join(work_dir, 'sequence.bam')
+    flagstat_file = os.path.join(work_dir, 'sequence_bamstat.txt')
+    outputs = [bam_file, bam_file + ".bai", flagstat_file]
+    if unmapped == "split":
+        outputs.append(os.path.join(work_dir, 'sequence_unmapped.fastq.gz'))
+    # the index is derived from the reference sequences, the batch size of bwa mem (hence the insert size
+    # estimation) from the threads
+    key = cache.key("mapping", [fastq_file1, fastq_file2, fasta_file],
+                    {"stream": stream, "unmapped": unmapped, "threads": threads}, ["bwa", "samtools"])
+    if cache.fresh("mapping", key):
+        if sam_file:
+            os.remove(sam_file)
+        return bam_file
+
+    if stream and not sam_file:
+        with timed_stage("Align BWA, filter, sort and index BAM"):
+            bam_file, unmapped_fastq_file = alignment_bwa_stream(index_file, fastq_file1, fastq_file2, work_dir,
+                                                                 threads, unmapped, sort_threads, sort_memory)
+        counters = read_flagstat(flagstat_file)
+        if counters:
+            print("Reads: {0} total, {1} mapped".format(counters.get("in total", 0), counters.get("mapped", 0)))
+        cache.record("mapping", key, outputs)
+        return bam_file
+
+    if not sam_file:
+        with timed_stage("Align BWA"):
+            sam_file = alignment_bwa(index_file, fastq_file1, fastq_file2, work_dir, threads)
+
+    with timed_stage("Convert SAM to BAM"):
+        bam_file = convert_sam_to_bam(sam_file)
+
+    with timed_stage("Split unmapped and mapped reads"):
+        bam_file, unmapped_fastq_file = split_unmapped_mapped_reads(bam_file, unmapped)
+
+    with timed_stage("sort and index BAM"):
+        bam_file = sort_bam_file(bam_file, sort_threads, sort_memory)
+
+    cache.record("mapping", key, outputs)
+    return bam_file
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+Run instrumentation: wall/CPU time, peak RSS and I/O of every stage and external command, written to a run manifest.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import cProfile
+import json
+import os
+import resource
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from subprocess import PIPE, STDOUT, Popen
+
+# ru_inblock / ru_oublock are counted in 512-byte blocks
+BLOCK_SIZE = 512
+
+# external commands are started by this wrapper, which reports their own resource usage (see usage_wrapper.py)
+USAGE_WRAPPER = [sys.executable, "-I", "-S", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          "usage_wrapper.py")]
+
+# seconds given to a stopped command to exit after SIGTERM, before SIGKILL
+KILL_GRACE = 5
+
+# process groups of the external commands running (each command runs in its own session), stopped by stop_run
+RUNNING = set()
+RUNNING_LOCK = threading.Lock()
+STOP = threading.Event()
+STOP_REASON = ""
+
+
+def cpu_times():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime, children.ru_utime + children.ru_stime)
+
+
+def max_rss():
+    # kB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def process_io():
+    """
+    Bytes read and written by the Python process (Linux /proc), None elsewhere.
+    """
+    try:
+        with open("/proc/self/io") as in_f:
+            counters = dict(line.split(":") for line in in_f)
+        return int(counters["read_bytes"]), int(counters["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class RunManifest:
+    """
+    Stages and commands of a run, in execution order.
+    """
+
+    def __init__(self, manifest_file=None, profile_dir=None):
+        self.manifest_file = manifest_file
+        self.profile_dir = profile_dir
+        self.start = time.time()
+        self.cpu_start = cpu_times()
+        self.run = OrderedDict([("argv", sys.argv), ("pid", os.getpid()),
+                                ("started", time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)))])
+        self.stages = []
+        self.commands = []
+        self.stack = []
+        self.profiler = None
+
+    def current_stage(self):
+        return self.stack[-1]["name"] if self.stack else None
+
+    def write(self, status="ok"):
+        if not self.manifest_file:
+            return None
+        cpu = cpu_times()
+        self.run["status"] = status
+        self.run["wall_s"] = round(time.time() - self.start, 3)
+        self.run["cpu_s"] = round(sum(cpu) - sum(self.cpu_start), 3)
+        self.run["max_rss_kb"] = max_rss()
+        manifest = OrderedDict([("run", self.run), ("stages", self.stages), ("commands", self.commands)])
+        # write then rename so that a reader never sees a partial file
+        fd, tmp_file = tempfile.mkstemp(prefix=".run_manifest_", dir=os.path.dirname(self.manifest_file))
+        with os.fdopen(fd, "w") as out_f:
+            json.dump(manifest, out_f, indent=2)
+        os.replace(tmp_file, self.manifest_file)
+        return self.manifest_file
+
+
+# manifest of the current process, stages and commands are recorded even when no file is written
+MANIFEST = RunManifest()
+
+
+def start_run(manifest_file, profile_dir=None, **info):
+    """
+    Start recording a run: the manifest is written to manifest_file, cProfile data of the top level stages to
+    profile_dir when it is given.
+    """
+    global MANIFEST
+    MANIFEST = RunManifest(os.path.abspath(manifest_file), profile_dir)
+    MANIFEST.run.update(info)
+    if profile_dir and not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    return MANIFEST
+
+
+def finish_run(status="ok"):
+    return MANIFEST.write(status)
+
+
+def stop_run(reason):
+    """
+    Stop the run from another thread (e.g. the heartbeat of a lost lease): the commands running are stopped, SIGTERM
+    then SIGKILL after KILL_GRACE seconds, and the run ends at its next command or stage (see check_stop).
+    """
+    global STOP_REASON
+    with RUNNING_LOCK:
+        STOP_REASON = reason
+        STOP.set()
+        groups = set(RUNNING)
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        groups = signal_groups(groups, sig)
+        deadline = time.time() + KILL_GRACE
+        while groups and time.time() < deadline:
+            time.sleep(0.1)
+            groups = signal_groups(groups, 0)
+        if not groups:
+            return
+
+
+def signal_groups(groups, sig):
+    # the process groups still holding a process (signal 0 only checks)
+    alive = set()
+    for group in groups:
+        try:
+            os.killpg(group, sig)
+            alive.add(group)
+        except ProcessLookupError:
+            pass
+    return alive
+
+
+def check_stop():
+    """
+    End the run when it was stopped by stop_run.
+    """
+    if STOP.is_set():
+        print("\nRun stopped: {0}\n".format(STOP_REASON), flush=True)
+        MANIFEST.write("stopped")
+        exit(1)
+
+
+def track_command(process):
+    """
+    Record a command started in its own session, to be stopped with the run. A command started after stop_run is
+    killed at once.
+    """
+    with RUNNING_LOCK:
+        RUNNING.add(process.pid)
+        stopped = STOP.is_set()
+    if stopped:
+        signal_groups([process.pid], signal.SIGKILL)
+
+
+def untrack_command(process):
+    with RUNNING_LOCK:
+        RUNNING.discard(process.pid)
+
+
+def fail(message):
+    """
+    Print the error, write the manifest of the failed run and exit.
+    """
+    print(message, flush=True)
+    MANIFEST.write("failed")
+    exit(1)
+
+
+@contextmanager
+def timed_stage(name):
+    """
+    Print the start and the end of a stage and record its wall time, CPU time (the process and its commands), peak
+    RSS and I/O. Top level stages are profiled with cProfile when the run has a profile directory.
+    """
+    check_stop()
+    print("*START {0}*".format(name), flush=True)
+    entry = OrderedDict([("name", name), ("parent", MANIFEST.current_stage()), ("status", "running")])
+    MANIFEST.stages.append(entry)
+    MANIFEST.stack.append(entry)
+
+    profiler = None
+    if MANIFEST.profile_dir and MANIFEST.profiler is None:
+        profiler = MANIFEST.profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.time()
+    cpu_start = cpu_times()
+    io_start = process_io()
+    try:
+        yield entry
+        entry["status"] = "ok"
+    except BaseException:
+        entry["status"] = "failed"
+        raise
+    finally:
+        wall = time.time() - start
+        cpu = cpu_times()
+        io_end = process_io()
+        entry["wall_s"] = round(wall, 3)
+        entry["cpu_s"] = round(cpu[0] - cpu_start[0], 3)
+        entry["commands_cpu_s"] = round(cpu[1] - cpu_start[1], 3)
+        entry["max_rss_kb"] = max_rss()
+        if io_start and io_end:
+            entry["read_bytes"] = io_end[0] - io_start[0]
+            entry["write_bytes"] = io_end[1] - io_start[1]
+        MANIFEST.stack.pop()
+
+        if profiler is not None:
+            profiler.disable()
+            MANIFEST.profiler = None
+            profile_file = os.path.join(MANIFEST.profile_dir, "{0:02d}_{1}.prof".format(
+                len(MANIFEST.stages), "".join(c if c.isalnum() else "_" for c in name)))
+            profiler.dump_stats(profile_file)
+            entry["profile"] = profile_file
+        print("*END {0}* ({1:.2f} s)".format(name, wall), flush=True)
+
+
+def format_command(cmd):
+    return cmd if isinstance(cmd, str) else " ".join(cmd)
+
+
+def exit_status(status):
+    # exit code of a wait status, negative signal number when the command was killed
+    return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+
+def start_command(cmd, **popen_args):
+    """
+    Start an external command (a string runs in bash) in its own session, through the usage wrapper. Return its Popen
+    and the file descriptor its usage is read from (see record_usage).
+    """
+    argv = ["/bin/bash", "-c", cmd] if isinstance(cmd, str) else list(cmd)
+    usage_fd, write_fd = os.pipe()
+    try:
+        process = Popen(USAGE_WRAPPER + [str(write_fd)] + argv, pass_fds=(write_fd,), start_new_session=True,
+                        **popen_args)
+    except BaseException:
+        os.close(usage_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    track_command(process)
+    return process, usage_fd
+
+
+def record_usage(entry, usage_fd, usage):
+    """
+    Add the CPU time, peak RSS and block I/O of a command, reported by the usage wrapper, to its manifest entry. When
+    the wrapper was killed with the command, the CPU time and I/O of usage (the rusage of os.wait4) are recorded
+    instead, without peak RSS: a process forked from the run shares its peak RSS.
+    """
+    with os.fdopen(usage_fd, "rb") as usage_f:
+        report = usage_f.read().split()
+    if len(report) == 5:
+        user, system = float(report[0]), float(report[1])
+        entry["max_rss_kb"], blocks_in, blocks_out = map(int, report[2:])
+    else:
+        user, system, blocks_in, blocks_out = usage.ru_utime, usage.ru_stime, usage.ru_inblock, usage.ru_oublock
+    entry["user_s"] = round(user, 3)
+    entry["sys_s"] = round(system, 3)
+    entry["read_bytes"] = blocks_in * BLOCK_SIZE
+    entry["write_bytes"] = blocks_out * BLOCK_SIZE
+    return entry
+
+
+@contextmanager
+def command(cmd, check=True, **popen_args):
+    """
+    Start an external command (a string runs in a shell) and yield its Popen, then wait for it and record its wall
+    time, CPU time, peak RSS, block I/O and exit status. A failing command ends the run when check is set. The
+    command runs in its own session, stopped with the run (see stop_run) or when the body raises.
+    """
+    check_stop()
+    entry = OrderedDict([("command", format_command(cmd)), ("stage", MANIFEST.current_stage())])
+    start = time.time()
+    process, usage_fd = start_command(cmd, **popen_args)
+    try:
+        yield process
+    except BaseException:
+        # outside of the terminal process group, an interrupt does not reach the command
+        signal_groups([process.pid], signal.SIGTERM)
+        raise
+    finally:
+        if process.stdout:
+            process.stdout.close()
+        _, status, usage = os.wait4(process.pid, 0)
+        untrack_command(process)
+        process.returncode = exit_status(status)
+        entry["wall_s"] = round(time.time() - start, 3)
+        record_usage(entry, usage_fd, usage)
+        entry["exit_status"] = process.returncode
+        MANIFEST.commands.append(entry)
+    check_stop()
+    if check and process.returncode != 0:
+        fail("\nCommand failed (exit code {0}): {1}\n".format(process.returncode, entry["command"]))
+
+
+def run_command(cmd, log_file=None, check=True):
+    """
+    Run an external command and return its output (stdout and stderr). The output is written to log_file, after the
+    command line, instead of being printed.
+    """
+    with command(cmd, check=False, stdout=PIPE, stderr=STDOUT) as process:
+        output = process.stdout.read().decode("utf-8", "replace")
+    if log_file:
+        with open(log_file, "w") as log_f:
+            log_f.write("Command line executed: {0}\n\n\n{1}".format(format_command(cmd), output))
+        MANIFEST.commands[-1]["log"] = log_file
+    if check and process.returncode != 0:
+        fail("\nCommand failed (exit code {0}): {1}\n{2}\n".format(process.returncode, format_command(cmd),
+                                                                  "See {0}".format(log_file) if log_file else output))
+    return output
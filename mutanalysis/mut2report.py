@@ -13,107 +13,88 @@ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
 details. You should have received a copy of the GNU General Public License along with CGST. If
 not, see <http://www.gnu.org/licenses/>.
 """
-import csv
 import os
-import re
-from csv import DictReader
 
-from Bio.Seq import Seq
+from mutanalysis.codon import decode_codon
+from mutanalysis.results import write_rows
 
 
-def report(work_dir, mutation, gene_name):
+def combinatorial_codons(count_table):
+    """
+    Expand every combination of the non-zero A/C/G/T depths of the three codon positions, the support of a codon
+    being the minimum depth of its bases. Return the candidate codons and the mean depth of the codon.
+    """
+    combinaison_dict = {}
+    depth = count = 0
+    for row in count_table.to_dict("records"):
+        combinaison_tmp_dict = {}
+        depth += int(row["total_depth"])
+        for base in "ACGT":
+            base_depth = int(row["{0}_depth".format(base)])
+            if base_depth == 0:
+                continue
+            if count == 0:
+                combinaison_dict[base] = base_depth
+            else:
+                for comb, depth_l in combinaison_dict.items():
+                    if len(comb) == count:
+                        combinaison_tmp_dict[comb + base] = min(depth_l, base_depth)
+        if count != 0:
+            combinaison_dict = combinaison_tmp_dict
+        count += 1
+    return combinaison_dict, int(depth/3)
+
+
+def phased_codons(histogram):
+    """
+    Return the codons carried by the reads from a 64-bin codon histogram and the number of reads spanning the codon.
+    """
+    combinaison_dict = {}
+    for code, depth in enumerate(histogram):
+        if depth:
+            combinaison_dict[decode_codon(code)] = depth
+    return combinaison_dict, sum(histogram)
+
+
+def site_rows(site, count_table=None, codon_histogram=None, sample=""):
+    """
+    Return the result rows of the codons found at a catalogue site (see catalogue.compile_catalogue) with their
+    susceptible/resistant call, by decreasing depth.
+    """
     threshold_view_mut = 10
 
-    final_result = os.path.join(work_dir, "final_result.tsv")
+    if codon_histogram is not None:
+        combinaison_dict, median_ref_depth = phased_codons(codon_histogram)
+    elif count_table is not None:
+        combinaison_dict, median_ref_depth = combinatorial_codons(count_table)
+    else:
+        return []
 
     combinaison_final_dict = {}
+    if median_ref_depth:
+        for comb, depth in combinaison_dict.items():
+            if (depth/median_ref_depth)*100 >= threshold_view_mut:
+                combinaison_final_dict[comb] = depth
+
+    rows = []
+    susceptible_codons = set(site["susceptible_codons"])
+    resistant_codons = set(site["resistant_codons"])
+    for comb, depth in sorted(combinaison_final_dict.items(), key=lambda x: -x[1]):
+        if comb in susceptible_codons:
+            resu_type = "Sensible"
+        elif comb in resistant_codons:
+            resu_type = "Resistant"
+        else:
+            resu_type = "X"
+        ratio = int((depth/median_ref_depth)*100)
+        rows.append([sample, site["feature"], site["mutation"], median_ref_depth, comb, depth, ratio,
+                     "{0}(depth:{1};ratio{2}%)".format(comb, depth, ratio), resu_type])
+    return rows
 
-    for file in os.listdir(work_dir):
-        if "_count.csv" in file:
-            path = os.path.join(work_dir, file)
 
-            with open(path, "r") as file_r:
-                reader = DictReader(file_r, delimiter="\t")
-                combinaison_ref = ""
-                combinaison_dict = {}
-                depth = count = 0
-                for row in reader:
-                    combinaison_tmp_dict = {}
-                    combinaison_ref += row["reference"]
-                    depth += int(row["total_depth"])
-                    if int(row["A_depth"]) != 0:
-                        if count == 0:
-                            combinaison_dict["A"] = int(row["A_depth"])
-                        else:
-                            for comb, depth_l in combinaison_dict.items():
-                                if len(comb) == count:
-                                    comb = comb + "A"
-                                    if int(row["A_depth"]) >= depth_l:
-                                        pass
-                                    else:
-                                        depth_l = int(row["A_depth"])
-                                    combinaison_tmp_dict[comb] = depth_l
-                    if int(row["C_depth"]) != 0:
-                        if count == 0:
-                            combinaison_dict["C"] = int(row["C_depth"])
-                        else:
-                            for comb, depth_l in combinaison_dict.items():
-                                if len(comb) == count:
-                                    comb = comb + "C"
-                                    if int(row["C_depth"]) >= depth_l:
-                                        pass
-                                    else:
-                                        depth_l = int(row["C_depth"])
-                                    combinaison_tmp_dict[comb] = depth_l
-                    if int(row["G_depth"]) != 0:
-                        if count == 0:
-                            combinaison_dict["G"] = int(row["G_depth"])
-                        else:
-                            for comb, depth_l in combinaison_dict.items():
-                                if len(comb) == count:
-                                    comb = comb + "G"
-                                    if int(row["G_depth"]) >= depth_l:
-                                        pass
-                                    else:
-                                        depth_l = int(row["G_depth"])
-                                    combinaison_tmp_dict[comb] = depth_l
-                    if int(row["T_depth"]) != 0:
-                        if count == 0:
-                            combinaison_dict["T"] = int(row["T_depth"])
-                        else:
-                            for comb, depth_l in combinaison_dict.items():
-                                if len(comb) == count:
-                                    comb = comb + "T"
-                                    if int(row["T_depth"]) >= depth_l:
-                                        pass
-                                    else:
-                                        depth_l = int(row["T_depth"])
-                                    combinaison_tmp_dict[comb] = depth_l
-                    if count != 0:
-                        combinaison_dict = combinaison_tmp_dict
-                    count += 1
-                combinaison_final_dict = {}
-                median_ref_depth = int(depth/3)
-                for comb, depth in combinaison_dict.items():
-                    if (depth/median_ref_depth)*100 >= threshold_view_mut:
-                        combinaison_final_dict[comb] = depth
-                    else:
-                        continue
-    if combinaison_final_dict:
-        with open(final_result, "w") as output:
-            writer = csv.writer(output, delimiter="\t")
-            writer.writerow(["Gene", "Mutation", "Mean Depth", "Result", "Sensible/Resistant"])
-            for comb, depth in combinaison_final_dict.items():
-                pattern = re.compile('([a-zA-Z_-]+)*([0-9]*)([a-zA-Z_-]+)')
-                match = pattern.match(mutation)
-                if match:
-                    acide_s = match.groups()[0]
-                    acide_r = match.groups()[2]
-                dna = Seq(comb)
-                if dna.translate(table=11) == acide_s:
-                    resu_type = "Sensible"
-                elif dna.translate(table=11) == acide_r:
-                    resu_type = "Resistant"
-                else:
-                    resu_type = "X"
-                writer.writerow([gene_name, mutation, median_ref_depth, "{0}(depth:{1};ratio{2}%)".format(comb, depth, int((depth/median_ref_depth)*100)), resu_type])
+def report(work_dir, rows, formats=("tsv",), html=False):
+    """
+    Write the result rows of every site of a sample once: final_result.tsv, its columnar copies and its HTML page
+    when they are requested.
+    """
+    return write_rows(rows, os.path.join(work_dir, "final_result"), formats, html)
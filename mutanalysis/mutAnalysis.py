@@ -14,30 +14,63 @@ details. You should have received a copy of the GNU General Public License along
 not, see <http://www.gnu.org/licenses/>.
 """
 import argparse
+import importlib
 import os
-import re
-import shutil
+import sys
+import time
+from collections import OrderedDict
 
-from mutanalysis import mapping, bam2count, mut2report
-from mutanalysis.utils import read_mutation_database
+from mutanalysis import index_cache, metrics, resources
+from mutanalysis.metrics import timed_stage
+from mutanalysis.stagecache import StageCache
+from mutanalysis.utils import rename_reference
 
 
-def main(args):
+def prepare_reference(wk_dir, index_cache_dir=None, force=False, cache=None):
+    """
+    Load the compiled catalogue, write the renamed reference to the work directory and get its BWA index.
+    """
+    from mutanalysis import catalogue, mapping
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    mut_catalogue = catalogue.load_catalogue(os.path.join(dir_path, "database", "mutations.tsv"),
+                                             os.path.join(dir_path, "database", "sequences.fasta"))
+    sequence_file = rename_reference(os.path.join(dir_path, "database", "sequences.fasta"),
+                                     os.path.join(wk_dir, "sequence.fasta"))
+    index_file = mapping.index_bwa(sequence_file, wk_dir, force, index_cache_dir, cache)
+    return {"catalogue": mut_catalogue, "sequence_file": sequence_file, "index_file": index_file}
+
+
+def main(args, reference=None):
+    """
+    Run the pipeline on a sample. reference is the prepared reference of a long-running process (see
+    prepare_reference), prepared in the work directory when it is not given.
+    """
+    # the pipeline modules (pandas, numpy, asyncio) are imported for a run only, not for -V, --help or subcommands
+    from mutanalysis import aligned, bam2count, catalogue, codon, depthcap, mapping, mut2report, prefilter, runner, \
+        store
 
     print("Version mutanalysis: ", version())
 
-    reads_1 = os.path.abspath(args.reads_1)
-    reads_2 = os.path.abspath(args.reads_2)
+    reads_1 = os.path.abspath(args.reads_1) if args.reads_1 else ''
+    reads_2 = os.path.abspath(args.reads_2) if args.reads_2 else ''
+    bam_file = os.path.abspath(args.bam) if args.bam else ''
+    bam_reference = os.path.abspath(args.bam_reference) if args.bam_reference else ''
     wk_dir = os.path.abspath(args.workDir)
     initial = args.initial
     force = args.force
+    index_cache_dir = None if args.no_index_cache else os.path.abspath(args.index_cache)
 
-    if not reads_1:
+    if bam_file and not bam_reference:
+        print("Reference of the aligned input is missing (--bam-reference) !\n", flush=True)
+        print(usage, flush=True)
+        exit(1)
+
+    if not bam_file and not reads_1:
         print("Reads R1 file is missing !\n", flush=True)
         print(usage, flush=True)
         exit(1)
 
-    if not reads_2:
+    if not bam_file and not reads_2:
         print("Reads R1 file is missing !\n", flush=True)
         print(usage, flush=True)
         exit(1)
@@ -54,92 +87,276 @@ def main(args):
 
     dir_path = os.path.dirname(os.path.realpath(__file__))
 
-    mutation_database = os.path.join(dir_path, "database", "mutations.tsv")
-    sequence_file = os.path.join(dir_path, "database", "sequences.fasta")
-
     if not os.path.exists(wk_dir):
         os.makedirs(wk_dir)
 
+    # threads, sort memory and concurrency derived from the cgroup limits, unless given
+    plan = resources.plan_resources(args.cpus, resources.parse_size(args.memory) if args.memory else None,
+                                    args.threads, args.sort_threads,
+                                    resources.parse_size(args.sort_memory) if args.sort_memory else None, args.jobs)
+    threads, jobs = plan["threads"], plan["jobs"]
+
+    # external commands of a stage run concurrently, at most jobs at a time, the commands without a log of their own
+    # write it to <wkDir>/logs
+    runner.configure(jobs, args.command_timeout, os.path.join(wk_dir, "logs"))
+
+    # a stage only runs again when its inputs, parameters or tools changed (every stage with --force)
+    cache = StageCache(wk_dir, force)
+
+    # every stage and external command is recorded in the run manifest
+    metrics.start_run(os.path.join(wk_dir, "run_manifest.json"),
+                      profile_dir=os.path.join(wk_dir, "profile") if args.profile else None,
+                      version=version(), **(OrderedDict([("bam", bam_file), ("bam_reference", bam_reference)])
+                                             if bam_file else OrderedDict([("reads_1", reads_1),
+                                                                           ("reads_2", reads_2)])),
+                      work_dir=wk_dir, resources=plan)
+
     # print folders/files path
-    print("Reads R1 File: {0}".format(reads_1), flush=True)
-    print("Reads R2 File: {0}".format(reads_2), flush=True)
+    if bam_file:
+        print("Aligned input: {0} (reference: {1})".format(bam_file, bam_reference), flush=True)
+        print("Feature map: {0}".format(args.feature_map or "liftover by exact match"), flush=True)
+    else:
+        print("Reads R1 File: {0}".format(reads_1), flush=True)
+        print("Reads R2 File: {0}".format(reads_2), flush=True)
     print("Work directory: {0}".format(wk_dir), flush=True)
     print("Initial user: {0}".format(initial), flush=True)
     print("Force: {0}".format(force), flush=True)
+    print("Resources: {0}".format(resources.describe(plan)), flush=True)
+    print("Command timeout: {0}".format(args.command_timeout or "none"), flush=True)
+    print("Mapping mode: {0}".format(args.mapping_mode), flush=True)
+    print("Unmapped reads: {0}".format(args.unmapped), flush=True)
+    print("Index cache: {0}".format(index_cache_dir), flush=True)
+    print("Counter: {0}".format(args.counter), flush=True)
+    print("Codon mode: {0}".format(args.codon_mode), flush=True)
+    print("Prefilter: {0}".format(args.prefilter), flush=True)
+    print("Depth cap: {0} (read budget: {1}, subsample: {2}, seed: {3})".format(args.depth_cap, args.read_budget,
+                                                                               args.subsample, args.seed), flush=True)
+    print("Write count files: {0} (HTML: {1})".format(args.write_counts, args.html), flush=True)
+    print("Result formats: {0}".format(", ".join(args.result_format)), flush=True)
+    print("Results store: {0}".format(os.path.abspath(args.store) if args.store else "none"), flush=True)
+    print("Profile: {0}".format(args.profile), flush=True)
     print("Application run at : {0}\n".format(dir_path), flush=True)
 
     #########################################
+    # Plan: prepare the reference once, align the sample once, then count and report every mutation on the same BAM
 
-    mut_dict = read_mutation_database(mutation_database)
-
-    ##################
-
-    sequence_new_tmp_file = os.path.join(wk_dir, "sequence_tmp.fasta")
-    sequence_new_file = os.path.join(wk_dir, "sequence.fasta")
-    shutil.copy(sequence_file, sequence_new_tmp_file)
-    # rename
-    with open(sequence_new_tmp_file, "r") as file:
-        with open(sequence_new_file, "w") as out_file:
-            for line in file.readlines():
-                if ">" in line:
-                    line = line.replace(':', '_').replace('(', '').replace(')', '').replace('\'', 'pr').replace('-', '')
-                    out_file.write(line)
-                else:
-                    out_file.write(line)
-    os.remove(sequence_new_tmp_file)
-    sequence_file = sequence_new_file
-
-
-    #######################################
-
-    for feature_name, mutation_dict in mut_dict.items():
-
-        print("FEATURE : {0}".format(feature_name), flush=True)
-
-        feature_name = feature_name.replace(':', '_').replace('(', '').replace(')', '').replace('\'', 'pr').replace('-', '')
-
-        print("FEATURE corrected : {0}".format(feature_name), flush=True)
-
+    print("\n-----------------", flush=True)
+    print("PREPARE REFERENCE", flush=True)
+    print("-----------------", flush=True)
+    with timed_stage("Prepare reference"):
+        if reference is not None:
+            print("Reference already prepared: {0}".format(reference["sequence_file"]), flush=True)
+        elif bam_file:
+            # the alignment comes with its own reference, no BWA index to build
+            reference = {"catalogue": catalogue.load_catalogue(), "sequence_file": None, "index_file": None}
+        else:
+            reference = prepare_reference(wk_dir, index_cache_dir, force, cache)
+        mut_catalogue = reference["catalogue"]
+        sequence_file = reference["sequence_file"]
+        index_file = reference["index_file"]
+        print("Catalogue {0}: {1} features, {2} sites".format(mut_catalogue["hash"][:16],
+                                                             len(mut_catalogue["features"]),
+                                                             len(mut_catalogue["sites"])), flush=True)
+        sites = OrderedDict(((site["feature"], site["mutation"]), site) for site in mut_catalogue["sites"])
+        regions = OrderedDict((key, (site["feature"], site["position"])) for key, site in sites.items())
+        codons = OrderedDict((key, (site["feature"], site["start"])) for key, site in sites.items())
+        placed = OrderedDict()
+
+        if bam_file:
+            # codons placed on the reference of the alignment, counted by index region queries
+            sequence_file = aligned.local_reference(bam_reference, wk_dir)
+            aligned.check_alignment(bam_file, sequence_file)
+            if args.feature_map:
+                features = aligned.read_feature_map(args.feature_map)
+            else:
+                features = aligned.liftover(mut_catalogue, bam_reference)
+            placed = aligned.genome_sites(sites, features)
+            regions = OrderedDict((key, (sites[key]["feature"], "{0}:{1}-{2}".format(
+                ctg, start, start + sites[key]["end"] - sites[key]["start"]))) for key, (ctg, start, strand)
+                in placed.items())
+            codons = OrderedDict((key, (ctg, start)) for key, (ctg, start, strand) in placed.items())
+            print("{0} features placed on {1}".format(len(features), bam_reference), flush=True)
+
+    depth_capped = False
+    if bam_file:
         print("\n-----------------", flush=True)
-        print("MAPPING READS ON SEQUENCES", flush=True)
+        print("PRE-ALIGNED INPUT, MAPPING SKIPPED", flush=True)
         print("-----------------", flush=True)
-        # Mapping
-        mapping.main(sequence_file, reads_1, reads_2, wk_dir)
-
+        if args.prefilter or args.depth_cap or args.read_budget or args.subsample < 1:
+            print("WARNING: prefilter and depth cap only apply to reads, ignored with --bam", flush=True)
+    else:
         print("\n-----------------", flush=True)
-        print("COUNT MUTATION ON ALIGNEMENT", flush=True)
+        print("MAPPING READS ON SEQUENCES", flush=True)
         print("-----------------", flush=True)
+        if args.prefilter:
+            prefilter_start = time.time()
+            with timed_stage("Prefilter reads"):
+                key = cache.key("prefilter", [reads_1, reads_2, sequence_file],
+                                {"k": args.prefilter_k, "min_hits": args.prefilter_min_hits})
+                # the evaluation needs the names of the kept reads, only known when the prefilter runs
+                if not args.prefilter_eval and cache.fresh("prefilter", key):
+                    filtered_1 = os.path.join(wk_dir, "prefilter_R1.fastq")
+                    filtered_2 = os.path.join(wk_dir, "prefilter_R2.fastq")
+                    prefilter_counters, kept_names = cache.info("prefilter"), None
+                else:
+                    filtered_1, filtered_2, prefilter_counters, kept_names = prefilter.filter_reads(
+                        sequence_file, reads_1, reads_2, wk_dir, k=args.prefilter_k, min_hits=args.prefilter_min_hits,
+                        threads=threads)
+                    cache.record("prefilter", key, [filtered_1, filtered_2], prefilter_counters)
+            print("Prefilter: {0} of {1} read pairs kept ({2}%)".format(prefilter_counters["kept_pairs"],
+                                                                       prefilter_counters["read_pairs"],
+                                                                       prefilter_counters["kept_percent"]), flush=True)
+        else:
+            filtered_1, filtered_2 = reads_1, reads_2
+
+        depth_capped = args.depth_cap or args.read_budget or args.subsample < 1
+        if depth_capped:
+            with timed_stage("Depth-capped read consumption"):
+                # the targeted codons follow the catalogue, the chunks aligned by bwa mem the threads
+                key = cache.key("depthcap", [filtered_1, filtered_2, sequence_file],
+                                {"codons": list(codons.values()), "depth_cap": args.depth_cap,
+                                 "read_budget": args.read_budget, "seed": args.seed, "subsample": args.subsample,
+                                 "threads": threads}, ["bwa"])
+                if cache.fresh("depthcap", key):
+                    filtered_1 = os.path.join(wk_dir, "depthcap_R1.fastq")
+                    filtered_2 = os.path.join(wk_dir, "depthcap_R2.fastq")
+                    depthcap_report = cache.info("depthcap")
+                else:
+                    filtered_1, filtered_2, depthcap_report = depthcap.cap_reads(
+                        index_file, filtered_1, filtered_2, wk_dir, codons, target_depth=args.depth_cap,
+                        max_pairs=args.read_budget, seed=args.seed, fraction=args.subsample, threads=threads)
+                    cache.record("depthcap", key, [filtered_1, filtered_2], depthcap_report)
+            print("Depth cap: {0} of {1} read pairs kept ({2})".format(depthcap_report["kept_pairs"],
+                                                                     depthcap_report["read_pairs"],
+                                                                     depthcap_report["stop"]), flush=True)
+            if depthcap_report.get("under_target"):
+                print("Depth cap: under {0} reads: {1}".format(
+                    args.depth_cap, ", ".join(site.replace("\t", " ") for site in depthcap_report["under_target"])),
+                    flush=True)
+
+        # the chunks aligned by the depth cap are the alignment of the kept pairs (gone when the depth cap was cached)
+        chunk_alignment = depthcap_report.get("alignment") if depth_capped else None
+        if chunk_alignment and not os.path.exists(chunk_alignment):
+            chunk_alignment = None
+        with timed_stage("Mapping"):
+            mapping.main(sequence_file, filtered_1, filtered_2, wk_dir, force, threads=threads,
+                         stream=args.mapping_mode == "stream", unmapped=args.unmapped, index_file=index_file,
+                         cache=cache, sort_threads=plan["sort_threads"], sort_memory=plan["sort_memory"],
+                         sam_file=chunk_alignment)
+
+        if args.prefilter:
+            filtered_time = time.time() - prefilter_start
+            unfiltered_bam = unfiltered_time = None
+            if args.prefilter_eval:
+                # align every read as well to measure the recall and the speed-up of the prefilter
+                eval_dir = os.path.join(wk_dir, "prefilter_eval")
+                if not os.path.exists(eval_dir):
+                    os.makedirs(eval_dir)
+                unfiltered_start = time.time()
+                with timed_stage("Mapping without prefilter"):
+                    unfiltered_bam = mapping.main(sequence_file, reads_1, reads_2, eval_dir, force=True,
+                                                  threads=threads, stream=args.mapping_mode == "stream",
+                                                  unmapped="skip", index_file=index_file,
+                                                  sort_threads=plan["sort_threads"], sort_memory=plan["sort_memory"])
+                unfiltered_time = time.time() - unfiltered_start
+            prefilter_report = prefilter.write_report(os.path.join(wk_dir, "prefilter_report.json"), prefilter_counters,
+                                                      kept_names, unfiltered_bam, filtered_time, unfiltered_time)
+            if "recall" in prefilter_report:
+                print("Prefilter recall: {0}, speed-up: {1}".format(prefilter_report["recall"],
+                                                                   prefilter_report.get("speedup")), flush=True)
 
-        for mut_prot in mutation_dict["proteic"]:
-            pattern = re.compile('([a-zA-Z_-]+)*([0-9]*)([a-zA-Z_-]+)')
-            match = pattern.match(mut_prot)
-            if match:
-                pos_mutation = int(match.groups()[1])
-            # Count
-            position = "{0}:{1}-{2}".format(feature_name, (pos_mutation*3)-2, (pos_mutation*3))
-            bam2count.main(wk_dir, sequence_file, position, feature_name)
+    print("\n-----------------", flush=True)
+    print("COUNT MUTATIONS ON ALIGNEMENT", flush=True)
+    print("-----------------", flush=True)
+    alignment_file = bam_file or os.path.join(wk_dir, "sequence.bam")
+    with timed_stage("Count"):
+        # a single counting pass for every codon of the catalogue
+        counts = bam2count.main(wk_dir, sequence_file, regions, stats=args.write_counts, data=args.write_counts,
+                                html=args.html, backend=args.counter, cache=cache, jobs=jobs,
+                                bam_file=alignment_file)
+
+    histograms = {}
+    if args.codon_mode == "phased":
+        with timed_stage("Count codons carried by reads"):
+            # a whole-genome alignment is read window by window through its index
+            histograms = codon.count_codons(alignment_file, codons, "pysam" if args.counter == "pysam" else "samtools",
+                                            reference=sequence_file if bam_file else None, random_access=bool(bam_file))
+
+    # counts of the aligned input back to the strand and coordinates of the features
+    for key, (ctg, start, strand) in placed.items():
+        if key in counts:
+            counts[key] = aligned.orient_table(counts[key], sites[key], start, strand)
+        if key in histograms:
+            histograms[key] = aligned.orient_histogram(histograms[key], strand)
 
-            print("\n-----------------", flush=True)
-            print("REPORTING MUTATION ANALYSIS", flush=True)
-            print("-----------------", flush=True)
+    print("\n-----------------", flush=True)
+    print("REPORTING MUTATION ANALYSIS", flush=True)
+    print("-----------------", flush=True)
+    with timed_stage("Report"):
+        # one table for every mutation of the sample, written once
+        rows = []
+        for key, count_table in counts.items():
+            rows.extend(mut2report.site_rows(sites[key], count_table, histograms.get(key), os.path.basename(wk_dir)))
+        for out_file in mut2report.report(wk_dir, rows, args.result_format, args.html):
+            print("Result table: {0}".format(out_file), flush=True)
+
+        if depth_capped:
+            # depth reached on the final alignment, as used by the report
+            achieved_depth = OrderedDict()
+            for key, count_table in counts.items():
+                if key in histograms:
+                    achieved_depth[key] = mut2report.phased_codons(histograms[key])[1]
+                else:
+                    achieved_depth[key] = mut2report.combinatorial_codons(count_table)[1]
+                print("Achieved depth {0} {1}: {2}".format(key[0], key[1], achieved_depth[key]), flush=True)
+            depthcap.write_report(os.path.join(wk_dir, "depthcap_report.json"), depthcap_report, achieved_depth)
 
-            mut2report.report(wk_dir, mut_prot, feature_name)
+    if args.store:
+        with timed_stage("Store"):
+            # the calls, codon counts and depth statistics of the sample replace its previous ones in one transaction
+            record = store.run_record(os.path.basename(wk_dir), wk_dir, version(), sites, counts, histograms, rows)
+            store.ingest_record(os.path.abspath(args.store), record)
+            print("Results store: {0}".format(os.path.abspath(args.store)), flush=True)
 
     print("\n-----------------", flush=True)
     print("FINISH", flush=True)
     print("-----------------", flush=True)
+    print("Run manifest: {0}".format(metrics.finish_run()), flush=True)
 
 
 def version():
     return "1.0.1"
 
 
-def run():
-    global usage
-
-    usage = "mutanalysis [-1 fastq_R1_.fastq] [-2 fastq_R2_.fastq] [-wd work directory] [-i " \
-            "initial of the user] <-F Overwrite output directory (Default=False)> "
-
+usage = "mutanalysis [-1 fastq_R1_.fastq] [-2 fastq_R2_.fastq] [-wd work directory] [-i " \
+        "initial of the user] <-f Run every stage again>\n" \
+        "       mutanalysis [--bam aligned.bam] [--bam-reference reference.fasta] <--feature-map map.tsv> " \
+        "[-wd work directory] [-i initial of the user]\n" \
+        "       mutanalysis warm-index [-r reference.fasta] [--index-cache directory]\n" \
+        "       mutanalysis batch [-s sample sheet] [-wd work directory] [-i initial of the user] [--cores N]\n" \
+        "       mutanalysis catalogue [-m mutations.tsv] [-s sequences.fasta]\n" \
+        "       mutanalysis merge [-o cohort prefix] [sample work directories]\n" \
+        "       mutanalysis html [work directories or tables]\n" \
+        "       mutanalysis daemon {start,health,submit,job,stop} [--spool directory]\n" \
+        "       mutanalysis queue {init,work,status} [-q queue directory] <-s sample sheet -wd work directory " \
+        "-i initial of the user>\n" \
+        "       mutanalysis store {ingest,query,export} [-d store.db] <work directories> <--gene --mutation " \
+        "--call --min-ratio>"
+
+# subcommand name -> module exposing a run(argv) function, imported only when used
+SUBCOMMANDS = {
+    "warm-index": "mutanalysis.index_cache",
+    "batch": "mutanalysis.batch",
+    "catalogue": "mutanalysis.catalogue",
+    "merge": "mutanalysis.results",
+    "html": "mutanalysis.render",
+    "daemon": "mutanalysis.daemon",
+    "queue": "mutanalysis.workqueue",
+    "store": "mutanalysis.store",
+}
+
+
+def build_parser():
     parser = argparse.ArgumentParser(
         prog='mutanalysis',
         usage=usage,
@@ -148,19 +365,100 @@ def run():
 
     parser.add_argument('-1', '--R1', dest="reads_1", default='', help="Reads file R1")
     parser.add_argument('-2', '--R2', dest="reads_2", default='', help="Reads file R2")
+    parser.add_argument('--bam', dest="bam", default='',
+                        help="Coordinate-sorted and indexed BAM or CRAM already aligned, counted instead of reads")
+    parser.add_argument('--bam-reference', dest="bam_reference", default='',
+                        help="FASTA reference of --bam, also decodes CRAM without network access")
+    parser.add_argument('--feature-map', dest="feature_map", default='',
+                        help="Tab separated feature, contig, start, end, strand of the catalogue features on "
+                             "--bam-reference (Default: found by exact sequence match)")
     parser.add_argument('-wd', '--wkDir', dest="workDir", default='',
                         help="Working directory")
     parser.add_argument('-i', '--initial', dest="initial", default='',
                         help="Initial of user")
-    parser.add_argument('-f', '--force', dest="force", default='False',
-                        help="Overwrite output directory")
+    parser.add_argument('-f', '--force', dest="force", action="store_true",
+                        help="Run every stage again, even when its inputs, parameters and tools did not change")
+    parser.add_argument('--cpus', dest="cpus", type=int, default=0,
+                        help="Number of CPUs of the run (Default=CPU quota of the cgroup, or CPUs of the host)")
+    parser.add_argument('--memory', dest="memory", default='',
+                        help="Memory of the run, e.g. 8G (Default=memory limit of the cgroup, or memory of the host)")
+    parser.add_argument('-t', '--threads', dest="threads", type=int, default=0,
+                        help="Number of threads of the aligner (Default=number of CPUs)")
+    parser.add_argument('--sort-threads', dest="sort_threads", type=int, default=0,
+                        help="Number of threads of samtools sort (Default=number of CPUs, fewer when the memory is "
+                             "short)")
+    parser.add_argument('--sort-memory', dest="sort_memory", default='',
+                        help="Memory per samtools sort thread, e.g. 768M (Default=half of the memory shared by the "
+                             "sort threads, at most 1G)")
+    parser.add_argument('--jobs', dest="jobs", type=int, default=0,
+                        help="Maximum number of external commands run concurrently (Default=number of CPUs, fewer "
+                             "when the memory is short)")
+    parser.add_argument('--command-timeout', dest="command_timeout", type=float, default=0,
+                        help="Stop the run when an external command takes longer, in seconds (Default=0, no "
+                             "timeout)")
+    parser.add_argument('--mapping-mode', dest="mapping_mode", default="stream", choices=["stream", "legacy"],
+                        help="stream: pipe bwa mem into samtools in one pass; legacy: write SAM/BAM intermediates "
+                             "(Default=stream)")
+    parser.add_argument('--unmapped', dest="unmapped", default="split", choices=["split", "skip"],
+                        help="Write unmapped reads to a FASTQ (split) or drop them (skip) (Default=split)")
+    parser.add_argument('--index-cache', dest="index_cache", default=index_cache.default_cache_dir(),
+                        help="Shared BWA index cache directory (Default=$MUTANALYSIS_INDEX_CACHE or "
+                             "~/.cache/mutanalysis/bwa_index)")
+    parser.add_argument('--no-index-cache', dest="no_index_cache", action="store_true",
+                        help="Build the BWA index inside the working directory instead of the shared cache")
+    parser.add_argument('--counter', dest="counter", default="bam-readcount", choices=["bam-readcount", "pysam"],
+                        help="Read counting backend: bam-readcount or the in-process pysam pileup "
+                             "(Default=bam-readcount)")
+    parser.add_argument('--codon-mode', dest="codon_mode", default="combinatorial",
+                        choices=["phased", "combinatorial"],
+                        help="combinatorial: combine the per-position base depths, as earlier releases; phased: count "
+                             "the codon carried by each read (Default=combinatorial)")
+    parser.add_argument('--prefilter', dest="prefilter", action="store_true",
+                        help="Only align the read pairs sharing k-mers with the reference sequences")
+    parser.add_argument('--prefilter-k', dest="prefilter_k", type=int, default=25,
+                        help="k-mer size of the prefilter (Default=25)")
+    parser.add_argument('--prefilter-min-hits', dest="prefilter_min_hits", type=int, default=2,
+                        help="Number of shared k-mers needed to keep a read pair (Default=2)")
+    parser.add_argument('--prefilter-eval', dest="prefilter_eval", action="store_true",
+                        help="Also align every read to report the recall and the speed-up of the prefilter")
+    parser.add_argument('--depth-cap', dest="depth_cap", type=int, default=0,
+                        help="Stop reading the FASTQ once every catalogued codon is carried by this number of reads "
+                             "(Default=0, read everything)")
+    parser.add_argument('--read-budget', dest="read_budget", type=int, default=0,
+                        help="Maximum number of read pairs to align (Default=0, no budget)")
+    parser.add_argument('--subsample', dest="subsample", type=float, default=1.0,
+                        help="Fraction of the read pairs kept by the seeded subsampling (Default=1.0)")
+    parser.add_argument('--seed', dest="seed", type=int, default=1,
+                        help="Seed of the subsampling (Default=1)")
+    parser.add_argument('--result-format', dest="result_format", nargs='+', default=["tsv"],
+                        choices=["tsv", "parquet", "arrow"],
+                        help="Formats of the result table, parquet and arrow need pyarrow (Default=tsv)")
+    parser.add_argument('--store', dest="store", default='',
+                        help="SQLite results store the calls, codon counts and depth statistics are added to")
+    parser.add_argument('--profile', dest="profile", action="store_true",
+                        help="Write cProfile data of the Python stages to <work directory>/profile")
+    parser.add_argument('--write-counts', dest="write_counts", action="store_true",
+                        help="Write the per-region count and depth statistics CSV files")
+    parser.add_argument('--html', dest="html", action="store_true",
+                        help="Also render the count and statistics files as HTML (with --write-counts)")
     parser.add_argument('-v', '--verbose', dest="verbose", default="0",
                         help="log process to file. Options are 0 or 1  (default = 0 for no logging)")
     parser.add_argument('-V', '--version', action='version', version='mutanalysis-' + version(),
                         help="Prints version number")
+    return parser
 
-    args = parser.parse_args()
-    main(args)
+
+def run():
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        importlib.import_module(SUBCOMMANDS[sys.argv[1]]).run(sys.argv[2:])
+        return
+
+    args = build_parser().parse_args()
+    try:
+        main(args)
+    except (Exception, SystemExit):
+        metrics.finish_run("failed")
+        raise
 
 
 if __name__ == '__main__':
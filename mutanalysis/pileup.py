@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+In-process read counting on an indexed BAM, an alternative to bam-readcount.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+BASES = ['A', 'C', 'G', 'T', 'N']
+BASE_INDEX = {base: i for i, base in enumerate(BASES)}
+
+# columns of the per-position arrays filled for each base
+COUNT, MAPQ_SUM, BASEQ_SUM, PLUS, MINUS = range(5)
+
+
+def check_pysam():
+    if pysam is None:
+        print("\nThe pysam counting backend needs pysam: pip install pysam\n")
+        exit(1)
+
+
+# regions of a contig closer than this share a pileup: skipping columns is cheaper than a new BAM seek per region
+WINDOW_GAP = 1000
+
+
+def count_window(bam, ctg, regions, min_mapq=0, min_baseq=0):
+    """
+    Fill the per-position arrays of sorted, disjoint 1-based inclusive regions of a contig with a single pileup over
+    their span: depth[i] and data[i, base, field] with field in COUNT, MAPQ_SUM, BASEQ_SUM, PLUS, MINUS, the rows of
+    the regions following each other.
+    """
+    span_start, span_end = regions[0][0], regions[-1][1]
+    # row of each position of the span, -1 between the regions
+    rows = [-1] * (span_end - span_start + 1)
+    size = 0
+    for start, end in regions:
+        rows[start - span_start:end - span_start + 1] = range(size, size + end - start + 1)
+        size += end - start + 1
+    depth = np.zeros(size, dtype=np.int64)
+    data = np.zeros((size, len(BASES), 5), dtype=np.int64)
+
+    for column in bam.pileup(ctg, span_start - 1, span_end, truncate=True, stepper="samtools", ignore_overlaps=False,
+                             ignore_orphans=False, min_base_quality=0, min_mapping_quality=min_mapq,
+                             max_depth=10 ** 7, multiple_iterators=False):
+        i = rows[column.reference_pos - (span_start - 1)]
+        if i < 0:
+            continue
+        pileups = column.pileups
+        depth[i] = len(pileups)
+        counts = [[0] * 5 for _ in BASES]
+        for pileup_read in pileups:
+            if pileup_read.is_del or pileup_read.is_refskip:
+                continue
+            read = pileup_read.alignment
+            qpos = pileup_read.query_position
+            base_quality = read.query_qualities[qpos] if read.query_qualities is not None else 0
+            if base_quality < min_baseq:
+                continue
+            base_counts = counts[BASE_INDEX.get(read.query_sequence[qpos].upper(), BASE_INDEX['N'])]
+            base_counts[COUNT] += 1
+            base_counts[MAPQ_SUM] += read.mapping_quality
+            base_counts[BASEQ_SUM] += base_quality
+            base_counts[MINUS if read.is_reverse else PLUS] += 1
+        data[i] = counts
+    return depth, data
+
+
+def count_region(bam, ctg, start, end, min_mapq=0, min_baseq=0):
+    """
+    Fill the per-position arrays of a 1-based inclusive region (see count_window).
+    """
+    return count_window(bam, ctg, [(start, end)], min_mapq, min_baseq)
+
+
+def windows(regions):
+    """
+    Group consecutive (contig, start, end) regions into pileup windows: same contig, in order, disjoint and closer
+    than WINDOW_GAP.
+    """
+    window = []
+    for ctg, start, end in regions:
+        if window and (ctg != window[0][0] or start <= window[-1][2] or start - window[-1][2] > WINDOW_GAP):
+            yield window[0][0], [(s, e) for c, s, e in window]
+            window = []
+        window.append((ctg, start, end))
+    if window:
+        yield window[0][0], [(s, e) for c, s, e in window]
+
+
+def to_table(ctgs, positions, reference, depth, data):
+    """
+    Convert the per-position arrays of the counted regions (contig, 1-based position, reference base, depth and
+    data rows aligned) into a count table like bam2count.read_bam_count (covered positions only).
+    """
+    covered = np.nonzero(depth)[0]
+    table = OrderedDict([('ID', ctgs[covered]), ('position', positions[covered]),
+                         ('reference', reference[covered]), ('total_depth', depth[covered])])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for b, base in enumerate(BASES):
+            count = data[covered, b, COUNT]
+            table['{0}_depth'.format(base)] = count
+            table['{0}_quality'.format(base)] = np.round(np.where(count > 0, data[covered, b, BASEQ_SUM] / count, 0), 2)
+            table['{0}_mapq'.format(base)] = np.round(np.where(count > 0, data[covered, b, MAPQ_SUM] / count, 0), 2)
+            table['{0}_plus'.format(base)] = data[covered, b, PLUS]
+            table['{0}_minus'.format(base)] = data[covered, b, MINUS]
+    return pd.DataFrame(table)
+
+
+def count_regions(bam_file, fasta_ref, regions, min_mapq=0, min_baseq=0):
+    """
+    Count the (contig, start, end) regions of an indexed BAM, every contig when regions is empty. Nearby regions
+    share a pileup (see windows) and the arrays of every region are gathered into a single table.
+    """
+    check_pysam()
+    ctgs, positions, reference, depths, datas = [], [], [], [], []
+    # the reference also decodes CRAM input
+    with pysam.AlignmentFile(bam_file, "r", reference_filename=fasta_ref) as bam, pysam.FastaFile(fasta_ref) as fasta:
+        if not regions:
+            regions = [(ctg, 1, length) for ctg, length in zip(bam.references, bam.lengths)]
+        for ctg, window in windows(regions):
+            depth, data = count_window(bam, ctg, window, min_mapq, min_baseq)
+            ctgs.append(np.full(len(depth), ctg, dtype=object))
+            for start, end in window:
+                ref_seq = fasta.fetch(ctg, start - 1, end).upper()
+                positions.append(np.arange(start, end + 1))
+                reference.append(np.array(list(ref_seq.ljust(end - start + 1, 'N')), dtype=object))
+            depths.append(depth)
+            datas.append(data)
+    if not depths:
+        return to_table(*[np.array([], dtype=object)] * 3, np.zeros(0, dtype=np.int64),
+                        np.zeros((0, len(BASES), 5), dtype=np.int64))
+    return to_table(np.concatenate(ctgs), np.concatenate(positions), np.concatenate(reference),
+                    np.concatenate(depths), np.concatenate(datas))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+k-mer prefilter: keep only the read pairs sharing k-mers with the reference before the alignment.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import gzip
+import json
+import os
+import shutil
+import signal
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing import Pool
+from subprocess import PIPE
+
+from mutanalysis.metrics import command, fail
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+# k-mer set shared with the pool processes
+KMERS = set()
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def build_kmer_set(sequence_file, k=25):
+    """
+    Return the k-mers of both strands of every sequence of a FASTA file.
+    """
+    kmers = set()
+    sequences = []
+    with open(sequence_file, "r") as in_f:
+        for line in in_f:
+            if line.startswith(">"):
+                sequences.append([])
+            elif sequences:
+                sequences[-1].append(line.strip().upper())
+    for sequence in ("".join(seq) for seq in sequences):
+        for strand in (sequence, reverse_complement(sequence)):
+            for i in range(len(strand) - k + 1):
+                kmers.add(strand[i:i + k])
+    return kmers
+
+
+@contextmanager
+def open_fastq(fastq_file, threads=1):
+    """
+    Open a FASTQ, gzipped ones are decompressed by pigz (multi-threaded) when available.
+    """
+    if fastq_file.endswith(".gz") and shutil.which("pigz"):
+        cmd = ["pigz", "-dc", "-p", str(max(1, threads)), fastq_file]
+        with command(cmd, check=False, stdout=PIPE, universal_newlines=True, bufsize=1 << 20) as process:
+            yield process.stdout
+        # a reader stopping early closes the pipe
+        if process.returncode not in (0, -signal.SIGPIPE):
+            fail("\nCommand failed (exit code {0}): {1}\n".format(process.returncode, " ".join(cmd)))
+    else:
+        with (gzip.open(fastq_file, "rt") if fastq_file.endswith(".gz") else open(fastq_file, "r")) as in_f:
+            yield in_f
+
+
+def read_pairs(fastq_file1, fastq_file2, threads=1):
+    with open_fastq(fastq_file1, threads) as in_1, open_fastq(fastq_file2, threads) as in_2:
+        while True:
+            record_1 = [in_1.readline() for _ in range(4)]
+            record_2 = [in_2.readline() for _ in range(4)]
+            if not record_1[0] or not record_2[0]:
+                break
+            yield record_1, record_2
+
+
+def read_name(header):
+    name = header[1:].split()[0]
+    return name[:-2] if name.endswith(("/1", "/2")) else name
+
+
+def init_worker(kmers):
+    global KMERS
+    KMERS = kmers
+
+
+def kmer_hits(sequence, k, stride, min_hits):
+    hits = 0
+    for i in range(0, len(sequence) - k + 1, stride):
+        if sequence[i:i + k] in KMERS:
+            hits += 1
+            if hits >= min_hits:
+                return True
+    return False
+
+
+def match_chunk(args):
+    chunk, k, stride, min_hits = args
+    return [kmer_hits(seq_1, k, stride, min_hits) or kmer_hits(seq_2, k, stride, min_hits) for seq_1, seq_2 in chunk]
+
+
+def filter_reads(sequence_file, fastq_file1, fastq_file2, work_dir, k=25, stride=4, min_hits=2, threads=1,
+                 chunk_size=20000):
+    """
+    Write the read pairs of which at least one mate shares min_hits k-mers (sampled every stride bases) with the
+    reference. Return the filtered FASTQ files, the counters of the filter and the names of the kept pairs.
+    """
+    start = time.time()
+    kmers = build_kmer_set(sequence_file, k)
+    out_file1 = os.path.join(work_dir, "prefilter_R1.fastq")
+    out_file2 = os.path.join(work_dir, "prefilter_R2.fastq")
+
+    total = kept = 0
+    kept_names = set()
+
+    def write_batch(batch):
+        nonlocal total, kept
+        jobs = [([(record_1[1].strip().upper(), record_2[1].strip().upper()) for record_1, record_2 in chunk],
+                 k, stride, min_hits) for chunk in batch]
+        for chunk, matches in zip(batch, pool.map(match_chunk, jobs)):
+            for (record_1, record_2), match in zip(chunk, matches):
+                total += 1
+                if match:
+                    kept += 1
+                    kept_names.add(read_name(record_1[0]))
+                    out_1.writelines(record_1)
+                    out_2.writelines(record_2)
+
+    with open(out_file1, "w") as out_1, open(out_file2, "w") as out_2, \
+            Pool(max(1, threads), initializer=init_worker, initargs=(kmers,)) as pool:
+        # bounded batches of chunks: one chunk per process at a time
+        batch, chunk = [], []
+        for pair in read_pairs(fastq_file1, fastq_file2, threads):
+            chunk.append(pair)
+            if len(chunk) == chunk_size:
+                batch.append(chunk)
+                chunk = []
+                if len(batch) == max(1, threads):
+                    write_batch(batch)
+                    batch = []
+        if chunk:
+            batch.append(chunk)
+        if batch:
+            write_batch(batch)
+
+    counters = OrderedDict([("k", k), ("stride", stride), ("min_hits", min_hits), ("reference_kmers", len(kmers)),
+                            ("read_pairs", total), ("kept_pairs", kept),
+                            ("kept_percent", round(100.0 * kept / total, 2) if total else 0.0),
+                            ("time_s", round(time.time() - start, 2))])
+    return out_file1, out_file2, counters, kept_names
+
+
+def mapped_read_names(bam_file):
+    names = set()
+    with command(["samtools", "view", "-F", "4", bam_file], stdout=PIPE, universal_newlines=True) as process:
+        for line in process.stdout:
+            names.add(line.split("\t", 1)[0])
+    return names
+
+
+def write_report(report_file, counters, kept_names=None, unfiltered_bam=None, filtered_time=None,
+                 unfiltered_time=None):
+    """
+    Write the prefilter counters, with the recall against an unfiltered alignment (share of the read pairs aligned
+    without prefilter that the prefilter kept) and the speed-up when it is given.
+    """
+    report = OrderedDict(counters)
+    if unfiltered_bam:
+        mapped = mapped_read_names(unfiltered_bam)
+        report["unfiltered_mapped_pairs"] = len(mapped)
+        report["recall"] = round(len(mapped & kept_names) / float(len(mapped)), 4) if mapped else 1.0
+    if filtered_time is not None and unfiltered_time:
+        report["filtered_time_s"] = round(filtered_time, 2)
+        report["unfiltered_time_s"] = round(unfiltered_time, 2)
+        report["speedup"] = round(unfiltered_time / filtered_time, 2) if filtered_time else None
+    with open(report_file, "w") as out_f:
+        json.dump(report, out_f, indent=2)
+    return report
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+HTML pages of the result and count tables, rendered on demand from the written files.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import glob
+import os
+
+# tables of a work directory rendered by default
+TABLE_PATTERNS = ["final_result.tsv", "cohort_result.tsv", "*_stats.csv", "*_count.csv"]
+
+
+def render_html(table_file, force=False):
+    """
+    Write <table>.html next to a tab separated table, unless it is newer than the table.
+    """
+    import pandas as pd
+    html_file = os.path.splitext(table_file)[0] + ".html"
+    if not force and os.path.exists(html_file) and os.path.getmtime(html_file) >= os.path.getmtime(table_file):
+        return html_file
+    # the count tables keep their row index in the first column
+    index_col = 0 if table_file.endswith(".csv") else None
+    df = pd.read_csv(table_file, sep="\t", index_col=index_col)
+    df.to_html(html_file, index=index_col is not None)
+    return html_file
+
+
+def table_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in TABLE_PATTERNS:
+                files.extend(sorted(glob.glob(os.path.join(path, pattern))))
+        else:
+            files.append(path)
+    return files
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis html',
+        description='mutanalysis html: render the result and count tables of work directories (or given tables) as '
+                    'HTML pages',
+    )
+    parser.add_argument('paths', nargs='+', help="Work directories or table files")
+    parser.add_argument('-f', '--force', dest="force", action="store_true", help="Render up to date pages again")
+    args = parser.parse_args(argv)
+
+    for table_file in table_files(args.paths):
+        print("HTML: {0}".format(render_html(table_file, args.force)), flush=True)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Resource governor: the CPUs and memory the run may use, from the cgroup limits of the process (v1 or v2) unless
+given on the command line, and the threads and memory of the aligner, the sort and the counting derived from them.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import math
+import os
+import re
+from collections import OrderedDict
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# share of the memory given to samtools sort, the rest is left to bwa mem which runs in the same pipeline
+SORT_MEMORY_FRACTION = 0.5
+# memory per sort thread (samtools sort -m), between these bounds
+SORT_MEMORY_MIN = 64 << 20
+SORT_MEMORY_MAX = 1000000000
+# memory kept per concurrent counting command (a bam-readcount shard)
+JOB_MEMORY = 256 << 20
+
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """
+    Bytes of a size given as a number of bytes or with a K, M, G or T suffix (e.g. 512M, 4G).
+    """
+    match = re.match(r"^\s*([0-9.]+)\s*([KMGT]?)i?B?\s*$", str(size), re.IGNORECASE)
+    if not match:
+        print("\nSize {0} not identified, e.g. 4G or 512M\n".format(size))
+        exit(1)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def format_size(size):
+    for unit in ("T", "G", "M", "K"):
+        if size >= SIZE_UNITS[unit]:
+            return "{0:g}{1}".format(round(size / float(SIZE_UNITS[unit]), 1), unit)
+    return str(size)
+
+
+def cgroup_paths():
+    """
+    Path of the cgroup of the process per v1 controller, under "" for the v2 unified hierarchy.
+    """
+    paths = {}
+    try:
+        with open("/proc/self/cgroup") as in_f:
+            for line in in_f:
+                fields = line.strip().split(":", 2)
+                if len(fields) == 3:
+                    for controller in fields[1].split(","):
+                        paths[controller] = fields[2]
+    except OSError:
+        pass
+    return paths
+
+
+def cgroup_files(controller, file_name, root=CGROUP_ROOT):
+    """
+    Existing file_name of the cgroup of the process and of its ancestors, up to the mount point. A container sees
+    its own cgroup at the mount point, the path of /proc/self/cgroup may then not exist below it.
+    """
+    if os.path.exists(os.path.join(root, "cgroup.controllers")):
+        mount, path = root, cgroup_paths().get("", "/")
+    else:
+        mount, path = os.path.join(root, controller), cgroup_paths().get(controller, "/")
+    files = []
+    parts = [part for part in path.split("/") if part]
+    for depth in range(len(parts), -1, -1):
+        candidate = os.path.join(mount, *(parts[:depth] + [file_name]))
+        if os.path.exists(candidate) and candidate not in files:
+            files.append(candidate)
+    return files
+
+
+def read_first_line(path):
+    try:
+        with open(path) as in_f:
+            return in_f.readline().strip()
+    except OSError:
+        return ""
+
+
+def cgroup_cpu_limit(root=CGROUP_ROOT):
+    """
+    CPUs allowed by the CPU quota of the cgroup (the lowest of the cgroup and its ancestors), None without quota.
+    """
+    limits = []
+    for cpu_max in cgroup_files("cpu", "cpu.max", root):
+        # v2: "<quota> <period>" or "max <period>"
+        fields = read_first_line(cpu_max).split()
+        if len(fields) == 2 and fields[0] != "max":
+            limits.append(int(fields[0]) / float(fields[1]))
+    for quota_file in cgroup_files("cpu", "cpu.cfs_quota_us", root):
+        # v1: quota -1 without limit
+        quota = read_first_line(quota_file)
+        period = read_first_line(os.path.join(os.path.dirname(quota_file), "cpu.cfs_period_us"))
+        if quota.lstrip("-").isdigit() and int(quota) > 0 and period.isdigit() and int(period) > 0:
+            limits.append(int(quota) / float(period))
+    return min(limits) if limits else None
+
+
+def cgroup_memory_limit(root=CGROUP_ROOT):
+    """
+    Memory limit (bytes) of the cgroup (the lowest of the cgroup and its ancestors), None without limit.
+    """
+    limits = []
+    # v2 memory.max ("max" without limit), v1 memory.limit_in_bytes (a huge value without limit)
+    for file_name in ("memory.max", "memory.limit_in_bytes"):
+        for limit_file in cgroup_files("memory", file_name, root):
+            value = read_first_line(limit_file)
+            if value.isdigit() and int(value) < (1 << 60):
+                limits.append(int(value))
+    return min(limits) if limits else None
+
+
+def host_cpus():
+    # CPUs the process may be scheduled on (cpuset, taskset)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def host_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_cpus(root=CGROUP_ROOT):
+    """
+    Whole CPUs of the cgroup quota (a fraction of CPU rounded up), at most the CPUs of the host.
+    """
+    quota = cgroup_cpu_limit(root)
+    if quota is None:
+        return host_cpus()
+    return max(1, min(host_cpus(), int(math.ceil(quota))))
+
+
+def available_memory(root=CGROUP_ROOT):
+    limits = [limit for limit in (cgroup_memory_limit(root), host_memory()) if limit]
+    return min(limits) if limits else None
+
+
+def plan_resources(cpus=None, memory=None, threads=None, sort_threads=None, sort_memory=None, jobs=None,
+                   root=CGROUP_ROOT):
+    """
+    Return the resources of a run: the CPUs and memory (bytes) available, from the cgroup limits unless given, and
+    the threads of the aligner, the threads and memory per thread of samtools sort and the number of concurrent
+    counting commands derived from them. Any derived value given is kept.
+    """
+    plan = OrderedDict()
+    plan["cpus"] = cpus or available_cpus(root)
+    plan["cpu_source"] = "option" if cpus else ("cgroup" if cgroup_cpu_limit(root) is not None else "host")
+    plan["memory"] = memory or available_memory(root)
+    plan["memory_source"] = "option" if memory else ("cgroup" if cgroup_memory_limit(root) else "host")
+
+    plan["threads"] = threads or plan["cpus"]
+
+    # each sort thread holds its own buffer: fewer threads when the memory cannot give each the minimum
+    sort_budget = int(plan["memory"] * SORT_MEMORY_FRACTION) if plan["memory"] else None
+    if not sort_threads:
+        sort_threads = plan["cpus"]
+        if sort_budget and not sort_memory:
+            sort_threads = max(1, min(sort_threads, sort_budget // SORT_MEMORY_MIN))
+    plan["sort_threads"] = sort_threads
+    if not sort_memory:
+        sort_memory = SORT_MEMORY_MAX
+        if sort_budget:
+            sort_memory = max(SORT_MEMORY_MIN, min(SORT_MEMORY_MAX, sort_budget // sort_threads))
+    plan["sort_memory"] = sort_memory
+
+    if not jobs:
+        jobs = plan["cpus"]
+        if plan["memory"]:
+            jobs = max(1, min(jobs, plan["memory"] // JOB_MEMORY))
+    plan["jobs"] = jobs
+    return plan
+
+
+def describe(plan):
+    return "{0} CPUs ({1}), memory {2} ({3}): aligner {4} threads, sort {5} threads x {6}, {7} concurrent " \
+           "commands".format(plan["cpus"], plan["cpu_source"],
+                             format_size(plan["memory"]) if plan["memory"] else "unknown", plan["memory_source"],
+                             plan["threads"], plan["sort_threads"], format_size(plan["sort_memory"]), plan["jobs"])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Per-sample result table of every catalogued mutation and its merge into a cohort table.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import csv
+import os
+
+from mutanalysis.render import render_html
+
+RESULT_COLUMNS = ["Sample", "Gene", "Mutation", "Mean Depth", "Codon", "Depth", "Ratio (%)", "Result",
+                  "Sensible/Resistant"]
+
+# output format -> file extension, tsv is always written
+RESULT_FORMATS = {"tsv": ".tsv", "parquet": ".parquet", "arrow": ".arrow"}
+
+
+def check_arrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        print("\nThe parquet and arrow result formats need pyarrow: pip install pyarrow\n")
+        exit(1)
+
+
+def result_table(rows):
+    import pandas as pd
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def write_tsv(rows, out_file):
+    # same text as DataFrame.to_csv(sep="\t", index=False), without importing pandas
+    with open(out_file, "w", newline="") as out_f:
+        writer = csv.writer(out_f, delimiter="\t", lineterminator="\n")
+        writer.writerow(RESULT_COLUMNS)
+        writer.writerows(rows)
+    return out_file
+
+
+def write_results(table, out_prefix, formats=("tsv",), html=False):
+    """
+    Write a result table once per requested format (<out_prefix>.tsv, .parquet, .arrow), the HTML page only on
+    request. Return the written files.
+    """
+    if set(formats) - {"tsv"}:
+        check_arrow()
+    files = []
+    for result_format in ["tsv"] + [f for f in formats if f != "tsv"]:
+        out_file = out_prefix + RESULT_FORMATS[result_format]
+        if result_format == "tsv":
+            table.to_csv(out_file, sep="\t", index=False)
+        elif result_format == "parquet":
+            table.to_parquet(out_file, index=False)
+        else:
+            table.reset_index(drop=True).to_feather(out_file)
+        files.append(out_file)
+    if html:
+        files.append(render_html(out_prefix + ".tsv", force=True))
+    return files
+
+
+def write_rows(rows, out_prefix, formats=("tsv",), html=False):
+    """
+    Write result rows (lists in RESULT_COLUMNS order) like write_results. The TSV alone is written without pandas,
+    the columnar formats go through a DataFrame.
+    """
+    if set(formats) - {"tsv"}:
+        return write_results(result_table(rows), out_prefix, formats, html)
+    files = [write_tsv(rows, out_prefix + ".tsv")]
+    if html:
+        files.append(render_html(files[0], force=True))
+    return files
+
+
+def read_results(path):
+    """
+    Read a result table from a file or from a work directory (the columnar file first when there is one).
+    """
+    import pandas as pd
+    if os.path.isdir(path):
+        for result_format in ("parquet", "arrow", "tsv"):
+            result_file = os.path.join(path, "final_result" + RESULT_FORMATS[result_format])
+            if os.path.exists(result_file):
+                return read_results(result_file)
+        return None
+    if path.endswith(".parquet"):
+        check_arrow()
+        return pd.read_parquet(path)
+    if path.endswith(".arrow"):
+        check_arrow()
+        return pd.read_feather(path)
+    return pd.read_csv(path, sep="\t", keep_default_na=False)
+
+
+def merge_results(paths, out_prefix, formats=("tsv",), html=False):
+    """
+    Merge the result tables of several samples (files or work directories) into one cohort table.
+    """
+    import pandas as pd
+    tables = []
+    for path in paths:
+        table = read_results(path)
+        if table is None:
+            print("No result table in {0}".format(path), flush=True)
+            continue
+        tables.append(table)
+    cohort = pd.concat(tables, ignore_index=True) if tables else result_table([])
+    cohort = cohort.sort_values(["Sample", "Gene", "Mutation", "Depth"], ascending=[True, True, True, False],
+                                kind="mergesort")
+    return write_results(cohort.reset_index(drop=True), out_prefix, formats, html)
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis merge',
+        description='mutanalysis merge: merge the result tables of several samples into a cohort table',
+    )
+    parser.add_argument('paths', nargs='+', help="Sample work directories or result tables")
+    parser.add_argument('-o', '--out', dest="out", default="cohort_result",
+                        help="Output prefix (Default=cohort_result)")
+    parser.add_argument('--result-format', dest="result_format", nargs='+', default=["tsv"],
+                        choices=sorted(RESULT_FORMATS), help="Formats of the cohort table (Default=tsv)")
+    parser.add_argument('--html', dest="html", action="store_true", help="Also render the cohort table as HTML")
+    args = parser.parse_args(argv)
+
+    for out_file in merge_results(args.paths, os.path.abspath(args.out), args.result_format, args.html):
+        print("Cohort table: {0}".format(out_file), flush=True)
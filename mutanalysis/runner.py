@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Concurrent runner of external commands: independent commands run together (at most jobs at a time), their output
+goes straight to log files, and a failure or a timeout stops the commands still running.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import asyncio
+import itertools
+import os
+import re
+import signal
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from subprocess import DEVNULL, STDOUT
+
+from mutanalysis import metrics
+
+# defaults of the run, set from the command line (see configure)
+JOBS = os.cpu_count() or 1
+TIMEOUT = None
+# directory of the logs of the commands run without a log file of their own
+LOG_DIR = None
+
+# lines of its log quoted when a command fails
+LOG_TAIL = 10
+COMMAND_NUMBERS = itertools.count(1)
+
+
+def configure(jobs=None, timeout=None, log_dir=None):
+    """
+    Set the maximum number of concurrent commands, the timeout (seconds) of each command, None for no timeout, and
+    the directory of the logs of the commands run without a log file (see stage_log).
+    """
+    global JOBS, TIMEOUT, LOG_DIR
+    if jobs:
+        JOBS = max(1, jobs)
+    TIMEOUT = timeout or None
+    LOG_DIR = log_dir
+
+
+def stage_log(cmd):
+    """
+    Log file of a command run without one: <log dir>/<stage>.<tool>.<n>.txt, one file per command as the commands of
+    a stage can run together. Without a log directory, a temporary file kept only when the command fails. Return the
+    log file and whether it is temporary.
+    """
+    words = re.sub(r"^\s*set -o pipefail;", "", cmd).split()
+    name = "{0}.{1}.{2}.txt".format(re.sub(r"\W+", "_", metrics.MANIFEST.current_stage() or "run").strip("_"),
+                                    os.path.basename(words[0]) if words else "command", next(COMMAND_NUMBERS))
+    if LOG_DIR is None:
+        fd, log_file = tempfile.mkstemp(prefix="mutanalysis_", suffix="." + name)
+        os.close(fd)
+        return log_file, True
+    os.makedirs(LOG_DIR, exist_ok=True)
+    return os.path.join(LOG_DIR, name), False
+
+
+def log_tail(log_file, lines=LOG_TAIL):
+    # last lines of the output of a command, after the command line written at the top of its log
+    try:
+        with open(log_file, errors="replace") as log_f:
+            output = log_f.read().splitlines()[3:]
+    except OSError:
+        return ""
+    return "\n".join(output[-lines:])
+
+
+async def stop(process, waiter):
+    # the shell runs in its own session, stop the whole pipeline
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        done, _ = await asyncio.wait({waiter}, timeout=metrics.KILL_GRACE)
+        if done:
+            return
+
+
+async def run_async(cmd, log_file=None, timeout=None, limit=None):
+    """
+    Run a shell command once a slot of limit (a semaphore) is free, stdout and stderr written to log_file after the
+    command line. Return the exit code, negative when the command was killed (timeout). The command is stopped when
+    the task is cancelled.
+    """
+    async with limit or nullcontext():
+        entry = OrderedDict([("command", cmd), ("stage", metrics.MANIFEST.current_stage())])
+        if log_file:
+            log_f = open(log_file, "wb")
+            log_f.write("Command line executed: {0}\n\n\n".format(cmd).encode())
+            log_f.flush()
+            entry["log"] = log_file
+        else:
+            log_f = DEVNULL
+        start = time.time()
+        # reaped by wait4 in a thread rather than by the asyncio child watcher, its usage recorded like the commands of
+        # metrics.command
+        process, usage_fd = metrics.start_command(cmd, stdin=DEVNULL, stdout=log_f, stderr=STDOUT)
+        waiter = asyncio.get_running_loop().run_in_executor(None, os.wait4, process.pid, 0)
+        try:
+            # asyncio.wait leaves the waiter running on timeout, the stopped command is still reaped by it
+            done, _ = await asyncio.wait({waiter}, timeout=timeout)
+            if not done:
+                entry["timed_out"] = True
+                await stop(process, waiter)
+        except asyncio.CancelledError:
+            entry["cancelled"] = True
+            await stop(process, waiter)
+            raise
+        finally:
+            if log_file:
+                log_f.close()
+            entry["wall_s"] = round(time.time() - start, 3)
+            metrics.untrack_command(process)
+            if waiter.done():
+                _, status, usage = waiter.result()
+                process.returncode = metrics.exit_status(status)
+                metrics.record_usage(entry, usage_fd, usage)
+            else:
+                os.close(usage_fd)
+            entry["exit_status"] = process.returncode
+            metrics.MANIFEST.commands.append(entry)
+    return process.returncode
+
+
+async def run_all(commands, jobs, timeout, check):
+    limit = asyncio.Semaphore(jobs)
+    # one reaping thread per command running at once, a queued wait4 would delay the end of a command
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max(1, min(jobs, len(commands)))))
+    tasks = [asyncio.ensure_future(run_async(cmd, log_file, timeout, limit)) for cmd, log_file in commands]
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        if check and any(task.result() != 0 for task in done):
+            # the other commands work for a failed stage
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            break
+    return [None if task.cancelled() else task.result() for task in tasks]
+
+
+def run_commands(commands, jobs=None, timeout=None, check=True):
+    """
+    Run independent shell commands concurrently, at most jobs at a time (Default: configured jobs). commands are
+    strings or (command, log file) pairs. Return the exit codes in order (None for a command cancelled after a
+    failure). With check, the first failing command stops the others and ends the run. A run stopped by
+    metrics.stop_run ends here.
+    """
+    commands = [(cmd, None) if isinstance(cmd, str) else tuple(cmd) for cmd in commands]
+    # every command gets a log, the output of a failing tool is quoted in the error
+    temporary_logs = set()
+    for i, (cmd, log_file) in enumerate(commands):
+        if not log_file:
+            log_file, temporary = stage_log(cmd)
+            commands[i] = (cmd, log_file)
+            if temporary:
+                temporary_logs.add(log_file)
+    timeout = timeout or TIMEOUT
+    try:
+        metrics.check_stop()
+        exit_codes = asyncio.run(run_all(commands, jobs or JOBS, timeout, check))
+        for (cmd, log_file), exit_code in zip(commands, exit_codes):
+            if exit_code:
+                temporary_logs.discard(log_file)
+    finally:
+        for log_file in temporary_logs:
+            os.remove(log_file)
+    metrics.check_stop()
+    if check:
+        for (cmd, log_file), exit_code in zip(commands, exit_codes):
+            if exit_code is None or exit_code == 0:
+                continue
+            if exit_code < 0 and timeout:
+                reason = "timed out after {0} s".format(timeout)
+            else:
+                reason = "exit code {0}".format(exit_code)
+            metrics.fail("\nCommand failed ({0}): {1}\nSee {2}\n{3}\n".format(reason, cmd, log_file,
+                                                                             log_tail(log_file)))
+    return exit_codes
+
+
+def run(cmd, log_file=None, timeout=None, check=True):
+    """
+    Run a single shell command, its output written to log_file. Return the exit code.
+    """
+    return run_commands([(cmd, log_file)], 1, timeout, check)[0]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Interval index of the catalogued sites: per contig, the sites sorted by start and merged into shared regions when
+they overlap or touch, so that a panel of thousands of genes is counted and routed region by region.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+
+class SitePlan:
+    """
+    Sites (key -> (contig, 1-based start, 1-based inclusive end)) indexed per contig. Overlapping and adjacent
+    sites share a region: regions[contig] is the sorted list of merged [start, end] intervals.
+    """
+
+    def __init__(self, sites):
+        self.sites = OrderedDict(sites)
+        by_contig = OrderedDict()
+        for key, (ctg, start, end) in self.sites.items():
+            by_contig.setdefault(ctg, []).append((start, end, key))
+
+        self.starts = OrderedDict()
+        self.ends = OrderedDict()
+        self.keys = OrderedDict()
+        self.regions = OrderedDict()
+        for ctg, intervals in by_contig.items():
+            intervals.sort(key=lambda interval: interval[:2])
+            self.starts[ctg] = [start for start, end, key in intervals]
+            self.ends[ctg] = [end for start, end, key in intervals]
+            self.keys[ctg] = [key for start, end, key in intervals]
+            regions = []
+            for start, end, key in intervals:
+                if regions and start <= regions[-1][1] + 1:
+                    regions[-1][1] = max(regions[-1][1], end)
+                else:
+                    regions.append([start, end])
+            self.regions[ctg] = regions
+
+    @classmethod
+    def from_codons(cls, codons):
+        """
+        Plan of codons given as key -> (contig, 1-based position of the first codon base).
+        """
+        return cls(OrderedDict((key, (ctg, start, start + 2)) for key, (ctg, start) in codons.items()))
+
+    def __len__(self):
+        return len(self.sites)
+
+    def region_list(self):
+        return [(ctg, start, end) for ctg, regions in self.regions.items() for start, end in regions]
+
+    def nb_regions(self):
+        return sum(len(regions) for regions in self.regions.values())
+
+    def within(self, ctg, start, end):
+        """
+        Keys of the sites lying entirely inside start..end (1-based, inclusive) of a contig.
+        """
+        if ctg not in self.starts:
+            return []
+        starts = self.starts[ctg]
+        keys = []
+        for i in range(bisect_left(starts, start), bisect_right(starts, end)):
+            if self.ends[ctg][i] <= end:
+                keys.append(self.keys[ctg][i])
+        return keys
+
+    def write_site_file(self, site_file):
+        # one line per merged region, in contig and position order
+        with open(site_file, 'w') as out_f:
+            for ctg, start, end in self.region_list():
+                out_f.write('{0}\t{1}\t{2}\n'.format(ctg, start, end))
+        return site_file
+
+    def write_bed(self, bed_file):
+        with open(bed_file, 'w') as out_f:
+            for ctg, start, end in self.region_list():
+                out_f.write('{0}\t{1}\t{2}\n'.format(ctg, start - 1, end))
+        return bed_file
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Stage cache: a stage is skipped only when the fingerprint of its inputs, parameters and tool versions matches its
+last run and its outputs are untouched.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from subprocess import DEVNULL, PIPE, STDOUT, Popen
+
+from mutanalysis import metrics
+
+CACHE_FILE = ".stage_cache.json"
+
+# files up to this size are fingerprinted by content, larger ones (reads, BAM) by size and modification time
+CONTENT_HASH_SIZE = 1 << 24
+
+# command printing the version of each external tool
+TOOL_VERSION_COMMANDS = {
+    "bwa": ["bwa"],
+    "samtools": ["samtools", "--version"],
+    "bam-readcount": ["bam-readcount", "--version"],
+}
+
+TOOL_VERSIONS = {}
+
+
+def tool_version(tool):
+    """
+    First line mentioning a version in the output of the tool, "missing" when it is not installed.
+    """
+    if tool not in TOOL_VERSIONS:
+        if not shutil.which(tool):
+            TOOL_VERSIONS[tool] = "missing"
+        else:
+            # stopped with the run, like the other commands (see metrics.stop_run)
+            process = Popen(TOOL_VERSION_COMMANDS.get(tool, [tool, "--version"]), stdin=DEVNULL, stdout=PIPE,
+                            stderr=STDOUT, universal_newlines=True, start_new_session=True)
+            metrics.track_command(process)
+            try:
+                lines = process.communicate()[0].splitlines()
+            finally:
+                metrics.untrack_command(process)
+            version_lines = [line.strip() for line in lines if "version" in line.lower()]
+            TOOL_VERSIONS[tool] = version_lines[0] if version_lines else (lines[0].strip() if lines else "unknown")
+    return TOOL_VERSIONS[tool]
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class StageCache:
+    """
+    Fingerprints and outputs of the stages run in a work directory, stored in <work dir>/.stage_cache.json.
+    The outputs of a recorded stage are fingerprinted by the key of that stage, so a stage rerun on identical
+    inputs does not invalidate the stages downstream.
+    """
+
+    def __init__(self, work_dir, force=False):
+        self.cache_file = os.path.join(work_dir, CACHE_FILE)
+        self.force = force
+        self.stages = OrderedDict()
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file) as in_f:
+                    self.stages = json.load(in_f, object_pairs_hook=OrderedDict)
+            except ValueError:
+                print("Stage cache {0} unreadable, every stage runs again".format(self.cache_file), flush=True)
+
+    def produced_by(self, path):
+        # key of the recorded stage that wrote this file, while the file is untouched
+        for record in self.stages.values():
+            if record["outputs"].get(path) == file_stat(path):
+                return record["key"]
+        return None
+
+    def file_fingerprint(self, path):
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            return "missing"
+        stage_key = self.produced_by(path)
+        if stage_key:
+            return "stage:" + stage_key
+        size, mtime = file_stat(path)
+        if size > CONTENT_HASH_SIZE:
+            return "stat:{0}:{1}".format(size, mtime)
+        sha = hashlib.sha256()
+        with open(path, "rb") as in_f:
+            for block in iter(lambda: in_f.read(1 << 20), b""):
+                sha.update(block)
+        return "sha256:" + sha.hexdigest()
+
+    def key(self, stage, inputs=(), params=None, tools=()):
+        """
+        Fingerprint of a stage: its input files, parameters (JSON serialisable) and the versions of its tools.
+        """
+        description = OrderedDict([("stage", stage),
+                                   ("inputs", [[os.path.abspath(path), self.file_fingerprint(path)]
+                                               for path in inputs]),
+                                   ("params", params or {}),
+                                   ("tools", OrderedDict((tool, tool_version(tool)) for tool in tools))])
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def fresh(self, stage, key):
+        """
+        True when the stage ran with this key and its outputs are untouched: the stage can be skipped.
+        """
+        record = self.stages.get(stage)
+        if self.force or not record or record["key"] != key:
+            return False
+        for path, stat in record["outputs"].items():
+            if stat is None or not os.path.exists(path) or file_stat(path) != stat:
+                return False
+        print("Stage {0} up to date, skipped".format(stage), flush=True)
+        return True
+
+    def info(self, stage):
+        return self.stages[stage].get("info", {})
+
+    def record(self, stage, key, outputs, info=None):
+        """
+        Record a completed stage and the stat of its outputs, a missing output keeps the stage stale.
+        """
+        self.stages[stage] = OrderedDict([("key", key),
+                                          ("outputs", OrderedDict((os.path.abspath(path),
+                                                                   file_stat(path) if os.path.exists(path) else None)
+                                                                  for path in outputs)),
+                                          ("info", info or {})])
+        fd, tmp_file = tempfile.mkstemp(prefix=".stage_cache_", dir=os.path.dirname(self.cache_file))
+        with os.fdopen(fd, "w") as out_f:
+            json.dump(self.stages, out_f, indent=2)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+Cohort results store: an SQLite file that each run appends its calls, per-codon counts and depth statistics to in
+one transaction, queried by gene, mutation, call and ratio through indexes instead of parsing the work directories.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+
+from mutanalysis.results import RESULT_COLUMNS
+from mutanalysis.utils import sanitize_name
+
+# seconds a writer waits for the lock of another run before failing
+BUSY_TIMEOUT = 600.0
+# samples ingested per transaction from work directories
+BATCH_SIZE = 200
+# rows fetched at a time by the queries and the export
+FETCH_SIZE = 10000
+
+# StatsAccumulator.stats() key -> column suffix, for the reference depth and quality of a region
+STAT_KEYS = OrderedDict([("perc>=30", "perc30"), ("perc>=20", "perc20"), ("perc>=10", "perc10"), ("mean", "mean"),
+                         ("50_perc", "median"), ("25_perc", "p25"), ("75_perc", "p75"), ("max", "max"),
+                         ("min", "min")])
+# prefix of the statistics in the CSV files of bam_count_stats -> column prefix
+STAT_PREFIXES = OrderedDict([("Ref_depth_", "depth_"), ("Ref_quali_", "quality_")])
+STAT_COLUMNS = [prefix + suffix for prefix in STAT_PREFIXES.values() for suffix in STAT_KEYS.values()]
+
+# table -> columns, the calls in the order of the result table (RESULT_COLUMNS)
+TABLES = OrderedDict([
+    ("samples", ["sample", "work_dir", "version", "source", "ingested"]),
+    ("calls", ["sample", "gene", "mutation", "mean_depth", "codon", "depth", "ratio", "result", "call"]),
+    ("codons", ["sample", "gene", "mutation", "codon", "depth", "site_depth"]),
+    ("depth_stats", ["sample", "gene", "start", "end", "size"] + STAT_COLUMNS),
+])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    sample TEXT PRIMARY KEY, work_dir TEXT, version TEXT, source TEXT, ingested TEXT);
+CREATE TABLE IF NOT EXISTS calls (
+    sample TEXT NOT NULL, gene TEXT NOT NULL, mutation TEXT NOT NULL, mean_depth INTEGER, codon TEXT,
+    depth INTEGER, ratio INTEGER, result TEXT, call TEXT);
+CREATE INDEX IF NOT EXISTS calls_site ON calls (gene, mutation, call, ratio);
+CREATE INDEX IF NOT EXISTS calls_sample ON calls (sample);
+CREATE TABLE IF NOT EXISTS codons (
+    sample TEXT NOT NULL, gene TEXT NOT NULL, mutation TEXT NOT NULL, codon TEXT NOT NULL, depth INTEGER,
+    site_depth INTEGER, PRIMARY KEY (sample, gene, mutation, codon)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS codons_site ON codons (gene, mutation, codon, depth);
+CREATE TABLE IF NOT EXISTS depth_stats (
+    sample TEXT NOT NULL, gene TEXT NOT NULL, start INTEGER NOT NULL, end INTEGER, size INTEGER, {0},
+    PRIMARY KEY (sample, gene, start, end)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS depth_stats_gene ON depth_stats (gene, depth_mean);
+""".format(", ".join("{0} REAL".format(column) for column in STAT_COLUMNS))
+
+
+def open_store(store_file):
+    """
+    Open (and create) a store. Transactions are explicit (see write_samples), concurrent runs wait for each other
+    up to BUSY_TIMEOUT. SQLite locks the file: the store must be on a local disk or on a filesystem with working
+    POSIX locks.
+    """
+    store_dir = os.path.dirname(os.path.abspath(store_file))
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    connection = sqlite3.connect(store_file, timeout=BUSY_TIMEOUT, isolation_level=None)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def sample_record(sample, work_dir="", version="", source="run"):
+    return OrderedDict([("sample", sample), ("work_dir", work_dir), ("version", version), ("source", source),
+                        ("calls", []), ("codons", []), ("depth_stats", [])])
+
+
+def stats_row(sample, gene, start, end, size, stats):
+    """
+    Row of depth_stats from the depth and quality statistics (column suffix -> value) of a region.
+    """
+    return [sample, gene, start, end, size] + [stats.get(column) for column in STAT_COLUMNS]
+
+
+def run_record(sample, work_dir, version, sites, counts, histograms, rows):
+    """
+    Record of a run from the data handed to the report: the result rows (calls), every codon found at each site with
+    its depth (not only those reported above the 10% ratio) and the statistics of each counted region.
+    """
+    from mutanalysis.bam2count import CountStats
+    from mutanalysis.mut2report import combinatorial_codons, phased_codons
+
+    record = sample_record(sample, work_dir, version)
+    record["calls"] = [list(row) for row in rows]
+    regions = set()
+    for key, count_table in counts.items():
+        site = sites[key]
+        if key in histograms:
+            codons, site_depth = phased_codons(histograms[key])
+        else:
+            codons, site_depth = combinatorial_codons(count_table)
+        for codon, depth in sorted(codons.items()):
+            record["codons"].append([sample, site["feature"], site["mutation"], codon, int(depth), int(site_depth)])
+
+        # a region shared by several mutations is kept once
+        count_stats = CountStats()
+        count_stats.update(count_table)
+        for ctg, contig in count_stats.contigs.items():
+            region = (ctg, contig["start"], contig["end"])
+            if region in regions:
+                continue
+            regions.add(region)
+            stats = {}
+            for name, prefix in (("depth", "depth_"), ("quality", "quality_")):
+                for key_name, value in contig[name].stats().items():
+                    stats[prefix + STAT_KEYS[key_name]] = value
+            record["depth_stats"].append(stats_row(sample, ctg, contig["start"], contig["end"], contig["size"],
+                                                   stats))
+    return record
+
+
+def read_stats_file(stats_file, sample):
+    """
+    Rows of depth_stats of a statistics file of bam_count_stats (the Overall row is left out).
+    """
+    rows = []
+    with open(stats_file, newline="") as in_f:
+        for row in csv.DictReader(in_f, delimiter="\t"):
+            if row["ID"] == "Overall":
+                continue
+            stats = {}
+            for name, value in row.items():
+                for file_prefix, prefix in STAT_PREFIXES.items():
+                    if name and name.startswith(file_prefix) and name[len(file_prefix):] in STAT_KEYS:
+                        stats[prefix + STAT_KEYS[name[len(file_prefix):]]] = float(value)
+            rows.append(stats_row(sample, row["ID"], int(row["start"]), int(row["end"]), int(row["size"]), stats))
+    return rows
+
+
+def dir_record(work_dir):
+    """
+    Record of a sample from the files of its work directory: final_result.tsv, the *_stats.csv files written with
+    --write-counts and the version of its run manifest. The per-codon counts are those of the reported codons, the
+    others are not kept in the files. Return None without result table.
+    """
+    result_file = os.path.join(work_dir, "final_result.tsv")
+    if not os.path.exists(result_file):
+        return None
+    sample = os.path.basename(os.path.normpath(work_dir))
+    manifest = {}
+    try:
+        with open(os.path.join(work_dir, "run_manifest.json")) as in_f:
+            manifest = json.load(in_f).get("run", {})
+    except (OSError, ValueError):
+        pass
+    record = sample_record(sample, os.path.abspath(work_dir), manifest.get("version", ""), "files")
+    with open(result_file, newline="") as in_f:
+        for row in csv.DictReader(in_f, delimiter="\t"):
+            row.setdefault("Sample", sample)
+            if "Codon" not in row:
+                # tables written before the consolidated report: the codon and its depth are in the Result column
+                codon, details = row["Result"].split("(", 1)
+                depth, ratio = [field.split(":")[-1].rstrip("%)") for field in details.split(";")]
+                row.update({"Codon": codon, "Depth": depth, "Ratio (%)": ratio.replace("ratio", "")})
+            call = [row[column] for column in RESULT_COLUMNS]
+            record["calls"].append(call)
+            record["codons"].append([sample, call[1], call[2], call[4], int(call[5]), int(call[3])])
+    for stats_file in sorted(glob.glob(os.path.join(work_dir, "*_stats.csv"))):
+        record["depth_stats"].extend(read_stats_file(stats_file, sample))
+    return record
+
+
+def write_samples(connection, records):
+    """
+    Replace the rows of each sample by those of its record, every sample of records in a single transaction: a
+    sample ingested again replaces its previous rows, and a failed transaction leaves the store unchanged.
+    """
+    ingested = time.strftime("%Y-%m-%dT%H:%M:%S")
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        for record in records:
+            sample = record["sample"]
+            for table in TABLES:
+                connection.execute("DELETE FROM {0} WHERE sample = ?".format(table), (sample,))
+            connection.execute("INSERT INTO samples VALUES (?, ?, ?, ?, ?)",
+                               (sample, record["work_dir"], record["version"], record["source"], ingested))
+            for table in ("calls", "codons", "depth_stats"):
+                if record[table]:
+                    connection.executemany("INSERT OR REPLACE INTO {0} VALUES ({1})".format(
+                        table, ", ".join("?" * len(TABLES[table]))), record[table])
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    return len(records)
+
+
+def ingest_record(store_file, record):
+    connection = open_store(store_file)
+    try:
+        return write_samples(connection, [record])
+    finally:
+        connection.close()
+
+
+def ingest_dirs(store_file, work_dirs, batch_size=BATCH_SIZE):
+    """
+    Ingest the samples of work directories, batch_size samples per transaction. Return the number of samples
+    ingested and the directories without result table.
+    """
+    connection = open_store(store_file)
+    nb_samples = 0
+    missing = []
+    batch = []
+    try:
+        for work_dir in work_dirs:
+            record = dir_record(work_dir)
+            if record is None:
+                missing.append(work_dir)
+                continue
+            batch.append(record)
+            if len(batch) >= batch_size:
+                nb_samples += write_samples(connection, batch)
+                print("{0} samples ingested".format(nb_samples), flush=True)
+                batch = []
+        if batch:
+            nb_samples += write_samples(connection, batch)
+    finally:
+        connection.close()
+    return nb_samples, missing
+
+
+def query_calls(connection, gene="", mutation="", call="", min_ratio=None, min_depth=None, samples=(),
+                samples_only=False):
+    """
+    Return the columns and a cursor of the calls matching the filters (their samples only with samples_only), found
+    through the calls_site index. gene is a catalogue name, sanitised like the features.
+    """
+    conditions, parameters = [], []
+    for column, value in (("gene", sanitize_name(gene) if gene else ""), ("mutation", mutation), ("call", call)):
+        if value:
+            conditions.append("{0} = ?".format(column))
+            parameters.append(value)
+    for column, value in (("ratio", min_ratio), ("depth", min_depth)):
+        if value is not None:
+            conditions.append("{0} >= ?".format(column))
+            parameters.append(value)
+    if samples:
+        conditions.append("sample IN ({0})".format(", ".join("?" * len(samples))))
+        parameters.extend(samples)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    if samples_only:
+        return ["Sample"], connection.execute("SELECT DISTINCT sample FROM calls{0} ORDER BY sample".format(where),
+                                              parameters)
+    sql = "SELECT {0} FROM calls{1} ORDER BY sample, gene, mutation, depth DESC".format(", ".join(TABLES["calls"]),
+                                                                                       where)
+    return RESULT_COLUMNS, connection.execute(sql, parameters)
+
+
+def write_cursor(out_f, columns, cursor):
+    writer = csv.writer(out_f, delimiter="\t", lineterminator="\n")
+    writer.writerow(columns)
+    nb_rows = 0
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return nb_rows
+        writer.writerows(rows)
+        nb_rows += len(rows)
+
+
+def export_tables(store_file, out_prefix, tables=tuple(TABLES)):
+    """
+    Write each table of the store to <out_prefix>_<table>.tsv, streamed by FETCH_SIZE rows. The calls are written
+    with the columns of the result tables, like a cohort table of mutanalysis merge.
+    """
+    connection = open_store(store_file)
+    files = []
+    try:
+        for table in tables:
+            out_file = "{0}_{1}.tsv".format(out_prefix, table)
+            cursor = connection.execute("SELECT {0} FROM {1} ORDER BY {2}".format(
+                ", ".join(TABLES[table]), table, ", ".join(TABLES[table][:3])))
+            with open(out_file, "w", newline="") as out_f:
+                write_cursor(out_f, RESULT_COLUMNS if table == "calls" else TABLES[table], cursor)
+            files.append(out_file)
+    finally:
+        connection.close()
+    return files
+
+
+def read_list(list_file):
+    with open(list_file) as in_f:
+        return [line.strip() for line in in_f if line.strip()]
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis store',
+        description='mutanalysis store: cohort results store, filled by the runs with --store or from their work '
+                    'directories, queried by gene, mutation, call and ratio',
+    )
+    parser.add_argument('action', choices=["ingest", "query", "export"],
+                        help="ingest: add or replace the samples of work directories; query: print the matching "
+                             "calls as TSV; export: write every table as TSV")
+    parser.add_argument('paths', nargs='*', help="ingest: sample work directories")
+    parser.add_argument('-d', '--db', dest="db", required=True, help="Store file (SQLite)")
+    parser.add_argument('-l', '--list', dest="list", default='',
+                        help="ingest: file of sample work directories, one per line")
+    parser.add_argument('--batch-size', dest="batch_size", type=int, default=BATCH_SIZE,
+                        help="ingest: samples per transaction (Default={0})".format(BATCH_SIZE))
+    parser.add_argument('--gene', dest="gene", default='', help="query: gene of the catalogue")
+    parser.add_argument('--mutation', dest="mutation", default='', help="query: mutation, e.g. L129S")
+    parser.add_argument('--call', dest="call", default='', choices=["", "Sensible", "Resistant", "X"],
+                        help="query: call of the codon")
+    parser.add_argument('--min-ratio', dest="min_ratio", type=int, default=None,
+                        help="query: minimum ratio (%%) of the codon")
+    parser.add_argument('--min-depth', dest="min_depth", type=int, default=None,
+                        help="query: minimum depth of the codon")
+    parser.add_argument('--sample', dest="samples", nargs='+', default=[], help="query: samples")
+    parser.add_argument('--samples-only', dest="samples_only", action="store_true",
+                        help="query: print the matching samples only")
+    parser.add_argument('-o', '--out', dest="out", default='',
+                        help="query: output file (Default=standard output); export: output prefix "
+                             "(Default=cohort_store)")
+    parser.add_argument('--table', dest="tables", nargs='+', default=list(TABLES), choices=list(TABLES),
+                        help="export: tables to write (Default=all)")
+    # the work directories may follow the options
+    args = parser.parse_intermixed_args(argv)
+
+    if args.action == "ingest":
+        work_dirs = args.paths + (read_list(args.list) if args.list else [])
+        if not work_dirs:
+            print("\nNo work directory to ingest\n")
+            exit(1)
+        nb_samples, missing = ingest_dirs(args.db, work_dirs, args.batch_size)
+        for work_dir in missing:
+            print("No result table in {0}".format(work_dir), flush=True)
+        print("{0} samples ingested in {1}".format(nb_samples, args.db), flush=True)
+    elif args.action == "query":
+        if not os.path.exists(args.db):
+            print("\nNo store {0}\n".format(args.db))
+            exit(1)
+        connection = open_store(args.db)
+        try:
+            columns, cursor = query_calls(connection, args.gene, args.mutation, args.call, args.min_ratio,
+                                          args.min_depth, args.samples, args.samples_only)
+            out_f = open(args.out, "w", newline="") if args.out else sys.stdout
+            try:
+                nb_rows = write_cursor(out_f, columns, cursor)
+            finally:
+                if args.out:
+                    out_f.close()
+        finally:
+            connection.close()
+        print("{0} rows".format(nb_rows), file=sys.stderr, flush=True)
+    else:
+        if not os.path.exists(args.db):
+            print("\nNo store {0}\n".format(args.db))
+            exit(1)
+        for out_file in export_tables(args.db, os.path.abspath(args.out or "cohort_store"), args.tables):
+            print("Table: {0}".format(out_file), flush=True)
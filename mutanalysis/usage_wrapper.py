@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Thin wrapper of the external commands of a run: starts the command, waits for it, writes its own resource usage to a
+file descriptor and exits like it (exit code or signal). The peak RSS that os.wait4 gives for a process forked from
+the run includes the memory of the run itself, the command started from this small process does not inherit it.
+Run as: python -I -S usage_wrapper.py <usage fd> <command> [arguments]
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import signal
+import sys
+
+
+def main(argv):
+    usage_fd = int(argv[0])
+    os.set_inheritable(usage_fd, False)
+    try:
+        pid = os.posix_spawnp(argv[1], argv[1:], os.environ)
+    except OSError as e:
+        print("{0}: {1}".format(argv[1], e.strerror), file=sys.stderr, flush=True)
+        os._exit(127 if isinstance(e, FileNotFoundError) else 126)
+    _, status, usage = os.wait4(pid, 0)
+    # user and system seconds, peak RSS (kB), blocks read and written
+    os.write(usage_fd, "{0} {1} {2} {3} {4}\n".format(usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+                                                      usage.ru_inblock, usage.ru_oublock).encode())
+    os.close(usage_fd)
+    if os.WIFSIGNALED(status):
+        signal.signal(os.WTERMSIG(status), signal.SIG_DFL)
+        os.kill(os.getpid(), os.WTERMSIG(status))
+    os._exit(os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,10 @@
 from csv import DictReader
 
 
+def sanitize_name(name):
+    return name.replace(':', '_').replace('(', '').replace(')', '').replace('\'', 'pr').replace('-', '')
+
+
 def read_mutation_database(mutation_file):
     mut_dict = {}
     with open(mutation_file, "r") as mut_file:
@@ -15,3 +19,15 @@ def read_mutation_database(mutation_file):
                 "nucleic": row["Nucleic"].replace("[", "").replace("]", "").split(",")
             }
     return mut_dict
+
+
+def rename_reference(sequence_file, out_file):
+    # sanitize fasta headers so that they match the feature names used in the positions
+    with open(sequence_file, "r") as file:
+        with open(out_file, "w") as out_f:
+            for line in file:
+                if line.startswith(">"):
+                    line = sanitize_name(line)
+                out_f.write(line)
+    return out_file
+
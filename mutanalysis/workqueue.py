@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+Work queue on a shared filesystem: the samples of a sample sheet are spread over shard directories and claimed by
+independent workers (on one or several nodes) through lease files, without a queue service.
+Copyright 2020 Aurélien BIRER (abirer36@gmail.com)
+https://github.com/CNRResistanceAntibiotic/mutAnalysis
+
+This file is part of CGST. CGST is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the Free Software Foundation,
+either version 3 of the License, or (at your option) any later version. CGST is distributed in
+the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details. You should have received a copy of the GNU General Public License along with CGST. If
+not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from mutanalysis import batch, metrics
+
+QUEUE_FILE = "queue.json"
+# queue sub-directories: task specs and their leases per shard, one marker per finished sample, one status file
+# per worker
+QUEUE_DIRS = ["tasks", "leases", "done", "failed", "workers"]
+
+# seconds between two heartbeats of a worker, and without heartbeat before its lease can be reclaimed
+HEARTBEAT = 30.0
+LEASE = 300.0
+POLL_INTERVAL = 10.0
+
+
+def write_json(out_file, data):
+    # write then rename so that another node never reads a partial file
+    fd, tmp_file = tempfile.mkstemp(prefix=".tmp_", dir=os.path.dirname(out_file))
+    with os.fdopen(fd, "w") as out_f:
+        json.dump(data, out_f, indent=2)
+    os.replace(tmp_file, out_file)
+    return out_file
+
+
+def read_json(in_file):
+    try:
+        with open(in_file) as in_f:
+            return json.load(in_f, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError):
+        return None
+
+
+def shard_of(sample_id, shards):
+    return int(hashlib.sha1(sample_id.encode("utf-8")).hexdigest(), 16) % shards
+
+
+def shard_name(shard):
+    return "{0:03d}".format(shard)
+
+
+def init_queue(queue_dir, sample_sheet, work_dir, initial, options=(), shards=16, max_attempts=3):
+    """
+    Create a queue of the samples of a sheet, their results to be written to <work_dir>/<sample id>. options are
+    the options of every sample run. Samples already queued are kept, so a sheet can be extended.
+    """
+    samples = batch.read_sample_sheet(sample_sheet)
+    for name in QUEUE_DIRS:
+        os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+    config = read_json(os.path.join(queue_dir, QUEUE_FILE))
+    if config is None:
+        config = OrderedDict([("work_dir", os.path.abspath(work_dir)), ("initial", initial),
+                              ("options", list(options)), ("shards", shards), ("max_attempts", max_attempts),
+                              ("created", time.strftime("%Y-%m-%dT%H:%M:%S"))])
+        write_json(os.path.join(queue_dir, QUEUE_FILE), config)
+    added = 0
+    for sample_id, reads_1, reads_2 in samples:
+        shard = shard_name(shard_of(sample_id, config["shards"]))
+        for name in ("tasks", "leases"):
+            os.makedirs(os.path.join(queue_dir, name, shard), exist_ok=True)
+        task_file = os.path.join(queue_dir, "tasks", shard, sample_id + ".json")
+        if not os.path.exists(task_file):
+            write_json(task_file, OrderedDict([("sample", sample_id), ("reads_1", reads_1), ("reads_2", reads_2)]))
+            added += 1
+    return config, added, len(samples)
+
+
+class Lease:
+    """
+    Claim of a sample by a worker: <queue>/leases/<shard>/<sample>.lease, created atomically (O_EXCL) and touched
+    by a heartbeat thread while the sample runs. A lease without heartbeat for longer than the lease duration is
+    expired and can be reclaimed by any worker. The clocks of the nodes must agree within a fraction of it.
+    """
+
+    def __init__(self, lease_file, worker_id):
+        self.lease_file = lease_file
+        self.worker_id = worker_id
+        self.token = uuid.uuid4().hex
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lost = False
+
+    @staticmethod
+    def expired(lease_file, duration):
+        try:
+            return time.time() - os.stat(lease_file).st_mtime > duration
+        except FileNotFoundError:
+            return False
+
+    def acquire(self, duration):
+        """
+        Create the lease, reclaiming it when it expired. Return False when another worker holds it.
+        """
+        for _ in range(2):
+            try:
+                fd = os.open(self.lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self.reclaim(duration):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as out_f:
+                json.dump(OrderedDict([("worker", self.worker_id), ("host", socket.gethostname()),
+                                       ("pid", os.getpid()), ("token", self.token), ("claimed", time.time())]),
+                          out_f)
+            return True
+        return False
+
+    def reclaim(self, duration):
+        # only one worker wins the rename of the expired lease, then checks that it moved the lease it judged
+        # expired and not a lease just taken by another worker
+        previous = read_json(self.lease_file)
+        if not self.expired(self.lease_file, duration):
+            return False
+        stale_file = "{0}.stale.{1}".format(self.lease_file, self.token)
+        try:
+            os.rename(self.lease_file, stale_file)
+        except FileNotFoundError:
+            return False
+        moved = read_json(stale_file)
+        if previous is not None and moved is not None and moved.get("token") != previous.get("token"):
+            # put the live lease back; when a third worker already took the lease it is left in stale_file, which
+            # may be its only copy
+            try:
+                os.link(stale_file, self.lease_file)
+            except OSError as e:
+                print("WARNING: lease of {0} (worker {1}) not restored: {2}, left in {3}".format(
+                    os.path.basename(self.lease_file)[:-len(".lease")], moved.get("worker", "unknown"), e.strerror,
+                    stale_file), flush=True)
+                return False
+            os.remove(stale_file)
+            return False
+        os.remove(stale_file)
+        print("Lease of {0} expired (worker {1}), reclaimed".format(
+            os.path.basename(self.lease_file)[:-len(".lease")], (previous or {}).get("worker", "unknown")),
+            flush=True)
+        return True
+
+    def held(self):
+        lease = read_json(self.lease_file)
+        return lease is not None and lease.get("token") == self.token
+
+    def beat(self, interval, callback=None):
+        while not self.stop_event.wait(interval):
+            if not self.held():
+                # reclaimed while this worker was stalled: the sample runs elsewhere, stop this run
+                print("Lease {0} lost, stopping".format(self.lease_file), flush=True)
+                self.lost = True
+                metrics.stop_run("lease {0} lost".format(self.lease_file))
+                return
+            os.utime(self.lease_file)
+            if callback:
+                callback()
+
+    def start_heartbeat(self, interval, callback=None):
+        self.thread = threading.Thread(target=self.beat, args=(interval, callback), daemon=True)
+        self.thread.start()
+
+    def release(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.held():
+            os.remove(self.lease_file)
+
+
+class Worker:
+    """
+    Worker of a queue: claims the samples one at a time, scanning the shards from its own starting shard, runs
+    them with mutAnalysis.main and records the outcome. Its progress is written to <queue>/workers/<worker>.json.
+    """
+
+    def __init__(self, queue_dir, options=(), lease=LEASE, heartbeat=HEARTBEAT, poll=POLL_INTERVAL):
+        self.queue_dir = queue_dir
+        self.config = read_json(os.path.join(queue_dir, QUEUE_FILE))
+        if self.config is None:
+            print("\nNo queue in {0}: mutanalysis queue init\n".format(queue_dir))
+            exit(1)
+        self.options = list(options)
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.poll = poll
+        self.worker_id = "{0}-{1}-{2}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.status = OrderedDict([("worker", self.worker_id), ("host", socket.gethostname()), ("pid", os.getpid()),
+                                   ("started", time.time()), ("state", "idle"), ("sample", None), ("done", 0),
+                                   ("failed", 0)])
+
+    def write_status(self, **changes):
+        self.status.update(changes)
+        self.status["seen"] = time.time()
+        write_json(os.path.join(self.queue_dir, "workers", self.worker_id + ".json"), self.status)
+
+    def shards(self):
+        # each worker starts on its own shard to spread the claims
+        shards = self.config["shards"]
+        first = shard_of(self.worker_id, shards)
+        return [shard_name((first + i) % shards) for i in range(shards)]
+
+    def finished(self, sample_id):
+        return any(os.path.exists(os.path.join(self.queue_dir, state, sample_id + ".json"))
+                   for state in ("done", "failed"))
+
+    def pending(self):
+        """
+        Tasks not finished yet, as (shard, sample id) in claim order.
+        """
+        tasks = []
+        for shard in self.shards():
+            task_dir = os.path.join(self.queue_dir, "tasks", shard)
+            if not os.path.isdir(task_dir):
+                continue
+            for task_file in sorted(os.listdir(task_dir)):
+                if task_file.endswith(".json") and not self.finished(task_file[:-len(".json")]):
+                    tasks.append((shard, task_file[:-len(".json")]))
+        return tasks
+
+    def attempts(self, shard, sample_id):
+        attempts_file = os.path.join(self.queue_dir, "tasks", shard, sample_id + ".attempts")
+        if not os.path.exists(attempts_file):
+            return 0
+        with open(attempts_file) as in_f:
+            return sum(1 for _ in in_f)
+
+    def record(self, state, sample_id, result):
+        write_json(os.path.join(self.queue_dir, state, sample_id + ".json"), result)
+
+    def run_task(self, shard, sample_id, lease):
+        task = read_json(os.path.join(self.queue_dir, "tasks", shard, sample_id + ".json"))
+        attempt = self.attempts(shard, sample_id) + 1
+        if attempt > self.config["max_attempts"]:
+            # every attempt ended without an outcome (crashed or stopped workers)
+            self.record("failed", sample_id, OrderedDict([("sample", sample_id), ("attempts", attempt - 1),
+                                                          ("error", "no outcome after {0} attempts".format(
+                                                              attempt - 1))]))
+            return "failed"
+        with open(os.path.join(self.queue_dir, "tasks", shard, sample_id + ".attempts"), "a") as out_f:
+            out_f.write("{0}\t{1}\n".format(self.worker_id, time.time()))
+
+        sample_dir = os.path.join(self.config["work_dir"], sample_id)
+        sample_argv = self.config["options"] + self.options + [
+            "-1", task["reads_1"], "-2", task["reads_2"], "-wd", sample_dir, "-i", self.config["initial"]]
+        self.write_status(state="running", sample=sample_id, attempt=attempt)
+        print("{0}: attempt {1} on {2}".format(sample_id, attempt, self.worker_id), flush=True)
+        # the stage of the run goes with each heartbeat
+        lease.start_heartbeat(self.heartbeat, lambda: self.write_status(stage=metrics.MANIFEST.current_stage()))
+        try:
+            sample_id, state, attempts, seconds, error = batch.run_sample(sample_id, sample_argv, sample_dir, 0)
+        finally:
+            lease.stop_event.set()
+        if lease.lost or not lease.held():
+            # reclaimed by another worker, which records the outcome: no marker, no further attempt here
+            print("{0}: lease lost after {1} s, not recorded".format(sample_id, seconds), flush=True)
+            return "lost"
+        result = OrderedDict([("sample", sample_id), ("work_dir", sample_dir), ("worker", self.worker_id),
+                              ("attempts", attempt), ("time_s", seconds), ("error", error)])
+        if state == "done":
+            self.record("done", sample_id, result)
+        elif attempt >= self.config["max_attempts"]:
+            self.record("failed", sample_id, result)
+        else:
+            # released for another attempt, on any worker
+            state = "retry"
+        print("{0}: {1} in {2} s {3}".format(sample_id, state, seconds, error), flush=True)
+        return state
+
+    def run(self, max_samples=0):
+        """
+        Process samples until every task of the queue is done or failed (or max_samples were run). Leases held by
+        other workers are waited for, and reclaimed when they expire.
+        """
+        self.write_status()
+        nb_samples = 0
+        while not max_samples or nb_samples < max_samples:
+            tasks = self.pending()
+            if not tasks:
+                break
+            claimed = False
+            for shard, sample_id in tasks:
+                lease = Lease(os.path.join(self.queue_dir, "leases", shard, sample_id + ".lease"), self.worker_id)
+                if not lease.acquire(self.lease):
+                    continue
+                try:
+                    # finished by another worker between the listing and the claim
+                    state = None if self.finished(sample_id) else self.run_task(shard, sample_id, lease)
+                finally:
+                    lease.release()
+                if state is None:
+                    continue
+                if state == "lost":
+                    # the run of this worker was stopped, its commands with it
+                    self.write_status(state="lost", sample=None, stage=None)
+                    return self.status
+                claimed = True
+                nb_samples += 1
+                if state in ("done", "failed"):
+                    self.status[state] += 1
+                self.write_status(state="idle", sample=None, stage=None)
+                break
+            if not claimed:
+                # every pending sample is held by a live worker
+                self.write_status(state="waiting")
+                time.sleep(self.poll)
+        self.write_status(state="finished")
+        return self.status
+
+
+def queue_status(queue_dir, lease=LEASE):
+    config = read_json(os.path.join(queue_dir, QUEUE_FILE))
+    if config is None:
+        print("\nNo queue in {0}\n".format(queue_dir))
+        exit(1)
+    counts = OrderedDict((state, 0) for state in ("pending", "running", "expired", "done", "failed"))
+    finished = {state: set(name[:-len(".json")] for name in os.listdir(os.path.join(queue_dir, state))
+                           if name.endswith(".json"))
+                for state in ("done", "failed")}
+    for shard in sorted(os.listdir(os.path.join(queue_dir, "tasks"))):
+        for task_file in os.listdir(os.path.join(queue_dir, "tasks", shard)):
+            if not task_file.endswith(".json"):
+                continue
+            sample_id = task_file[:-len(".json")]
+            lease_file = os.path.join(queue_dir, "leases", shard, sample_id + ".lease")
+            if sample_id in finished["done"]:
+                counts["done"] += 1
+            elif sample_id in finished["failed"]:
+                counts["failed"] += 1
+            elif os.path.exists(lease_file):
+                counts["expired" if Lease.expired(lease_file, lease) else "running"] += 1
+            else:
+                counts["pending"] += 1
+    workers = []
+    for status_file in sorted(os.listdir(os.path.join(queue_dir, "workers"))):
+        worker = read_json(os.path.join(queue_dir, "workers", status_file))
+        if worker:
+            worker["seen_s_ago"] = round(time.time() - worker["seen"], 1)
+            if worker["state"] != "finished" and worker["seen_s_ago"] > lease:
+                # no heartbeat for a whole lease: crashed or stalled
+                worker["state"] = "lost"
+            workers.append(worker)
+    return OrderedDict([("queue", os.path.abspath(queue_dir)), ("work_dir", config["work_dir"]),
+                        ("samples", counts), ("workers", workers)])
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='mutanalysis queue',
+        description='mutanalysis queue: share the samples of a sample sheet between workers started on any node '
+                    'that sees the queue directory. Options not listed here are passed to each sample run.',
+    )
+    parser.add_argument('action', choices=["init", "work", "status"],
+                        help="init: queue the samples of a sheet; work: run a worker until the queue is empty; "
+                             "status: count the samples per state and list the workers")
+    parser.add_argument('-q', '--queue', dest="queue", required=True,
+                        help="Queue directory, on a filesystem shared by the workers")
+    parser.add_argument('-s', '--sample-sheet', dest="sample_sheet", default='',
+                        help="init: TSV file of sample id, reads R1 and reads R2")
+    parser.add_argument('-wd', '--wkDir', dest="workDir", default='',
+                        help="init: working directory, each sample is written to <wkDir>/<sample id>")
+    parser.add_argument('-i', '--initial', dest="initial", default='', help="init: initial of user")
+    parser.add_argument('--shards', dest="shards", type=int, default=16,
+                        help="init: number of shard directories of the tasks (Default=16)")
+    parser.add_argument('--max-attempts', dest="max_attempts", type=int, default=3,
+                        help="init: attempts of a sample before it is failed (Default=3)")
+    parser.add_argument('--lease', dest="lease", type=float, default=LEASE,
+                        help="Seconds without heartbeat before the sample of a worker is reclaimed "
+                             "(Default={0:g})".format(LEASE))
+    parser.add_argument('--heartbeat', dest="heartbeat", type=float, default=HEARTBEAT,
+                        help="work: seconds between two heartbeats (Default={0:g})".format(HEARTBEAT))
+    parser.add_argument('--poll', dest="poll", type=float, default=POLL_INTERVAL,
+                        help="work: seconds between two scans when every sample is held by another worker "
+                             "(Default={0:g})".format(POLL_INTERVAL))
+    parser.add_argument('--max-samples', dest="max_samples", type=int, default=0,
+                        help="work: stop after this number of samples (Default=0, until the queue is empty)")
+    args, sample_options = parser.parse_known_args(argv)
+
+    queue_dir = os.path.abspath(args.queue)
+    if args.action == "init":
+        missing = [option for option, value in (("-s", args.sample_sheet), ("-wd", args.workDir),
+                                                ("-i", args.initial)) if not value]
+        if missing:
+            print("\nmutanalysis queue init needs {0}\n".format(", ".join(missing)))
+            exit(1)
+        config, added, total = init_queue(queue_dir, args.sample_sheet, args.workDir, args.initial, sample_options,
+                                          args.shards, args.max_attempts)
+        print("Queue {0}: {1} of {2} samples added, {3} shards, results in {4}".format(
+            queue_dir, added, total, config["shards"], config["work_dir"]), flush=True)
+    elif args.action == "work":
+        if args.heartbeat >= args.lease:
+            print("\nThe heartbeat (--heartbeat) must be shorter than the lease (--lease)\n")
+            exit(1)
+        worker = Worker(queue_dir, sample_options, args.lease, args.heartbeat, args.poll)
+        print("Worker {0} on queue {1}".format(worker.worker_id, queue_dir), flush=True)
+        status = worker.run(args.max_samples)
+        if status["state"] == "lost":
+            print("\nWorker {0} lost the lease of its sample and stopped\n".format(worker.worker_id), flush=True)
+            exit(1)
+        print("Worker {0} finished: {1} done, {2} failed".format(worker.worker_id, status["done"],
+                                                                status["failed"]), flush=True)
+    else:
+        print(json.dumps(queue_status(queue_dir, args.lease), indent=2), flush=True)
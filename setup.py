@@ -39,7 +39,8 @@ setup(name='mutanalysis',
       packages=["mutanalysis"],
       package_data={'mutanalysis': ['database/mutations.tsv', 'database/sequences.fasta']},
       include_package_data=True,
-      install_requires=['biopython', 'pandas'],
+      install_requires=['pandas'],
+      extras_require={'pysam': ['pysam'], 'arrow': ['pyarrow']},
       entry_points={"console_scripts": ['mutanalysis = mutanalysis.mutAnalysis:run']},
       zip_safe=False,
-      python_requires='>=3.6')
+      python_requires='>=3.7')
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Record the bam-readcount output that tests/test_pileup.py compares the pysam counter with: pileup.sam is written as
+an indexed BAM, then counted by bam-readcount with -b 0 and -b 20 on pileup_sites.txt. The outputs are written to
+pileup_b0.readcount and pileup_b20.readcount, the bam-readcount version and commands to pileup_readcount.json.
+Needs bam-readcount on the PATH and pysam.
+
+    python tests/data/record_readcount.py
+"""
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+
+import pysam
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+MIN_BASEQS = [0, 20]
+COMMAND = 'bam-readcount -w 0 -q 0 -b {0} -l {1} -f {2} {3}'
+
+
+def write_bam(sam_file, bam_file):
+    with pysam.AlignmentFile(sam_file, 'r') as sam, pysam.AlignmentFile(bam_file, 'wb', template=sam) as bam:
+        for read in sam:
+            bam.write(read)
+    pysam.index(bam_file)
+
+
+def bam_readcount_version():
+    # printed on stdout or stderr depending on the release
+    result = subprocess.run(['bam-readcount', '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True)
+    return result.stdout.strip()
+
+
+def main():
+    if not shutil.which('bam-readcount'):
+        print('bam-readcount is not on the PATH')
+        sys.exit(1)
+    work_dir = tempfile.mkdtemp(prefix='record_readcount_')
+    try:
+        bam_file = os.path.join(work_dir, 'pileup.bam')
+        write_bam(os.path.join(DATA_DIR, 'pileup.sam'), bam_file)
+        fasta_file = shutil.copy(os.path.join(DATA_DIR, 'pileup_ref.fasta'), work_dir)
+        pysam.faidx(fasta_file)
+        commands = OrderedDict()
+        for min_baseq in MIN_BASEQS:
+            cmd = COMMAND.format(min_baseq, os.path.join(DATA_DIR, 'pileup_sites.txt'), fasta_file, bam_file)
+            out_file = os.path.join(DATA_DIR, 'pileup_b{0}.readcount'.format(min_baseq))
+            with open(out_file, 'w') as out_f:
+                subprocess.run(cmd.split(), stdout=out_f, stderr=subprocess.DEVNULL, check=True)
+            commands[os.path.basename(out_file)] = COMMAND.format(min_baseq, 'pileup_sites.txt', 'pileup_ref.fasta',
+                                                                  'pileup.bam')
+    finally:
+        shutil.rmtree(work_dir)
+    provenance = OrderedDict([('bam_readcount', bam_readcount_version()), ('pysam', pysam.__version__),
+                              ('recorded', datetime.date.today().isoformat()), ('commands', commands)])
+    with open(os.path.join(DATA_DIR, 'pileup_readcount.json'), 'w') as out_f:
+        json.dump(provenance, out_f, indent=2)
+        out_f.write('\n')
+    print(json.dumps(provenance, indent=2))
+
+
+if __name__ == '__main__':
+    main()
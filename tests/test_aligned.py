@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from mutanalysis import aligned
+
+pysam = pytest.importorskip("pysam")
+
+
+@pytest.fixture
+def read_only_reference(tmp_path):
+    reference_dir = tmp_path / "reference"
+    reference_dir.mkdir()
+    reference_file = reference_dir / "genome.fasta"
+    reference_file.write_text(">ctg1 first contig\nACGTACGTACGTACGTACGT\n>ctg2\nTTTTGGGGCCCCAAAA\n")
+    reference_dir.chmod(0o555)
+    yield str(reference_file)
+    reference_dir.chmod(0o755)
+
+
+def test_local_reference_indexed_in_work_dir(read_only_reference, tmp_path, monkeypatch):
+    monkeypatch.delenv("REF_PATH", raising=False)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    local_file = aligned.local_reference(read_only_reference, str(work_dir))
+
+    assert os.path.dirname(local_file) == str(work_dir / "bam_reference")
+    assert os.path.exists(local_file + ".fai")
+    assert not os.path.exists(read_only_reference + ".fai")
+    assert aligned.read_reference(local_file) == aligned.read_reference(read_only_reference)
+    with pysam.FastaFile(local_file) as fasta:
+        assert fasta.fetch("ctg2", 4, 8) == "GGGG"
+    # a second run replaces the links of the first one
+    assert aligned.local_reference(read_only_reference, str(work_dir)) == local_file
+
+
+def test_local_reference_links_existing_index(tmp_path):
+    reference_file = tmp_path / "genome.fasta"
+    reference_file.write_text(">ctg1\nACGTACGTAC\n")
+    pysam.faidx(str(reference_file))
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+
+    local_file = aligned.local_reference(str(reference_file), str(work_dir))
+
+    assert os.path.realpath(local_file + ".fai") == str(reference_file) + ".fai"
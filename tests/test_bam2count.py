@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from mutanalysis import bam2count
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+INDEL_FIRST_LINE = os.path.join(DATA_DIR, 'indel_first_line.readcount')
+
+
+def test_indel_entry_on_first_line():
+    table = bam2count.read_bam_count(INDEL_FIRST_LINE)
+    assert list(table['position']) == [4, 5, 12, 13]
+    assert list(table['total_depth']) == [3, 3, 7, 6]
+    row = table.iloc[0]
+    assert (row['reference'], row['T_depth'], row['T_quality'], row['T_mapq']) == ('T', 2, 40.0, 55.0)
+    assert (row['T_plus'], row['T_minus'], row['N_depth']) == (1, 1, 0)
+
+
+@pytest.mark.parametrize('block_size', [1, 300, 1 << 26])
+def test_indel_entries_at_block_starts(block_size):
+    # a block of one byte starts a block on every line
+    expected = bam2count.read_bam_count(INDEL_FIRST_LINE)
+    tables = list(bam2count.iter_bam_count(INDEL_FIRST_LINE, block_size=block_size))
+    table = bam2count.pd.concat(tables, ignore_index=True)
+    assert table.equals(expected)
+
+
+def test_contig_name_with_colons():
+    table = bam2count.read_bam_count(INDEL_FIRST_LINE)
+    assert list(table['ID']) == ['ref1', 'ref1', 'HLA-A*01:01:01:01', 'HLA-A*01:01:01:01']
+    row = table.iloc[2]
+    assert (row['reference'], row['G_depth'], row['G_quality'], row['A_depth'], row['A_quality']) == \
+        ('G', 6, 37.5, 1, 20.0)
+    assert (row['A_plus'], row['A_minus']) == (0, 1)
+
+
+@pytest.mark.parametrize('scale', [1, 100])
+def test_percentiles_match_numpy(scale):
+    rng = bam2count.np.random.default_rng(scale)
+    for n in (1, 2, 7, 100, 2501):
+        values = bam2count.np.round(rng.random(n) * 60, 2) if scale == 100 else rng.integers(0, 500, n)
+        accumulator = bam2count.StatsAccumulator(scale)
+        accumulator.add(values)
+        for q in (0, 25, 50, 75, 100, 33.3):
+            assert accumulator.percentile(q) == bam2count.np.percentile(values, q)
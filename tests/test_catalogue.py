@@ -0,0 +1,38 @@
+import os
+import stat
+
+import pytest
+
+from mutanalysis import catalogue
+
+
+@pytest.fixture
+def cache_files(monkeypatch, tmp_path):
+    files = [str(tmp_path / "package" / "catalogue.json"), str(tmp_path / "user" / "catalogue.json")]
+    monkeypatch.setattr(catalogue, "cached_catalogue_files", lambda key: files)
+    return files
+
+
+def test_cache_readable_by_every_user(cache_files):
+    compiled = catalogue.load_catalogue()
+    assert stat.S_IMODE(os.stat(cache_files[0]).st_mode) == 0o644
+    assert catalogue.load_catalogue() == compiled
+
+
+@pytest.mark.parametrize("content", ["", '{"hash": "stale"}'])
+def test_unreadable_or_stale_cache_is_a_miss(cache_files, content):
+    os.makedirs(os.path.dirname(cache_files[0]))
+    with open(cache_files[0], "w") as out_f:
+        out_f.write(content)
+    compiled = catalogue.load_catalogue()
+    assert compiled["hash"] != "stale"
+    assert catalogue.load_catalogue() == compiled
+
+
+def test_cache_that_cannot_be_opened_is_a_miss(cache_files):
+    # a directory in place of the cache fails to open like a file of another user without read access (the tests
+    # may run as root, which reads any file)
+    os.makedirs(cache_files[0])
+    compiled = catalogue.load_catalogue()
+    assert os.path.exists(cache_files[1])
+    assert catalogue.load_catalogue() == compiled
@@ -0,0 +1,31 @@
+import os
+import signal
+import time
+
+from mutanalysis import daemon
+
+REFERENCE = {"catalogue": {"hash": "test"}, "index_file": "index"}
+
+
+def test_broken_pool_is_restarted(tmp_path):
+    queue = daemon.JobQueue(REFERENCE, workers=2)
+    try:
+        # every worker is forked at startup
+        worker_pids = queue.health()["worker_pids"]
+        assert len(worker_pids) == 2
+        # a worker killed out of memory breaks the pool
+        os.kill(worker_pids[0], signal.SIGKILL)
+        time.sleep(0.5)
+        spec = {"sample": "S1", "reads_1": "missing_R1.fq", "reads_2": "missing_R2.fq",
+                "work_dir": str(tmp_path / "S1"), "initial": "t"}
+        reply = queue.submit(spec)
+        assert reply["status"] == "ok"
+        restarted_pids = queue.health()["worker_pids"]
+        assert len(restarted_pids) == 2 and not set(restarted_pids) & set(worker_pids)
+        # the job runs on the new pool (and fails on its missing reads) instead of staying queued
+        deadline = time.time() + 60
+        while queue.job(reply["id"])["state"] in ("queued", "running") and time.time() < deadline:
+            time.sleep(0.1)
+        assert queue.job(reply["id"])["state"] == "failed"
+    finally:
+        queue.shutdown()
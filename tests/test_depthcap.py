@@ -0,0 +1,60 @@
+import os
+import stat
+
+import pytest
+
+from mutanalysis import depthcap
+
+# aligns every read pair on the first 30 bases of ref1, the reads of a mate file in order
+FAKE_BWA = """#!/usr/bin/env python3
+import sys
+fastq_1 = sys.argv[-2]
+print("@SQ\\tSN:ref1\\tLN:100")
+print("@SQ\\tSN:ref2\\tLN:100")
+with open(fastq_1) as in_1:
+    lines = in_1.read().split()
+for i in range(0, len(lines), 4):
+    name, seq = lines[i][1:], lines[i + 1]
+    for flag in (99, 147):
+        print("\\t".join([name, str(flag), "ref1", "1", "60", "30M", "=", "1", "30", seq, "I" * 30]))
+"""
+
+
+@pytest.fixture
+def reads(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    bwa = bin_dir / "bwa"
+    bwa.write_text(FAKE_BWA)
+    bwa.chmod(bwa.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", "{0}{1}{2}".format(bin_dir, os.pathsep, os.environ["PATH"]))
+    files = []
+    for mate in (1, 2):
+        fastq_file = tmp_path / "reads_R{0}.fastq".format(mate)
+        fastq_file.write_text("".join("@pair{0}/{1}\n{2}\n+\n{3}\n".format(i, mate, "ACGT" * 7 + "AC", "I" * 30)
+                                      for i in range(25)))
+        files.append(str(fastq_file))
+    return files
+
+
+def test_chunk_alignments_kept_as_final_alignment(reads, tmp_path):
+    # the codon of ref2 is never covered: every pair is read, aligned once and kept
+    codons = {("geneA", "M1I"): ("ref1", 4), ("geneB", "A5T"): ("ref2", 13)}
+    out_1, out_2, report = depthcap.cap_reads("index", reads[0], reads[1], str(tmp_path), codons, target_depth=10,
+                                              chunk_size=10, threads=1)
+    assert (report["kept_pairs"], report["chunks"], report["stop"]) == (25, 3, "end of input")
+    assert report["under_target"] == ["geneB\tA5T"]
+    assert report["depth"]["geneA\tM1I"] == 50
+    with open(report["alignment"]) as sam_f:
+        lines = sam_f.read().splitlines()
+    assert [line for line in lines if line.startswith("@")] == ["@SQ\tSN:ref1\tLN:100", "@SQ\tSN:ref2\tLN:100"]
+    assert len(lines) == 2 + 2 * 25
+
+
+def test_target_reached_keeps_alignment_of_consumed_pairs(reads, tmp_path):
+    codons = {("geneA", "M1I"): ("ref1", 4)}
+    _, _, report = depthcap.cap_reads("index", reads[0], reads[1], str(tmp_path), codons, target_depth=10,
+                                      chunk_size=10, threads=1)
+    assert (report["kept_pairs"], report["stop"], report["under_target"]) == (10, "target depth reached", [])
+    with open(report["alignment"]) as sam_f:
+        assert sum(1 for line in sam_f if not line.startswith("@")) == 2 * 10
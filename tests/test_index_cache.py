@@ -0,0 +1,72 @@
+import os
+import stat
+
+import pytest
+
+from mutanalysis import index_cache
+
+# writes every index file of "bwa index -p <prefix> <fasta>" with the count of the indexes built
+FAKE_BWA = """#!/bin/sh
+count=$(cat "$FAKE_BWA_COUNT" 2>/dev/null || echo 0)
+count=$((count + 1))
+echo $count > "$FAKE_BWA_COUNT"
+for ext in amb ann bwt pac sa; do echo "index $count" > "$3.$ext"; done
+"""
+
+
+@pytest.fixture
+def reference(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    bwa = bin_dir / "bwa"
+    bwa.write_text(FAKE_BWA)
+    bwa.chmod(bwa.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", "{0}{1}{2}".format(bin_dir, os.pathsep, os.environ["PATH"]))
+    monkeypatch.setenv("FAKE_BWA_COUNT", str(tmp_path / "count.txt"))
+    sequence_file = tmp_path / "sequence.fasta"
+    sequence_file.write_text(">gene1\nACGTACGTAC\n")
+    return str(sequence_file)
+
+
+def read_index(prefix):
+    with open(prefix + ".bwt") as in_f:
+        return in_f.read().strip()
+
+
+def test_index_built_once(reference, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    prefix = index_cache.cached_index(reference, cache_dir)
+    assert index_cache.cached_index(reference, cache_dir) == prefix
+    assert read_index(prefix) == "index 1"
+    assert stat.S_IMODE(os.stat(os.path.dirname(prefix)).st_mode) == 0o755
+
+
+def test_force_rebuild_keeps_the_index_in_use(reference, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    prefix = index_cache.cached_index(reference, cache_dir)
+    rebuilt_prefix = index_cache.cached_index(reference, cache_dir, force=True)
+
+    # a run started on the first index still reads it, new runs get the rebuilt one
+    assert rebuilt_prefix != prefix
+    assert read_index(prefix) == "index 1"
+    assert read_index(rebuilt_prefix) == "index 2"
+    assert index_cache.cached_index(reference, cache_dir) == rebuilt_prefix
+    entry_dir = os.path.join(cache_dir, index_cache.file_checksum(reference))
+    assert os.path.islink(entry_dir)
+    assert not [name for name in os.listdir(cache_dir) if ".link_" in name]
+
+
+def test_force_rebuild_of_an_entry_built_in_place(reference, tmp_path):
+    cache_dir = tmp_path / "cache"
+    entry_dir = cache_dir / index_cache.file_checksum(reference)
+    entry_dir.mkdir(parents=True)
+    for ext in index_cache.INDEX_EXTENSIONS:
+        (entry_dir / (index_cache.INDEX_PREFIX + ext)).write_text("index 0\n")
+
+    prefix = index_cache.cached_index(reference, str(cache_dir), force=True)
+
+    assert read_index(prefix) == "index 1"
+    assert os.path.islink(str(entry_dir))
+    kept = [path for path in cache_dir.glob(entry_dir.name + ".*") if path.is_dir() and not path.is_symlink()
+            and read_index(str(path / index_cache.INDEX_PREFIX)) == "index 0"]
+    assert len(kept) == 1
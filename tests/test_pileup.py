@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from mutanalysis import bam2count, pileup
+
+pysam = pytest.importorskip('pysam')
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+@pytest.fixture(scope='module')
+def fixture_files(tmp_path_factory):
+    # pileup.sam holds a deletion, an insertion, a refskip, an N base, low base qualities, a mapq 0 read and a
+    # duplicate, in both orientations
+    work_dir = tmp_path_factory.mktemp('pileup')
+    bam_file = str(work_dir / 'pileup.bam')
+    with pysam.AlignmentFile(os.path.join(DATA_DIR, 'pileup.sam'), 'r') as sam, \
+            pysam.AlignmentFile(bam_file, 'wb', template=sam) as bam:
+        for read in sam:
+            bam.write(read)
+    pysam.index(bam_file)
+    # the reference is indexed next to the BAM, not in the repository
+    fasta_file = shutil.copy(os.path.join(DATA_DIR, 'pileup_ref.fasta'), str(work_dir))
+    pysam.faidx(fasta_file)
+    return bam_file, fasta_file
+
+
+def bam_readcount_table(fixture_files, min_baseq, tmp_path):
+    """
+    Count table of bam-readcount on the fixture: run when it is installed, else recorded by data/record_readcount.py.
+    """
+    if shutil.which('bam-readcount'):
+        bam_file, fasta_file = fixture_files
+        out_file = str(tmp_path / 'pileup.readcount')
+        with open(out_file, 'w') as out_f:
+            subprocess.run(['bam-readcount', '-w', '0', '-q', '0', '-b', str(min_baseq), '-l',
+                            os.path.join(DATA_DIR, 'pileup_sites.txt'), '-f', fasta_file, bam_file], stdout=out_f,
+                           stderr=subprocess.DEVNULL, check=True)
+        return bam2count.read_bam_count(out_file)
+    if not os.path.exists(os.path.join(DATA_DIR, 'pileup_readcount.json')):
+        pytest.skip('bam-readcount is not installed and its output was not recorded (tests/data/record_readcount.py)')
+    return bam2count.read_bam_count(os.path.join(DATA_DIR, 'pileup_b{0}.readcount'.format(min_baseq)))
+
+
+@pytest.mark.parametrize('min_baseq', [0, 20])
+def test_count_regions_matches_bam_readcount(fixture_files, min_baseq, tmp_path):
+    expected = bam_readcount_table(fixture_files, min_baseq, tmp_path)
+    table = pileup.count_regions(*fixture_files, [('ref1', 1, 30)], min_baseq=min_baseq)
+    assert list(table.columns) == list(expected.columns)
+    assert len(table) == len(expected)
+    for column in expected.columns:
+        if expected[column].dtype == float:
+            np.testing.assert_allclose(table[column].values.astype(float), expected[column].values, atol=0.005,
+                                       err_msg=column)
+        else:
+            assert list(table[column]) == list(expected[column]), column
+
+
+def test_total_depth_counts_deletions_and_refskips(fixture_files):
+    table = pileup.count_regions(*fixture_files, [('ref1', 5, 6)])
+    # r1, r3, r5 carry a base, r2 a deletion and r4 a refskip
+    assert list(table['total_depth']) == [5, 5]
+    bases = table[['{0}_depth'.format(base) for base in pileup.BASES]].sum(axis=1)
+    assert list(bases) == [3, 3]
+
+
+def test_min_baseq_keeps_depth(fixture_files):
+    table = pileup.count_regions(*fixture_files, [('ref1', 13, 13)], min_baseq=20)
+    # the only base (quality 10) is filtered out of the counts but not of the depth, as bam-readcount -b does
+    assert list(table['total_depth']) == [1]
+    assert list(table['C_depth']) == [0]
@@ -0,0 +1,116 @@
+import glob
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+from mutanalysis import metrics, runner
+
+
+@pytest.fixture(autouse=True)
+def manifest(monkeypatch, tmp_path):
+    # recorded in memory, no manifest file is written, the command logs go to a temporary directory
+    monkeypatch.setattr(metrics, "MANIFEST", metrics.RunManifest())
+    monkeypatch.setattr(runner, "LOG_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "STOP", threading.Event())
+    return metrics.MANIFEST
+
+
+def stop_later(delay):
+    stopper = threading.Timer(delay, metrics.stop_run, args=("test",))
+    stopper.start()
+    return stopper
+
+
+def test_command_usage_recorded(manifest):
+    assert runner.run("python3 -c 'x = bytearray(64 << 20); sum(range(2000000))'") == 0
+    entry = manifest.commands[-1]
+    for key in ("wall_s", "user_s", "sys_s", "max_rss_kb", "read_bytes", "write_bytes"):
+        assert key in entry, key
+    assert entry["user_s"] > 0
+    assert entry["max_rss_kb"] >= 64 << 10
+    assert entry["exit_status"] == 0
+
+
+def test_command_rss_excludes_the_run(manifest):
+    # the run holds 256 MB, a tiny command stays within the few MB of the usage wrapper
+    held = bytearray(256 << 20)
+    held[::4096] = b"\x01" * len(held[::4096])
+    with metrics.command("true"):
+        pass
+    assert runner.run("true") == 0
+    assert all(entry["max_rss_kb"] < 32 << 10 for entry in manifest.commands)
+
+
+def test_concurrent_commands_recorded(manifest):
+    assert runner.run_commands(["sleep 0.2"] * 4, jobs=2) == [0, 0, 0, 0]
+    assert len(manifest.commands) == 4
+    assert all("user_s" in entry and entry["exit_status"] == 0 for entry in manifest.commands)
+
+
+def test_timeout_stops_and_reaps_command(manifest):
+    start = time.time()
+    assert runner.run("sleep 30", timeout=0.3, check=False) < 0
+    assert time.time() - start < metrics.KILL_GRACE
+    entry = manifest.commands[-1]
+    assert entry["timed_out"] and entry["exit_status"] < 0 and "user_s" in entry
+
+
+def test_failure_cancels_running_commands(manifest):
+    start = time.time()
+    with pytest.raises(SystemExit):
+        runner.run_commands(["sleep 30", "sleep 0.1; exit 3", "sleep 30"], jobs=3)
+    assert time.time() - start < metrics.KILL_GRACE
+    states = sorted((entry.get("cancelled", False), entry["exit_status"]) for entry in manifest.commands)
+    assert states[0] == (False, 3)
+    assert all(cancelled and status < 0 for cancelled, status in states[1:])
+
+
+def test_stop_run_stops_running_commands(manifest):
+    start = time.time()
+    stopper = stop_later(0.3)
+    with pytest.raises(SystemExit):
+        runner.run_commands(["sleep 30; echo late", "sleep 30 | cat"], jobs=2)
+    stopper.join()
+    assert time.time() - start < metrics.KILL_GRACE
+    assert all(entry["exit_status"] < 0 for entry in manifest.commands)
+    assert not metrics.RUNNING
+    # stopped runs start no command
+    with pytest.raises(SystemExit):
+        runner.run("true")
+    assert len(manifest.commands) == 2
+
+
+def test_stop_run_stops_streamed_command(manifest):
+    stopper = stop_later(0.3)
+    with pytest.raises(SystemExit):
+        with metrics.command("sleep 30 | cat", stdout=metrics.PIPE) as process:
+            process.stdout.read()
+    stopper.join()
+    assert manifest.commands[-1]["exit_status"] < 0
+    assert not metrics.RUNNING
+
+
+def test_failure_quotes_stage_log(manifest, tmp_path, capsys):
+    with metrics.timed_stage("Sort BAM"):
+        assert runner.run("echo sorted") == 0
+        with pytest.raises(SystemExit):
+            runner.run("set -o pipefail; echo '[bam_sort] truncated file' >&2; exit 1")
+    logs = sorted(os.listdir(str(tmp_path)))
+    assert [log.rsplit(".", 2)[0] for log in logs] == ["Sort_BAM.echo", "Sort_BAM.echo"]
+    output = capsys.readouterr().out
+    assert "[bam_sort] truncated file" in output
+    assert os.path.join(str(tmp_path), logs[1]) in output
+
+
+def test_temporary_logs_kept_on_failure_only(manifest, monkeypatch):
+    monkeypatch.setattr(runner, "LOG_DIR", None)
+    before = set(glob.glob(os.path.join(tempfile.gettempdir(), "mutanalysis_*")))
+    assert runner.run_commands(["echo ok", "echo lost >&2; exit 4"], check=False) == [0, 4]
+    kept = set(glob.glob(os.path.join(tempfile.gettempdir(), "mutanalysis_*"))) - before
+    assert len(kept) == 1
+    kept_log = kept.pop()
+    assert runner.log_tail(kept_log) == "lost"
+    os.remove(kept_log)
@@ -0,0 +1,67 @@
+import json
+import os
+import time
+
+import pytest
+
+from mutanalysis import workqueue
+
+
+def write_lease(lease_file, worker, age=0.0):
+    with open(lease_file, "w") as out_f:
+        json.dump({"worker": worker, "token": worker + "-token"}, out_f)
+    claimed = time.time() - age
+    os.utime(lease_file, (claimed, claimed))
+
+
+@pytest.fixture
+def lease_file(tmp_path):
+    # lease of w1, expired
+    lease_file = str(tmp_path / "S01.lease")
+    write_lease(lease_file, "w1", age=60)
+    return lease_file
+
+
+def stale_files(lease_file):
+    directory = os.path.dirname(lease_file)
+    return [name for name in os.listdir(directory) if ".stale." in name]
+
+
+def test_expired_lease_reclaimed(lease_file):
+    lease = workqueue.Lease(lease_file, "w2")
+    assert lease.acquire(10)
+    assert lease.held()
+    assert not stale_files(lease_file)
+
+
+def test_renewed_lease_put_back(lease_file, monkeypatch):
+    rename = os.rename
+
+    def renew_then_rename(src, dst):
+        # w3 reclaims the expired lease between the expiry check and the rename of w2
+        os.remove(src)
+        write_lease(src, "w3")
+        rename(src, dst)
+
+    monkeypatch.setattr(workqueue.os, "rename", renew_then_rename)
+    assert not workqueue.Lease(lease_file, "w2").reclaim(10)
+    assert workqueue.read_json(lease_file)["worker"] == "w3"
+    assert not stale_files(lease_file)
+
+
+def test_lease_kept_when_not_put_back(lease_file, monkeypatch):
+    rename = os.rename
+
+    def renew_then_rename(src, dst):
+        # w3 renews the lease before the rename of w2, w4 creates one before w2 links the lease of w3 back
+        os.remove(src)
+        write_lease(src, "w3")
+        rename(src, dst)
+        write_lease(src, "w4")
+
+    monkeypatch.setattr(workqueue.os, "rename", renew_then_rename)
+    assert not workqueue.Lease(lease_file, "w2").reclaim(10)
+    assert workqueue.read_json(lease_file)["worker"] == "w4"
+    stale = stale_files(lease_file)
+    assert len(stale) == 1
+    assert workqueue.read_json(os.path.join(os.path.dirname(lease_file), stale[0]))["worker"] == "w3"